@@ -143,7 +143,7 @@ def FindGoodMeas(data, info_in, bthresh = 0.075):
         print('info_in["pairs"] does not exist and is required')
         print('exiting FindGoodMeas')
         return()
-    info_out = info_in.copy() # create info_out
+    info_out = ndot.Info(info_in) # create info_out (copy-on-write)
     try:
         GVwin
     except NameError:
@@ -163,7 +163,7 @@ def FindGoodMeas(data, info_in, bthresh = 0.075):
         data = np.reshape(data, [], Nt)
     
     # Crop data to synchpts if necessary. 
-    keep = np.logical_and(info_in['pairs']['r2d'] < 20, info_in['pairs']['WL'] == 2)
+    keep = np.logical_and(np.ravel(info_in['pairs']['r2d']) < 20, np.ravel(info_in['pairs']['WL']) == 2)
     foo = np.squeeze(data[keep,:])
     foo = ndot.highpass(foo, 0.02, info_in['system']['framerate']) # bandpass filter, omega_hp = 0.02
     foo = ndot.lowpass(foo, 1, info_in['system']['framerate'])     # bandpass filter, omega_lp = 1
@@ -179,26 +179,30 @@ def FindGoodMeas(data, info_in, bthresh = 0.075):
         while i <= (NtGV - 1):
             GVTD_win_means[i] =  np.mean(foob[i:((i+1)+ GVwin - 1)])
             i = i+1
-        t0 = np.where(GVTD_win_means == np.min(GVTD_win_means)) # find min and set t0 --> tF
-        tF = t0[0][0] + GVwin 
-        STD = np.std(data[:, t0[0][0]:tF], 1, ddof= 1)          # Calulate STD, make sure ddof param is set = 1 so that np.STD behaves the same as matlab STD
-    elif not 'synchpts' in info_out['paradigm']:
-        NsynchPts = len(info_out['paradigm']['synchpts'])
+        t0 = np.where(GVTD_win_means == np.min(GVTD_win_means))[0][0] # find min and set t0 --> tF
+        tF = t0 + GVwin 
+        STD = np.std(data[:, t0:tF], 1, ddof= 1)          # Calulate STD, make sure ddof param is set = 1 so that np.STD behaves the same as matlab STD
+    elif 'synchpts' in info_out['paradigm']:
+        synchpts = np.ravel(info_out['paradigm']['synchpts']).astype(int)
+        NsynchPts = len(synchpts)
         if NsynchPts > 2:
-            tF = info_out['paradigm']['synchpts'][-1]
-            t0 = info_out['paradigm']['synchpts'][0]
+            tF = synchpts[-1]
+            t0 = synchpts[0]
         elif NsynchPts == 2:
-            tF = info_out['paradigm']['synchpts'][1]
-            t0 = info_out['paradigm']['synchpts'][0]
+            tF = synchpts[1]
+            t0 = synchpts[0]
         else:
+            t0 = 0
             tF = data.shape[1]
         STD = np.std(data[:, t0:tF], 1, ddof=1)                 # Calculate STD.
     else:
+        t0 = 0
+        tF = Nt
         STD = np.std(data, 1, ddof=1)
     
     # Populate in table of on-the-fly calculated stuff.
     info_out['GVTDparams'] = {}
-    info_out['GVTDparams']['t0'] = t0[0][0]
+    info_out['GVTDparams']['t0'] = t0
     info_out['GVTDparams']['tF'] = tF
     if not 'MEAS' in info_out:
         info_out['MEAS'] = {}
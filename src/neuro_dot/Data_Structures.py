@@ -0,0 +1,200 @@
+# General imports
+import copy
+import numpy as np
+from collections.abc import ItemsView, ValuesView
+
+
+def _share(table):
+    # Keys of the arrays and sections of an Info or PairsTable, which
+    # both sides of a copy share until one of them accesses the key.
+    return {key for key, value in dict.items(table) if isinstance(value, (np.ndarray, _CopyOnWrite))}
+
+
+class _CopyOnWrite(dict):
+    # Dict whose copies share arrays and sections, each copied (sections
+    # one level) on first access. Subclasses convert values in _convert.
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._shared = set()
+        if len(args) == 1 and not kwargs and isinstance(args[0], _CopyOnWrite):
+            other = args[0].copy()
+            for key, value in dict.items(other):
+                self._set(key, self._convert(key, value))
+            self._shared = set(other._shared)
+            return
+        for key, value in dict(*args, **kwargs).items():
+            self._set(key, self._convert(key, value))
+        self._shared = _share(self)
+
+    def _convert(self, key, value):
+        return value
+
+    def _set(self, key, value):
+        dict.__setitem__(self, key, value)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if key in self._shared:
+            value = value.copy()
+            dict.__setitem__(self, key, value)
+            self._shared.discard(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if isinstance(value, _CopyOnWrite):
+            value = value.copy()
+        self._set(key, self._convert(key, value))
+        self._shared.discard(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._shared.discard(key)
+
+    def get(self, key, default = None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default = None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        key = next(reversed(self))
+        return key, self.pop(key)
+
+    def clear(self):
+        dict.clear(self)
+        self._shared.clear()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def items(self):
+        return ItemsView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def copy(self):
+        shared = _share(self)
+        self._shared |= shared
+        out = self.__class__.__new__(self.__class__)
+        dict.update(out, dict.items(self))
+        out._shared = set(shared)
+        return out
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        out = self.copy()
+        for key, value in list(dict.items(out)):
+            if isinstance(value, _CopyOnWrite):
+                dict.__setitem__(out, key, copy.deepcopy(value, memo))
+                out._shared.discard(key)
+            elif not isinstance(value, np.ndarray):
+                dict.__setitem__(out, key, copy.deepcopy(value, memo))
+        return out
+
+    def __reduce__(self):
+        return (self.__class__, (self.to_dict(),))
+
+    def to_dict(self):
+        '''
+        Returns a plain nested dict (e.g., for SCIPY.IO.SAVEMAT), with
+        writable copies of the arrays.
+        '''
+        out = dict()
+        for key, value in dict.items(self):
+            if isinstance(value, _CopyOnWrite):
+                value = value.to_dict()
+            elif isinstance(value, np.ndarray):
+                value = np.array(value)
+            out[key] = value
+        return out
+
+
+class PairsTable(_CopyOnWrite):
+    '''
+    PAIRSTABLE Measurement list ("info.pairs") as a table of columns.
+
+    pairs = PAIRSTABLE(info['pairs']) holds the columns of the
+    measurement list as they are given (e.g., the MEAS x 1 float64
+    columns of the loaders); their type and shape are not changed. All
+    columns must have the same number of rows.
+
+    A PAIRSTABLE is a dict of its columns, and is copied like an INFO
+    (see INFO): copies share the column arrays until they are accessed.
+
+    Fields and methods:
+        :Nm:        Number of measurements (rows).
+        :take(idx): Table of the rows "idx" (indices or a boolean mask,
+                    MEAS long or MEAS x 1).
+        :to_dict(): Plain dict of the columns.
+
+    See Also: INFO.
+    '''
+    def _convert(self, key, value):
+        Nm = self.Nm
+        if np.ndim(value) > 0 and Nm is not None and np.shape(value)[0] != Nm and len(self) > (key in self):
+            raise ValueError('Error: pairs column "' + str(key) + '" has ' + str(np.shape(value)[0])
+                             + ' rows, expected ' + str(Nm) + '.')
+        return value
+
+    @property
+    def Nm(self):
+        for key, value in dict.items(self):
+            if np.ndim(value) > 0:
+                return np.shape(value)[0]
+        return None
+
+    def take(self, idx):
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.ravel(idx)
+        out = PairsTable()
+        for key, value in dict.items(self):
+            dict.__setitem__(out, key, np.asarray(value)[idx] if np.ndim(value) > 0 else value)
+        return out
+
+
+class Info(_CopyOnWrite):
+    '''
+    INFO Copy-on-write container for the NeuroDOT "info" structure.
+
+    info = INFO(info_in) wraps the nested dict "info_in": each section
+    (e.g., "system", "paradigm", "MEAS") is an INFO, and "pairs" is a
+    PAIRSTABLE. Arrays keep their type and shape. They are shared with
+    "info_in", not copied, until "info" accesses them.
+
+    INFO is a dict, so existing code can index, test, assign and write
+    into fields as before. Copies (info.copy(), copy.copy and
+    copy.deepcopy) are cheap: they share the sections and arrays of
+    "info", and a section (one level) or an array is copied the first
+    time either side accesses it. Changing a copy, e.g.
+        info_out = info.copy()
+        info_out['system']['framerate'] = 1
+        info_out['pairs']['r3d'][0] = 5
+    leaves "info" unchanged. Dicts assigned into an INFO are converted,
+    not kept by reference. Other values (e.g., lists) are shared by
+    copy(), as in dict.copy, and copied by copy.deepcopy.
+
+    Fields and methods:
+        :copy():    Copy-on-write copy.
+        :to_dict(): Plain nested dict of writable arrays.
+
+    See Also: PAIRSTABLE.
+    '''
+    def _convert(self, key, value):
+        if isinstance(value, _CopyOnWrite):
+            return value
+        if isinstance(value, dict):
+            return PairsTable(value) if key == 'pairs' else Info(value)
+        return value
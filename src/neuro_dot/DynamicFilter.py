@@ -45,16 +45,20 @@ def DynamicFilter(input_data, info_in, params, mode, save = 'no', pathToSave = '
         :fft_ba: display Fourier transform of block-averaged data
     '''
     lmdata = ndot.logmean(input_data)[0]
-    __info = copy.deepcopy(info_in)
-    keep = np.logical_and(np.logical_and(np.where(__info['pairs']['WL'] == 2,1,0), np.where(__info['pairs']['r2d'] < 40,1,0)), __info['MEAS']['GI']) # measurements to include
-    keepd1=np.logical_and(np.logical_and(__info['MEAS']['GI'], np.where(__info['pairs']['r2d']<20,1,0)), np.where(__info['pairs']['WL']==2,1,0))
-    keepd2=np.logical_and(np.logical_and(np.logical_and(__info['MEAS']['GI'], np.where(__info['pairs']['r2d']>=20,1,0)), np.where(__info['pairs']['r2d']<30,1,0)), np.where(__info['pairs']['WL']==2,1,0))
-    keepd3=np.logical_and(np.logical_and(np.logical_and(__info['MEAS']['GI'], np.where(__info['pairs']['r2d']>=30,1,0)), np.where(__info['pairs']['r2d']<40,1,0)), np.where(__info['pairs']['WL']==2,1,0))
+    __info = ndot.Info(info_in)
+    # MEAS x 1 columns as vectors, so that the masks stay MEAS long
+    WL = np.ravel(__info['pairs']['WL'])
+    r2d = np.ravel(__info['pairs']['r2d'])
+    GI = np.ravel(__info['MEAS']['GI'])
+    keep = np.logical_and(np.logical_and(np.where(WL == 2,1,0), np.where(r2d < 40,1,0)), GI) # measurements to include
+    keepd1=np.logical_and(np.logical_and(GI, np.where(r2d<20,1,0)), np.where(WL==2,1,0))
+    keepd2=np.logical_and(np.logical_and(np.logical_and(GI, np.where(r2d>=20,1,0)), np.where(r2d<30,1,0)), np.where(WL==2,1,0))
+    keepd3=np.logical_and(np.logical_and(np.logical_and(GI, np.where(r2d>=30,1,0)), np.where(r2d<40,1,0)), np.where(WL==2,1,0))
 
     
     if mode == 'fft_lml':
         figdata = lmdata
-        keep = np.logical_and(np.logical_and(np.where(__info['pairs']['WL'] == 2,1,0), np.where(__info['pairs']['r2d'] < 40,1,0)), __info['MEAS']['GI']) # measurements to include
+        keep = np.logical_and(np.logical_and(np.where(WL == 2,1,0), np.where(r2d < 40,1,0)), GI) # measurements to include
 
     elif mode == 'lml':
         figdata = lmdata
@@ -120,7 +124,7 @@ def DynamicFilter(input_data, info_in, params, mode, save = 'no', pathToSave = '
         # % SSRdata = lp1data; % example to ignore SSR
 
     elif mode == 'fft_resample':
-        __info_new = info_in.copy()
+        __info_new = ndot.Info(info_in)
         if params['det'] ==1:
             figdata = ndot.detrend_tts(lmdata)
         if params['highpass']==1:   
@@ -135,7 +139,7 @@ def DynamicFilter(input_data, info_in, params, mode, save = 'no', pathToSave = '
         figdata, __info = ndot.resample_tts(figdata, __info_new, params['omega_resample'], params['rstol'])
 
     elif mode == 'resample':
-        __info_new = copy.deepcopy(info_in)
+        __info_new = ndot.Info(info_in)
         if params['det'] ==1:
             figdata = ndot.detrend_tts(lmdata)
         if params['highpass']==1:  
@@ -188,7 +192,7 @@ def DynamicFilter(input_data, info_in, params, mode, save = 'no', pathToSave = '
 
     if 'fft' in mode:
         if 'ba' not in mode:
-            __info['GVTD'] = ndot.CalcGVTD((figdata[np.logical_and(__info['MEAS']['GI'],np.where(__info['pairs']['r2d'] < 20,1,0)[0])]))
+            __info['GVTD'] = ndot.CalcGVTD((figdata[np.logical_and(np.ravel(__info['MEAS']['GI']), np.ravel(__info['pairs']['r2d']) < 20)]))
             ndot.nlrGrayPlots_220324(figdata,__info)
         else:   
             ndot.nlrGrayPlots_220324(figdata,__info, mode = 'ba')
@@ -2,13 +2,22 @@
 import sys
 import math
 import os
+import json
+import hashlib
 import mat73
 import scipy.io as spio
 import numpy as np 
+import scipy.sparse as sps
 from pathlib import Path
+from collections import OrderedDict
 import nibabel as nb
 import io as fio
 import snirf 
+import h5py
+try:
+    import tomllib
+except ImportError: # Python < 3.11
+    import tomli as tomllib
 
 import neuro_dot as ndot
 
@@ -23,7 +32,111 @@ def check_keys(dict):
     return dict     
 
 
-def loadmat(filename):
+# Process-wide cache of parsed .mat files, least recently used first.
+_mat_cache = OrderedDict()
+_mat_cache_state = {'bytes': 0, 'max_bytes': 4 * 2**30}
+
+
+def _nbytes(obj):
+    # Approximate memory held by a parsed .mat variable.
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes + (sum(_nbytes(x) for x in obj.flat) if obj.dtype == object else 0)
+    if sps.issparse(obj):
+        return sum(getattr(obj, key).nbytes for key in ('data', 'indices', 'indptr', 'row', 'col') if hasattr(obj, key))
+    if isinstance(obj, dict):
+        return sum(_nbytes(x) for x in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(x) for x in obj)
+    return sys.getsizeof(obj)
+
+
+def _cache_copy(obj):
+    # Copy of a cached load for one caller: dicts and lists are copied,
+    # arrays are read-only views, so no caller can change the cache.
+    if isinstance(obj, dict):
+        return obj.__class__((k, _cache_copy(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [_cache_copy(x) for x in obj]
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            out = np.empty(np.shape(obj), dtype = object)
+            for k, x in enumerate(obj.flat):
+                out.flat[k] = _cache_copy(x)
+            return out
+        out = obj.view()
+        out.flags.writeable = False
+        return out
+    if sps.issparse(obj):
+        return obj.copy()
+    return obj
+
+
+def _cached_load(filename, variable_names, loader, parse):
+    # Returns parse(filename, variable_names) through the cache. Entries are
+    # keyed on the file's path, mtime and size, so a changed file is re-read.
+    # A request for a subset of variables is served from a cached full load.
+    st = os.stat(filename)
+    base = (os.path.abspath(filename), st.st_mtime_ns, st.st_size, loader)
+    names = None if variable_names is None else tuple(sorted(set(variable_names)))
+    for key in ((base + (names,)), (base + (None,))):
+        if key in _mat_cache:
+            _mat_cache.move_to_end(key)
+            data = _mat_cache[key][0]
+            if names is not None and key[-1] is None:
+                return _cache_copy({k: data[k] for k in names if k in data})
+            return _cache_copy(data)
+
+    data = parse(filename, None if names is None else list(names))
+    size = _nbytes(data)
+    if size <= _mat_cache_state['max_bytes']:
+        # Stale entries of the same file go first, then the least recently used.
+        for key in [k for k in _mat_cache if k[0] == base[0] and k[1:4] != base[1:4]]:
+            _mat_cache_state['bytes'] -= _mat_cache.pop(key)[1]
+        while _mat_cache and _mat_cache_state['bytes'] + size > _mat_cache_state['max_bytes']:
+            _mat_cache_state['bytes'] -= _mat_cache.popitem(last = False)[1][1]
+        _mat_cache[base + (names,)] = (data, size)
+        _mat_cache_state['bytes'] += size
+    return _cache_copy(data)
+
+
+def loadmat_cache(max_bytes = None, clear = False):
+    '''
+    LOADMAT_CACHE Sizes, clears, or reports the cache of LOADMAT and LOADMAT7P3.
+
+    info = LOADMAT_CACHE() returns the number of cached loads ("entries"),
+    their approximate size ("bytes") and the size budget ("max_bytes",
+    default 4 GB).
+
+    LOADMAT_CACHE(max_bytes) sets the budget, evicting the least recently
+    used loads as needed. 0 disables caching. LOADMAT_CACHE(clear = True)
+    empties the cache.
+
+    See Also: LOADMAT, LOADMAT7P3.
+    '''
+    if clear:
+        _mat_cache.clear()
+        _mat_cache_state['bytes'] = 0
+    if max_bytes is not None:
+        _mat_cache_state['max_bytes'] = int(max_bytes)
+        while _mat_cache and _mat_cache_state['bytes'] > _mat_cache_state['max_bytes']:
+            _mat_cache_state['bytes'] -= _mat_cache.popitem(last = False)[1][1]
+    return {'entries': len(_mat_cache), 'bytes': _mat_cache_state['bytes'], 'max_bytes': _mat_cache_state['max_bytes']}
+
+
+def _parse_mat(filename, variable_names):
+    data = spio.loadmat(filename, variable_names = variable_names, struct_as_record=False, squeeze_me=True)
+    return ndot.check_keys(data)
+
+
+def _parse_mat7p3(filename, variable_names):
+    data = mat73.loadmat(filename, use_attrdict = True, only_include = variable_names, verbose = False)
+    if variable_names is not None: # only_include also matches longer names ('A' -> 'Adot')
+        for key in [k for k in data if k not in variable_names]:
+            del data[key]
+    return ndot.check_keys(data)
+
+
+def loadmat(filename, variable_names = None, cache = False):
     '''
     LOADMAT Loads files with the *.mat extension.
     
@@ -36,14 +149,22 @@ def loadmat(filename):
     
     Loadmat calls the function check_keys to cure all entries
     which are still mat-objects. 
+
+    Only the variables listed in "variable_names" are read, if given.
+    With cache = True, loads are cached (see LOADMAT_CACHE) until the
+    file changes, so loading "data", "info" and "flags" from one file
+    parses it once. Each call then gets its own dicts, but the arrays
+    are read-only views of the cache: copy an array (np.array) before
+    modifying it in place.
     
     NOTE:This function does not work for .mat -v7.3 files. 
     '''
-    data = spio.loadmat(filename,struct_as_record=False, squeeze_me=True)
-    return ndot.check_keys(data)
+    if not cache:
+        return _parse_mat(filename, variable_names)
+    return _cached_load(filename, variable_names, 'mat', _parse_mat)
 
 
-def loadmat7p3(filename):
+def loadmat7p3(filename, variable_names = None, cache = False):
     '''
     LOADMAT7P3 Loads files with the *.mat extension in the "mat 7.3" format.
     
@@ -56,14 +177,190 @@ def loadmat7p3(filename):
     
     Loadmat7p3 calls the function check_keys to cure all entries
     which are still mat-objects. 
+
+    Only the variables listed in "variable_names" are read from the
+    HDF5 file, if given. With cache = True, loads are cached as in
+    LOADMAT.
     
     NOTE:This function is to be used for .mat -v7.3 files only. 
     '''
-    data = mat73.loadmat(filename, use_attrdict = True )
-    return ndot.check_keys(data)
+    if not cache:
+        return _parse_mat7p3(filename, variable_names)
+    return _cached_load(filename, variable_names, 'mat7p3', _parse_mat7p3)
+
+
+def _plain_dict(obj):
+    # Nested dicts (e.g., mat73 AttrDicts) as plain dicts, as spio.savemat expects.
+    if isinstance(obj, dict):
+        return {key: _plain_dict(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_plain_dict(value) for value in obj]
+    return obj
+
+
+def _Amat_rows(infoA, Nm):
+    # [start, stop) rows of each wavelength of a wavelength-major MEAS x VOX A.
+    WL = None
+    if isinstance(infoA, dict) and 'pairs' in infoA and 'WL' in infoA['pairs']:
+        WL = np.asarray(infoA['pairs']['WL']).astype(int).ravel()
+    if WL is None or len(WL) != Nm or np.any(np.diff(WL) < 0):
+        return [[0, Nm]]
+    edges = np.flatnonzero(np.diff(WL)) + 1
+    bounds = np.concatenate(([0], edges, [Nm]))
+    return [[int(bounds[k]), int(bounds[k + 1])] for k in range(0, len(bounds) - 1)]
+
+
+def convert_Amat(filename, store = None, dtype = None, chunk = 4096):
+    '''
+    CONVERT_AMAT Converts an A-matrix .mat file into a memory-mappable store.
+
+    store = CONVERT_AMAT(filename) writes the sensitivity matrix "A" and
+    its "info" from the .mat file "filename" (v5 or v7.3) into the
+    directory "store" (default: "filename" with the extension replaced
+    by ".Astore"), which holds:
+        :A.npy:         MEAS x VOX matrix, wavelength-major rows (a
+                        [wl x meas x vox] A is unfolded as in the
+                        reconstruction notebook), one contiguous row
+                        block per wavelength.
+        :info.mat:      The "info" structure (tissue.dim, with Good_Vox,
+                        pairs, ...).
+        :manifest.json: Shape, dtype, wavelength row blocks, the SHA-256
+                        of A.npy's data and the size and mtime of the
+                        source file.
+
+    A v7.3 "A" is streamed from the HDF5 file "chunk" voxels at a time,
+    so it is never held in memory. If "store" is already up to date
+    with "filename", nothing is done. "dtype" (e.g., np.float32)
+    converts the stored matrix.
+
+    See Also: LOAD_AMAT, LOADMAT7P3.
+    '''
+    ## Parameters and Initialization.
+    if store is None:
+        store = os.path.splitext(filename)[0] + '.Astore'
+    st = os.stat(filename)
+    source = {'file': os.path.abspath(filename), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    manifest_fn = os.path.join(store, 'manifest.json')
+    if os.path.isfile(manifest_fn):
+        with open(manifest_fn, 'r') as fp:
+            old = json.load(fp)
+        if old.get('source', {}).get('size') == source['size'] and old.get('source', {}).get('mtime_ns') == source['mtime_ns'] \
+                and (dtype is None or np.dtype(old['dtype']) == np.dtype(dtype)):
+            return store
+    os.makedirs(store, exist_ok = True)
+    out_fn = os.path.join(store, 'A.npy')
+
+    ## Stream A into A.npy.
+    if h5py.is_hdf5(filename):
+        infoA = _plain_dict(ndot.loadmat7p3(filename, ['info'], cache = False).get('info', {}))
+        with h5py.File(filename, 'r') as f:
+            ds = f['A']
+            # MATLAB arrays are stored column-major: [wl x meas x vox] reads as (vox, meas, wl)
+            Nv = ds.shape[0]
+            Nwl = ds.shape[2] if ds.ndim == 3 else 1
+            Nmeas = ds.shape[1]
+            out = np.lib.format.open_memmap(out_fn, mode = 'w+', dtype = np.dtype(dtype or ds.dtype), shape = (Nwl * Nmeas, Nv))
+            for v0 in range(0, Nv, chunk):
+                v1 = min(v0 + chunk, Nv)
+                block = ds[v0:v1]
+                if ds.ndim == 3:
+                    for w in range(0, Nwl):
+                        out[w * Nmeas:(w + 1) * Nmeas, v0:v1] = np.transpose(block[:, :, w])
+                else:
+                    out[:, v0:v1] = np.transpose(block)
+    else:
+        mat = ndot.loadmat(filename, ['A', 'info'], cache = False)
+        A = mat['A']
+        infoA = mat.get('info', {})
+        if sps.issparse(A):
+            A = A.toarray()
+        if np.ndim(A) == 3: # [wl x meas x vox] --> [meas x vox]
+            A = np.reshape(A, (np.shape(A)[0] * np.shape(A)[1], np.shape(A)[2]))
+        out = np.lib.format.open_memmap(out_fn, mode = 'w+', dtype = np.dtype(dtype or A.dtype), shape = np.shape(A))
+        out[:] = A
+        del A
+    out.flush()
+
+    ## Content hash, over the data of A.npy.
+    sha = hashlib.sha256()
+    step = max(1, (64 * 2**20) // max(1, out.strides[0]))
+    for r0 in range(0, np.shape(out)[0], step):
+        sha.update(np.ascontiguousarray(out[r0:r0 + step]).data)
+
+    spio.savemat(os.path.join(store, 'info.mat'), {'info': infoA})
+    manifest = dict()
+    manifest['shape'] = [int(n) for n in np.shape(out)]
+    manifest['dtype'] = np.dtype(out.dtype).str
+    manifest['wl_rows'] = _Amat_rows(infoA, np.shape(out)[0])
+    manifest['sha256'] = sha.hexdigest()
+    manifest['source'] = source
+    del out
+    with open(manifest_fn, 'w') as fp:
+        json.dump(manifest, fp, indent = 1)
+
+    return store
+
+
+def load_Amat(store, keep = None, wl = None, verify = False):
+    '''
+    LOAD_AMAT Loads an A matrix from a store written by CONVERT_AMAT.
+
+    [A, infoA] = LOAD_AMAT(store) memory-maps the MEAS x VOX matrix "A"
+    (read-only) and loads its "info". Nothing is read until "A" is
+    used, and processes on one machine share the file's page cache.
+
+    [A, infoA] = LOAD_AMAT(store, keep) returns the rows "keep" (a
+    boolean mask or indices over MEAS) only. Rows that form one
+    contiguous range (e.g., a whole wavelength) are returned as a view
+    of the map, without copying. Otherwise only the kept rows are read.
+
+    [A, infoA] = LOAD_AMAT(store, keep, wl) restricts "A" (and "keep",
+    given over the rows of that wavelength) to the wavelength block
+    "wl" (1-based), as a view.
 
+    With "verify" set, the SHA-256 of the stored matrix is checked
+    against the manifest.
 
-def LoadVolumetricData(filename, pn, file_type):
+    See Also: CONVERT_AMAT.
+    '''
+    ## Parameters and Initialization.
+    with open(os.path.join(store, 'manifest.json'), 'r') as fp:
+        manifest = json.load(fp)
+    A = np.load(os.path.join(store, 'A.npy'), mmap_mode = 'r')
+    infoA = ndot.loadmat(os.path.join(store, 'info.mat'))['info']
+    if isinstance(infoA, dict) and 'tissue' in infoA and 'dim' in infoA['tissue']:
+        dim = infoA['tissue']['dim']
+        for key in dim:
+            if isinstance(dim[key], float) and dim[key] == int(dim[key]):
+                dim[key] = int(dim[key])
+    if verify:
+        sha = hashlib.sha256()
+        step = max(1, (64 * 2**20) // max(1, A.strides[0]))
+        for r0 in range(0, np.shape(A)[0], step):
+            sha.update(np.ascontiguousarray(A[r0:r0 + step]).data)
+        if sha.hexdigest() != manifest['sha256']:
+            raise ValueError('Error: A.npy in ' + store + ' does not match its manifest.')
+
+    ## Wavelength block.
+    if wl is not None:
+        if wl < 1 or wl > len(manifest['wl_rows']):
+            raise ValueError('Error: no wavelength block ' + str(wl) + ' in ' + store + '.')
+        r0, r1 = manifest['wl_rows'][wl - 1]
+        A = A[r0:r1]
+
+    ## Row subset, as a view when contiguous.
+    if keep is not None:
+        keep = np.ravel(np.asarray(keep))
+        rows = np.flatnonzero(keep) if keep.dtype == bool else keep.astype(np.int64)
+        if len(rows) > 0 and np.all(np.diff(rows) == 1):
+            A = A[rows[0]:rows[-1] + 1]
+        else:
+            A = A[rows]
+
+    return A, infoA
+
+
+def LoadVolumetricData(filename, pn, file_type, frames = None):
     '''
     LOADVOLUMETRICDATA Loads a volumetric data file
 
@@ -75,6 +372,15 @@ def LoadVolumetricData(filename, pn, file_type):
     [volume, header] = LOADVOLUMETRICDATA(filename) supports a full
     filename input, as long as the extension is included in the file name
     and matches a supported file type.
+
+    The image is memory-mapped, not read: "volume" is a read-only view
+    of the file (orientation flips are done through strides), and only
+    the parts that are used are loaded. Compressed ('nii.gz') or scaled
+    NIfTI data cannot be mapped and are read when loaded.
+
+    [volume, header] = LOADVOLUMETRICDATA(filename, pn, file_type, frames)
+    keeps only the time points "frames" (an index, a slice, or a list of
+    indices) of a 4D volume; only those frames are ever read.
     
     Supported File Types/Extensions: '.4dfp' 4dfp, 'nii' NIFTI.
     
@@ -85,20 +391,21 @@ def LoadVolumetricData(filename, pn, file_type):
     
     See Also: SAVEVOLUMETRICDATA.
     ''' 
-    header = dict()
-        
     if file_type == '4dfp':
         header_out = ndot.Read_4dfp_Header(filename + '.4dfp.ifh', pn)
-        # Read .img file.
+        # Map the .img file: float32, x fastest, in the byte order of the header.
         pn = pn + '/' + filename + '.4dfp.img'
-        with fio.open(pn,'rb',) as fp:
-            volume = np.fromfile(fp, dtype = '<f')
-            fp.close()
+        nV = (int(header_out['nVx']), int(header_out['nVy']), int(header_out['nVz']), int(header_out['nVt']))
+        byte = '<' if header_out['byte'] == 'l' else '>'
+        volume = np.memmap(pn, dtype = byte + 'f4', mode = 'r', shape = nV, order = 'F')
+        if frames is not None:
+            volume = volume[:, :, :, frames]
+            header_out['nVt'] = np.shape(volume)[3] if np.ndim(volume) == 4 else 1
 
     ## Put header into native space if not already.
         header_out = ndot.Make_NativeSpace_4dfp(header_out)
         ## Format for output.
-        volume =np.squeeze(np.reshape(volume, (int(header_out['nVx']), int(header_out['nVy']), int(header_out['nVz']), int(header_out['nVt']))))
+        volume = np.squeeze(volume)
         
         if header_out['acq'] == 'transverse':
             volume = np.flip(volume, 1)
@@ -118,7 +425,7 @@ def LoadVolumetricData(filename, pn, file_type):
         if file_type == 'nifti':
             file_type = 'nii'
 
-        nii = nb.load(pn + filename +  '.' + file_type)
+        nii = nb.load(pn + filename +  '.' + file_type, mmap = 'r')
         if nii.header['sform_code'] == 'scanner':
             nii.header['sform_code'] = 1
         elif nii.header['sform_code'] == 'talairach':
@@ -137,8 +444,13 @@ def LoadVolumetricData(filename, pn, file_type):
         elif nii.header['qform_code'] == 0:
             nii.header['qform_code'] = 0
 
-        img_out, header_out = ndot.nifti_4dfp(nii.header, volume, '4') # Convert nifti format header to 4dfp format
-        volume = np.flip(nii.dataobj,0)
+        _, header_out = ndot.nifti_4dfp(nii.header, None, '4') # Convert nifti format header to 4dfp format
+        # Slicing the proxy reads only the requested frames; unsliced, it maps the file if it can.
+        if frames is not None and len(nii.shape) > 3:
+            volume = nii.dataobj[:, :, :, frames]
+        else:
+            volume = np.asanyarray(nii.dataobj)
+        volume = np.flip(volume, 0)
         header_out['original_header'] = nii.header
 
         # Convert NIFTI header to NeuroDOT style info metadata
@@ -151,18 +463,20 @@ def LoadVolumetricData(filename, pn, file_type):
         header_out['nVy'] = header_out['matrix_size'][1]
         header_out['nVz'] = header_out['matrix_size'][2]
         header_out['nVt'] = header_out['matrix_size'][3]
+        if frames is not None and len(nii.shape) > 3:
+            header_out['nVt'] = np.shape(volume)[3] if np.ndim(volume) == 4 else 1
         header_out['mmx'] = abs(header_out['mmppix'][0])
         header_out['mmy'] = abs(header_out['mmppix'][1])
         header_out['mmz'] = abs(header_out['mmppix'][2])
 
-        orientation = header_out['orientation']
+        orientation = str(header_out['orientation'])
 
         if orientation == '2':
-            header['acq'] = 'transverse'
+            header_out['acq'] = 'transverse'
         elif orientation == '3':
-            header['acq'] = 'coronal'
+            header_out['acq'] = 'coronal'
         elif orientation == '4':
-            header['acq'] = 'sagittal'
+            header_out['acq'] = 'sagittal'
 
     return volume, header_out
 
@@ -333,7 +647,7 @@ def nifti_4dfp(header_in, img_in, mode):
                     sform[j,3] = (dim[i]-1)*sform[j,i] + sform[j,3]
                     sform[j,i] = -sform[j,i]
         orig_sform = sform
-        auto_orient_sform = np.zeros(3,4)
+        auto_orient_sform = np.zeros((3,4))
         # Re order axes to x, y, z, t
         for i in range(0,3):
             for j in range(0,3):
@@ -356,10 +670,10 @@ def nifti_4dfp(header_in, img_in, mode):
         # Create output Nifti-style header
         header_out = nb.Nifti1Header()
         header_out['dim'] = [4, 
-            dim[int(revorder[0])],
-            dim[int(revorder[1])], 
-            dim[int(revorder[2])],
-            dim[int(revorder[3])],0,0,0]
+            int(dim[int(revorder[0]), 0]),
+            int(dim[int(revorder[1]), 0]), 
+            int(dim[int(revorder[2]), 0]),
+            int(dim[int(revorder[3]), 0]),0,0,0]
         header_out['pixdim'] = [1.0,
             spacing[0],
             spacing[1], 
@@ -376,7 +690,7 @@ def nifti_4dfp(header_in, img_in, mode):
         header_out['qform_code'] = 3
         header_out['sizeof_hdr'] = 348
         header_out['aux_file'] = ''
-        header_out['descrip'] = header_in['filename'] + '.4dfp.ifh converted with nifti_4dfp'
+        header_out['descrip'] = str(header_in.get('filename', 'volume')) + '.4dfp.ifh converted with nifti_4dfp'
         header_out['vox_offset'] = 352
         NIFTI_UNITS_MM = 2
         NIFTI_UNITS_SEC = 8
@@ -384,6 +698,10 @@ def nifti_4dfp(header_in, img_in, mode):
         header_out['datatype'] = 16
         header_out['bitpix'] = 32
 
+        # Header only
+        if img_in is None:
+            return None, header_out
+
         ## Adjust Volume
         outmem = np.zeros(np.shape(img_in))
 
@@ -554,7 +872,7 @@ def nifti_4dfp(header_in, img_in, mode):
         # auto_orient_header
         orientation = orientation ^ (1 << int(revorder[0]))
         orientation = orientation ^ (1 << int(revorder[1]))
-        temp_sform = np.zeros(3,4)
+        temp_sform = np.zeros((3,4))
         orig_sform = sform
         for i in range(0,3):
             # Flip axes
@@ -584,7 +902,7 @@ def nifti_4dfp(header_in, img_in, mode):
         spacing[1] = -spacing[1] # we do this here to specify we want the flips to take place before the t4 transform is applied */
 
         # Initialize t4trans
-        t4trans = nm.repmat([0.0], 4,4) # 4dfp_format.c:453
+        t4trans = np.zeros((4,4)) # 4dfp_format.c:453
         t4trans[3,3] = 1.0 # 4dfp_format.c:456
         
         # First, invert sform to get t4
@@ -604,7 +922,7 @@ def nifti_4dfp(header_in, img_in, mode):
             temp = 1.0
 
         # Adjugate
-        t4trans = nm.repmat([0.0], 4,4) # Line 4dfp_format.c:453
+        t4trans = np.zeros((4,4)) # Line 4dfp_format.c:453
         t4trans[3,3] = 1.0 # 4dfp_format.c:456
         for i in range(0,3): # 4dfp_format.c:480-488
             a = (i+1) % 3
@@ -640,7 +958,7 @@ def nifti_4dfp(header_in, img_in, mode):
         header_out['matrix_size'] = [header_in['dim'][int(revorder[0])+1],
             header_in['dim'][int(revorder[1])+1],
             header_in['dim'][int(revorder[2])+1],
-            header_in['dim'][int(revorder[3])]+1]
+            header_in['dim'][int(revorder[3])+1]]
         header_out['acq'] = 'transverse'
         header_out['nDim'] = 4
         header_out['orientation'] = 2
@@ -648,6 +966,10 @@ def nifti_4dfp(header_in, img_in, mode):
         header_out['mmppix'] = [spacing[0], spacing[1], spacing[2]]
         header_out['center'] = [center[0], center[1], center[2]]
 
+        # Header only
+        if img_in is None:
+            return None, header_out
+
         ## Adjust Volume
         outmem = np.zeros(np.shape(img_in))
 
@@ -698,7 +1020,6 @@ def Read_4dfp_Header(filename, pn):
     header_ifh = {}
     header  ={}
     ## Open file.
-    fid = open(filename, 'rb')
     path = Path(pn + filename)
     assert path.exists()
     ## Read text.    
@@ -787,7 +1108,122 @@ def Read_4dfp_Header(filename, pn):
     return header
 
 
-def SaveVolumetricData(volume, header, filename, pn, file_type):
+class VolumeWriter:
+    """
+    VOLUMEWRITER Writes a 4dfp or NIfTI volume one frame (or block of frames) at a time.
+
+    w = VOLUMEWRITER(header, filename, pn, file_type) opens the 4dfp
+    ('4dfp') or NIfTI ('nii' or 'nifti') file "filename" in the folder
+    "pn" for the X x Y x Z space of "header" (as given by
+    LOADVOLUMETRICDATA), and writes a provisional header. Each
+    w.write(block) appends an X x Y x Z frame or an X x Y x Z x T block
+    of frames (an array or a VOXELVOLUME), reoriented as in
+    SAVEVOLUMETRICDATA one block at a time. w.close() sets the number of
+    frames written in the header. A VOLUMEWRITER can also be used in a
+    "with" statement, which closes it.
+
+    Only the block being written is held in memory, so volumes produced
+    chunk by chunk (e.g., by a chunked reconstruction) never need to be
+    assembled in full. Frames are written as float32.
+
+    Fields and methods:
+        :nVt:          Frames written so far.
+        :write(block): Appends one frame or a block of frames.
+        :close():      Finalizes the header and closes the file.
+
+    See Also: SAVEVOLUMETRICDATA, LOADVOLUMETRICDATA.
+    """
+
+    def __init__(self, header, filename, pn = '', file_type = '4dfp'):
+        if pn is None:
+            pn = ''
+        self.header = dict(header)
+        self.file_type = file_type.lower()
+        self.nV = (int(header['nVx']), int(header['nVy']), int(header['nVz']))
+        self.nVt = 0
+        self._filename = filename
+        self._pn = pn
+        if self.file_type == '4dfp':
+            self._dtype = np.dtype(('>' if self.header.get('byte', 'l') == 'b' else '<') + 'f4')
+            self._fp = open(os.path.join(pn, filename + '.4dfp.img'), 'wb')
+            self._write_header()
+        elif self.file_type in ('nii', 'nifti'):
+            if 'original_header' in self.header:
+                hdr = nb.Nifti1Header.from_header(self.header['original_header'])
+            else:
+                hdr = nb.Nifti1Header.from_header(ndot.nifti_4dfp(dict(self.header), None, 'n')[1])
+            hdr.set_data_dtype(np.float32)
+            hdr.set_slope_inter(1.0, 0.0)
+            self._hdr = hdr
+            name = filename if filename.endswith('.nii') else filename + '.nii'
+            self._fp = open(os.path.join(pn, name), 'wb')
+            self._write_header()
+            self._dtype = hdr.get_data_dtype()
+        else:
+            raise ValueError('Error: unsupported file type ' + file_type + '.')
+
+    def _write_header(self):
+        if self.file_type == '4dfp':
+            self.header['nVt'] = self.nVt
+            self.header['nDim'] = 4
+            ndot.Write_4dfp_Header(self.header, self._filename + '.4dfp', self._pn)
+            return
+        pos = self._fp.tell()
+        self._hdr.set_data_shape(self.nV + (max(self.nVt, 1),))
+        self._fp.seek(0)
+        self._hdr.write_to(self._fp)
+        offset = max(int(self._hdr['vox_offset']), self._fp.tell())
+        if offset != int(self._hdr['vox_offset']):
+            self._hdr['vox_offset'] = offset
+            self._fp.seek(0)
+            self._hdr.write_to(self._fp)
+        self._fp.write(bytes(offset - self._fp.tell()))
+        self._fp.seek(max(pos, offset))
+
+    def write(self, block):
+        if isinstance(block, ndot.VoxelVolume):
+            block = block.toarray()
+        block = np.asanyarray(block)
+        if block.ndim == 3:
+            block = block[..., None]
+        if np.shape(block)[0:3] != self.nV:
+            raise ValueError('Error: frames do not match the volume size in the header.')
+
+        ## Orientation, applied to this block only (views).
+        if self.file_type == '4dfp':
+            acq = self.header.get('acq', 'transverse')
+            if acq == 'transverse':
+                block = np.flip(block, 1)
+            elif acq == 'coronal':
+                block = np.flip(np.flip(block, 1), 2)
+            elif acq == 'sagittal':
+                block = np.flip(np.flip(np.flip(block, 0), 1), 2)
+        else:
+            block = np.flip(block, 0) # Convert back from LAS to RAS for NIFTI.
+
+        # Each frame is stored x fastest
+        for t in range(0, np.shape(block)[3]):
+            self._fp.write(np.ravel(block[:, :, :, t], order = 'F').astype(self._dtype, copy = False).tobytes())
+        self.nVt = self.nVt + np.shape(block)[3]
+
+    def close(self):
+        if self._fp.closed:
+            return
+        if self.file_type == '4dfp':
+            self._fp.close()
+            self._write_header()
+        else:
+            self._write_header()
+            self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def SaveVolumetricData(volume, header, filename, pn, file_type, chunk = 16):
     '''
     SAVEVOLUMETRICDATA Saves a volumetric data file.
 
@@ -801,71 +1237,83 @@ def SaveVolumetricData(volume, header, filename, pn, file_type):
 
         - Supported File Types/Extensions: '.4dfp' 4dfp, '.nii' NIFTI.
 
+    The volume is written through a VOLUMEWRITER, "chunk" frames at a
+    time. "volume" may also be a VOXELVOLUME, which is densified one
+    chunk at a time.
+
     Dependencies: WRITE_4DFP_HEADER, NIFTI_4DFP.
 
-    See Also: LOADVOLUMETRICDATA, MAKE_NATIVESPACE_4DFP.
+    See Also: LOADVOLUMETRICDATA, MAKE_NATIVESPACE_4DFP, VOLUMEWRITER.
     '''
+    nVt = np.shape(volume)[3] if len(np.shape(volume)) > 3 else 1
+    if file_type.lower() == '4dfp' and int(header['nVt']) != nVt:
+        print('Warning: Stated header 4th dimension size ' + 
+        str(header['nVt']) + ' does not equal the size of the volume ' +
+        str(nVt) + '. Updating header info.')
+
+    with VolumeWriter(header, filename, pn, file_type) as w:
+        if len(np.shape(volume)) == 3:
+            w.write(volume)
+        else:
+            for t0 in range(0, nVt, chunk):
+                w.write(volume[:, :, :, t0:t0 + chunk])
+    header['nVt'] = nVt
+            
 
-    if file_type.lower() == '4dfp':
-        if header['nVt']!=np.size(volume,3):
-            print('Warning: Stated header 4th dimension size ' + 
-            str(header['nVt']) + ' does not equal the size of the volume ' +
-            str(np.size(volume,3)) + '. Updating header info.')
-            header['nVt']=np.size(volume,3)
+def _h5_indexed(group, name):
+    # Subgroups "name", "name1", "name2", ... of an HDF5 group, in index order.
+    found = []
+    for key in group.keys():
+        if key.startswith(name) and (key[len(name):] == '' or key[len(name):].isdigit()):
+            found.append((int(key[len(name):] or 0), key))
+    return [group[key] for _, key in sorted(found)]
 
-        ## Write 4dfp header.
-        if header['acq'] == 'transverse':
-            volume = np.flip(volume,1)
-        elif header['acq'] == 'coronal':
-            volume = np.flip(volume, 1)
-            volume = np.flip(volume, 2)
-        elif header['acq'] == 'sagittal':
-            volume = np.flip(volume, 0)
-            volume = np.flip(volume, 1)
-            volume = np.flip(volume, 2)
-                
-        ndot.Write_4dfp_Header(header, pn + filename)
-    
-        ## Write 4dfp image file.
-        volume = np.squeeze(np.reshape(volume, header['nVx'] * header['nVy'] * header['nVz'] * header['nVt'], 1))
-        # Write .img file
-        imgfname = filename + '.4dfp.img'
-        with open(filename + '.4dfp.img','wb') as fp:
-            np.array(volume.shape).tofile(fp)
-            volume.T.tofile(fp)
-
-    elif np.logical_or(file_type.lower() == 'nifti', file_type.lower() == 'nii'):
-        volume = np.flip(volume, 0) # Convert back from LAS to RAS for NIFTI.      
-        
-        if 'original_header' in header: # if header was loaded as nii, and you are saving it as nifti again
-            nii = header['original_header']
-            # Required fields
-            if 'Description' in nii:
-                if len(nii['Description']) > 80:    
-                    nii['Description'] = 'Converted with NeuroDOT nifti_4dfp'
-            affine=[nii['srow_x'],nii['srow_y'], nii['srow_z'],[0,0,0,1]]
-            nifti_image = nb.Nifti1Image(volume, affine, nii)
-            nb.save(nifti_image, pn + '/' + filename) 
 
-            
-        else: # Build nii header from information in NeuroDOT 4dfp header
-            new_vol, nifti_header = ndot.nifti_4dfp(header,volume, 'n')
-            affine=[nifti_header['srow_x'],nifti_header['srow_y'], nifti_header['srow_z'],[0,0,0,1]]
-            nifti_image = nb.Nifti1Image(new_vol, affine , nifti_header)
-            nb.save(nifti_image, pn + '/' + filename+'.nii') 
-            
+def _h5_str(value):
+    # HDF5 string scalars are read back as bytes.
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _snirf_measlist(dgrp):
+    # Measurement list columns of a SNIRF data group, read in bulk.
+    fields = ('sourceIndex', 'detectorIndex', 'wavelengthIndex', 'wavelengthActual')
+    ml = dict()
+    if 'measurementLists' in dgrp:
+        for key in fields:
+            if key in dgrp['measurementLists']:
+                ml[key] = np.asarray(dgrp['measurementLists'][key][()]).ravel()
+    else:
+        groups = _h5_indexed(dgrp, 'measurementList')
+        for key in fields:
+            if len(groups) > 0 and key in groups[0]:
+                ml[key] = np.array([g[key][()] for g in groups]).ravel()
+    return ml
+
 
-def snirf2ndot(filename, pn, save_file =0, output = None, dtype = []):
+def snirf2ndot(filename, pn, save_file =0, output = None, dtype = [], t_start = None, t_stop = None, channels = None, lazy = False):
     '''
     SNIRF2NDOT takes a file with the 'snirf' extension in the SNIRF format and converts it to NeuroDOT formatting.
 
-    This function depends on the "Snirf" class from pysnirf2.
+    This function depends on the "Snirf" class from pysnirf2 for the
+    metadata. The measurement list and the time series are read directly
+    from the HDF5 file, and only the requested window and channels of
+    "dataTimeSeries" are fetched.
 
     Inputs:
         :Filename: the name of the file to be converted, followed by the .snirf extension.
         :Save_file: flag which determines whether the data will be saved to a 'mat' file in NeuroDOT format. (default = 1) 
         :Output: the filename (without extension) of the .mat file to be saved.
         :Type: optional - the only currently acceptable value is "snirf"
+        :t_start: optional - first time (s) to read. (default: start of the recording)
+        :t_stop: optional - time (s) at which to stop reading; samples
+            at or after t_stop are excluded. (default: end of the recording)
+        :channels: optional - measurements to read, as 0-based indices or a
+            boolean mask into the NeuroDOT-ordered measurement list
+            (by wavelength, then detector). (default: all)
+        :lazy: optional - if True, "data" is returned as a LAZYMEASDATA
+            view of the file, read only when indexed. The file then stays
+            open until data.close() is called (or the "with data:" block
+            ends). (default: False)
     Outputs:
         :data: NeuroDOT formatted data (# of channels x # of samples)
         :info: NeuroDOT formatted metadata "info"
@@ -880,227 +1328,229 @@ def snirf2ndot(filename, pn, save_file =0, output = None, dtype = []):
     if save_file is None:
         save_file = 0
     fn = pn + filename
-    snf = snirf.Snirf(fn, 'r')
-    info = dict()
-    custom_io = ['Nd', 'Ns','Nwl','comment','enc', 'framesize', 'naux','nblank','nframe',
-                'nmotu','nsamp','nts','pad','run','tag','Nt','PadName']
-    if snf['original_header']:
-        info['original_header'] = snf.original_header
-
-    if snf.nirs[0].data[0]:
-        info['system'] = dict()
-        data = np.transpose(snf.nirs[0].data[0].dataTimeSeries)
-        if hasattr(snf.nirs[0].data[0],'time'):
-            info['system']['framerate'] = 1/np.mean(np.diff(snf.nirs[0].data[0].time))
-            info['system']['init_framerate'] = info['system']['framerate']
-        if snf.nirs[0].metaDataTags.TimeUnit == 'ms':
-            info['system']['framerate'] = info['system']['framerate']*1e3
-            info['system']['init_framerate'] = info['system']['framerate']*1e3
-    info['io'] = dict()
-    if 'original_header' in snf:
-        info['original_header'] = snf.original_header
-        if 'io' in snf.original_header:
-            if 'a' in snf.original_header.io:
-                info['io']['a'] = snf.original_header.io.a
-                info['io']['b'] = snf.original_header.io.b
-            else:
-                info['io'] = snf.original_header.io
-
-    if snf:
-        if snf['original_header']:
-            if snf.original_header.io:
-                if snf.original_header.io.a:
-                    info['io']['a'] = snf.original_header.io.a
-                    info['io']['b'] = snf.original_header.io.b
-                else:
-                    info['io'] = snf.original_header.io     
-        else:
-            if snf.nirs[0].metaDataTags:
-                if not ('io' in info):
-                    info['io'] = dict()
-                info['misc'] = dict()
-                info['misc']['metaDataTags'] = snf.nirs[0].metaDataTags
-                info['misc']['time'] = snf.nirs[0].data[0].time
-                if hasattr(snf.nirs[0].metaDataTags,'framerate'):
-                    info['system']['framerate'] = snf.nirs[0].metaDataTags.framerate
-                    info['system']['init_framerate'] = info['system']['framerate']
-                if hasattr(snf.nirs[0].metaDataTags,'Nd'):
-                    info['io']['Nd'] = snf.nirs[0].metaDataTags.Nd
-                else:
-                    info['io']['Nd'] = len(snf.nirs[0].probe.detectorPos3D)
-
-                if hasattr(snf.nirs[0].metaDataTags,'Ns'):
-                    info['io']['Ns'] = snf.nirs[0].metaDataTags.Ns
+    if not fn.endswith('.snirf'):
+        fn = fn + '.snirf'
+    # "h5" stays open for a lazy read (it backs the returned LAZYMEASDATA)
+    h5 = h5py.File(fn, 'r')
+    try:
+        with snirf.Snirf(fn, 'r', dynamic_loading = True) as snf:
+            dgrp = _h5_indexed(_h5_indexed(h5, 'nirs')[0], 'data')[0]
+            info = dict()
+            custom_io = ['Nd', 'Ns','Nwl','comment','enc', 'framesize', 'naux','nblank','nframe',
+                        'nmotu','nsamp','nts','pad','run','tag','Nt','PadName']
+            if snf['original_header']:
+                info['original_header'] = snf.original_header
+
+            ## Time base and read window (in seconds).
+            series = dgrp['dataTimeSeries']
+            if series.ndim == 1:
+                series = np.reshape(series[()], (-1, 1))
+            Nt = np.shape(series)[0]
+            timeFull = np.asarray(dgrp['time'][()], dtype = np.float64).ravel()
+            if len(timeFull) == 2 and Nt != 2: # [start, step] time specification
+                timeFull = timeFull[0] + np.arange(0, Nt) * timeFull[1]
+            if snf.nirs[0].metaDataTags.TimeUnit == 'ms':
+                timeFull = timeFull * 1e-3
+            t0 = -np.inf if t_start is None else t_start
+            t1 = np.inf if t_stop is None else t_stop
+            window = np.flatnonzero((timeFull >= t0) & (timeFull < t1))
+            if len(window) == 0:
+                raise ValueError('Error: no samples between t_start and t_stop.')
+            cols = np.arange(window[0], window[-1] + 1)
+            timeArray = timeFull[cols]
+
+            info['system'] = dict()
+            if Nt > 1:
+                info['system']['framerate'] = 1/np.mean(np.diff(timeFull))
+                info['system']['init_framerate'] = info['system']['framerate']
+            info['io'] = dict()
+            if 'original_header' in snf:
+                info['original_header'] = snf.original_header
+                if 'io' in snf.original_header:
+                    if 'a' in snf.original_header.io:
+                        info['io']['a'] = snf.original_header.io.a
+                        info['io']['b'] = snf.original_header.io.b
+                    else:
+                        info['io'] = snf.original_header.io
+
+            if snf:
+                if snf['original_header']:
+                    if snf.original_header.io:
+                        if snf.original_header.io.a:
+                            info['io']['a'] = snf.original_header.io.a
+                            info['io']['b'] = snf.original_header.io.b
+                        else:
+                            info['io'] = snf.original_header.io     
                 else:
-                    info['io']['Ns'] = len(snf.nirs[0].probe.sourcePos3D)
-
-                if hasattr(snf.nirs[0].metaDataTags,'MeasurementDate'):
-                    info['io']['date'] = str(snf.nirs[0].metaDataTags.MeasurementDate)  # this might need to have join() because in Matlab the measurement date was a character array
-                if hasattr(snf.nirs[0].metaDataTags, 'MeasurementTime'):
-                    info['io']['time'] = str(snf.nirs[0].metaDataTags.MeasurementTime) # this might need to have join() because in Matlab the measurement date was a character array
-                if hasattr(snf.nirs[0].metaDataTags, 'UnixTime'):
-                    info['io']['unix_time'] = snf.nirs[0].metaDataTags.UnixTime
-                if hasattr(snf.nirs[0].metaDataTags,'Nwl'):
-                    info['io']['Nwl'] = snf.nirs[0].metaDataTags.Nwl
-                else:
-                    info['io']['Nwl'] = len(snf.nirs[0].probe.wavelengths)
-                if hasattr(snf.nirs[0].metaDataTags,'comment'):
-                    info['io']['comment'] = snf.nirs[0].metaDataTags.comment
-                if hasattr(snf.nirs[0].metaDataTags,'enc'):
-                    info['io']['enc'] = snf.nirs[0].metaDataTags.enc
-                if hasattr(snf.nirs[0].metaDataTags,'framesize'):
-                    info['io']['framesize'] = snf.nirs[0].metaDataTags.framesize
-                if hasattr(snf.nirs[0].metaDataTags,'naux'):
-                    info['io']['naux'] = snf.nirs[0].metaDataTags.naux
-
-    if snf.nirs[0].probe:
-        info['optodes'] = dict()
-        if 'CapName' in snf.nirs[0].metaDataTags:
-            info['optodes']['CapName'] = snf.nirs[0].metaDataTags.CapName
-        if 'detectorPos2D' in snf.nirs[0].probe:
-            info['optodes']['dpos2'] = snf.nirs[0].probe.detectorPos2D
-        if 'detectorPos3D' in snf.nirs[0].probe:
-            info['optodes']['dpos3'] = snf.nirs[0].probe.detectorPos3D
-        if 'sourcePos2D' in snf.nirs[0].probe:
-            info['optodes']['spos2'] = snf.nirs[0].probe.sourcePos2D
-        if 'sourcePos3D' in snf.nirs[0].probe:
-            info['optodes']['spos3'] = snf.nirs[0].probe.sourcePos3D
-            
-    if snf.nirs[0].data[0].measurementList:  
-        info['pairs'] = dict()
-        info['pairs']['Src'] = np.zeros(len(snf.nirs[0].data[0].measurementList[:]))
-        info['pairs']['Det'] = np.zeros(len(snf.nirs[0].data[0].measurementList[:]))
-        info['pairs']['WL'] = np.zeros(len(snf.nirs[0].data[0].measurementList[:]))
-        info['pairs']['lambda'] = np.zeros(len(snf.nirs[0].data[0].measurementList[:]))     
-        for j in range(0, len(snf.nirs[0].data[0].measurementList[:])):
-            if hasattr(snf.nirs[0].data[0].measurementList[0], 'sourceIndex'):
-                info['pairs']['Src'][j] = snf.nirs[0].data[0].measurementList[j].sourceIndex
-            if hasattr(snf.nirs[0].data[0].measurementList[0], 'detectorIndex'):
-                info['pairs']['Det'][j] = snf.nirs[0].data[0].measurementList[j].detectorIndex
-            if hasattr(snf.nirs[0].data[0].measurementList[0], 'wavelengthActual'):
-                info['pairs']['lambda'][j] = snf.nirs[0].data[0].measurementList[j].wavelengthActual
-            if hasattr(snf.nirs[0].data[0].measurementList[0],'wavelengthIndex'):
-                info['pairs']['WL'][j] = snf.nirs[0].data[0].measurementList[j].wavelengthIndex
-        if not hasattr(snf.nirs[0].data[0].measurementList[0],'wavelengthActual'):
-            info['pairs']['lambda'] = list()
-            if 'wavelengths' in snf.nirs[0].probe:
-                wavelengths = snf.nirs[0].probe.wavelengths
-            for k in range(1, len(wavelengths)+1):
-                info['pairs']['lambda'][np.where(info['pairs']['WL'] == k)[1]] = wavelengths[k]                 
-            if np.size(info['pairs']['lambda'],1) > 1:
-                info['pairs']['lambda'] = np.transpose(info['pairs']['lambda'])
-                
-        gridTemp = dict()
-        if not hasattr(snf, 'original_header'):
-            gridTemp['spos3']=snf.nirs[0].probe.sourcePos3D
-            gridTemp['dpos3']=snf.nirs[0].probe.detectorPos3D
-            #Enforce that arrays are column-wise
-            if np.size(gridTemp['spos3'],1) > np.size(gridTemp['spos3'],0):
-                gridTemp['spos3'] = np.transpose(gridTemp['spos3'])
-                gridTemp['dpos3'] = np.transpose(gridTemp['dpos3'])
+                    if snf.nirs[0].metaDataTags:
+                        if not ('io' in info):
+                            info['io'] = dict()
+                        info['misc'] = dict()
+                        # Plain copy of the tags ("snf" is closed before returning)
+                        tags = _h5_indexed(h5, 'nirs')[0]['metaDataTags']
+                        info['misc']['metaDataTags'] = {k: _h5_str(tags[k][()]) if tags[k].dtype.kind in 'SOU' else tags[k][()] for k in tags}
+                        info['misc']['time'] = snf.nirs[0].data[0].time
+                        if hasattr(snf.nirs[0].metaDataTags,'framerate'):
+                            info['system']['framerate'] = snf.nirs[0].metaDataTags.framerate
+                            info['system']['init_framerate'] = info['system']['framerate']
+                        if hasattr(snf.nirs[0].metaDataTags,'Nd'):
+                            info['io']['Nd'] = snf.nirs[0].metaDataTags.Nd
+                        else:
+                            info['io']['Nd'] = len(snf.nirs[0].probe.detectorPos3D)
+
+                        if hasattr(snf.nirs[0].metaDataTags,'Ns'):
+                            info['io']['Ns'] = snf.nirs[0].metaDataTags.Ns
+                        else:
+                            info['io']['Ns'] = len(snf.nirs[0].probe.sourcePos3D)
+
+                        if hasattr(snf.nirs[0].metaDataTags,'MeasurementDate'):
+                            info['io']['date'] = str(snf.nirs[0].metaDataTags.MeasurementDate)  # this might need to have join() because in Matlab the measurement date was a character array
+                        if hasattr(snf.nirs[0].metaDataTags, 'MeasurementTime'):
+                            info['io']['time'] = str(snf.nirs[0].metaDataTags.MeasurementTime) # this might need to have join() because in Matlab the measurement date was a character array
+                        if hasattr(snf.nirs[0].metaDataTags, 'UnixTime'):
+                            info['io']['unix_time'] = snf.nirs[0].metaDataTags.UnixTime
+                        if hasattr(snf.nirs[0].metaDataTags,'Nwl'):
+                            info['io']['Nwl'] = snf.nirs[0].metaDataTags.Nwl
+                        else:
+                            info['io']['Nwl'] = len(snf.nirs[0].probe.wavelengths)
+                        if hasattr(snf.nirs[0].metaDataTags,'comment'):
+                            info['io']['comment'] = snf.nirs[0].metaDataTags.comment
+                        if hasattr(snf.nirs[0].metaDataTags,'enc'):
+                            info['io']['enc'] = snf.nirs[0].metaDataTags.enc
+                        if hasattr(snf.nirs[0].metaDataTags,'framesize'):
+                            info['io']['framesize'] = snf.nirs[0].metaDataTags.framesize
+                        if hasattr(snf.nirs[0].metaDataTags,'naux'):
+                            info['io']['naux'] = snf.nirs[0].metaDataTags.naux
+
+            if snf.nirs[0].probe:
+                info['optodes'] = dict()
+                if 'CapName' in snf.nirs[0].metaDataTags:
+                    info['optodes']['CapName'] = snf.nirs[0].metaDataTags.CapName
+                if 'detectorPos2D' in snf.nirs[0].probe:
+                    info['optodes']['dpos2'] = snf.nirs[0].probe.detectorPos2D
+                if 'detectorPos3D' in snf.nirs[0].probe:
+                    info['optodes']['dpos3'] = snf.nirs[0].probe.detectorPos3D
+                if 'sourcePos2D' in snf.nirs[0].probe:
+                    info['optodes']['spos2'] = snf.nirs[0].probe.sourcePos2D
+                if 'sourcePos3D' in snf.nirs[0].probe:
+                    info['optodes']['spos3'] = snf.nirs[0].probe.sourcePos3D
             
-            if hasattr(snf.nirs[0].probe, 'sourcePos2D') and hasattr(snf.nirs[0].probe,'detectorPos2D'):
-                if  not (snf.nirs[0].probe.sourcePos2D is None):
-                    if snf.nirs[0].probe.sourcePos2D.all() != None and snf.nirs[0].probe.detectorPos2D.all() != None:
-                        gridTemp['spos2']=snf.nirs[0].probe.sourcePos2D
-                        gridTemp['dpos2']=snf.nirs[0].probe.detectorPos2D
-                    #Enforce that arrays are column-wise
-                        if np.size(gridTemp['spos3'],1) > np.size(gridTemp['spos3'],0):
-                            gridTemp['spos2'] = np.transpose(gridTemp['spos2'])
-                            gridTemp['dpos2'] = np.transpose(gridTemp['dpos2'])
-            params = dict()
-            params['lambda']= snf.nirs[0].probe.wavelengths
-            tempInfo=ndot.Generate_pad_from_grid(gridTemp,params, info)          
-            data_measList = np.array(np.c_[info['pairs']['Src'],info['pairs']['Det'],info['pairs']['WL']])
-            full_measList =np.array(np.c_[tempInfo['pairs']['Src'],tempInfo['pairs']['Det'],tempInfo['pairs']['WL']])
-            idxmeaslist = [np.where((full_measList == data_meas).all(axis=1))[0] for data_meas in data_measList]
-            info['pairs']['Mod'] = tempInfo['pairs']['Mod'][idxmeaslist,:]
-            info['pairs']['r3d']=tempInfo['pairs']['r3d'][idxmeaslist]
-            info['pairs']['r2d'] = tempInfo['pairs']['r2d'][idxmeaslist]
-            info['pairs']['NN'] = tempInfo['pairs']['NN'][idxmeaslist]
-            info['pairs']['lambda'] = tempInfo['pairs']['lambda'][idxmeaslist]
+
+            ## Measurement list, read in bulk.
+            ml = _snirf_measlist(dgrp)
+            Nm = np.shape(series)[1]
+            info['pairs'] = dict()
+            info['pairs']['Src'] = np.asarray(ml.get('sourceIndex', np.zeros(Nm)), dtype = np.float64)
+            info['pairs']['Det'] = np.asarray(ml.get('detectorIndex', np.zeros(Nm)), dtype = np.float64)
+            info['pairs']['WL'] = np.asarray(ml.get('wavelengthIndex', np.zeros(Nm)), dtype = np.float64)
+            wavelengths = np.asarray(snf.nirs[0].probe.wavelengths, dtype = np.float64).ravel()
+            if 'wavelengthActual' in ml:
+                info['pairs']['lambda'] = np.asarray(ml['wavelengthActual'], dtype = np.float64)
+            else:
+                info['pairs']['lambda'] = wavelengths[info['pairs']['WL'].astype(int) - 1]
+
+            gridTemp = dict()
+            if not hasattr(snf, 'original_header'):
+                gridTemp['spos3']=snf.nirs[0].probe.sourcePos3D
+                gridTemp['dpos3']=snf.nirs[0].probe.detectorPos3D
+                #Enforce that arrays are column-wise
+                if np.size(gridTemp['spos3'],1) > np.size(gridTemp['spos3'],0):
+                    gridTemp['spos3'] = np.transpose(gridTemp['spos3'])
+                    gridTemp['dpos3'] = np.transpose(gridTemp['dpos3'])
         
-            avg_r3d = np.mean(info['pairs']['r3d'])
-            if (avg_r3d >=1) & (avg_r3d <=10):# Changed max_log to min_log 2/1/23
-                mult = 10
-            elif (avg_r3d >=0.1) & (avg_r3d <=1):
-                mult = 100
-            elif (avg_r3d >=0) & (avg_r3d <=0.1):
-                mult = 1000
+                if hasattr(snf.nirs[0].probe, 'sourcePos2D') and hasattr(snf.nirs[0].probe,'detectorPos2D'):
+                    if  not (snf.nirs[0].probe.sourcePos2D is None):
+                        if snf.nirs[0].probe.sourcePos2D.all() != None and snf.nirs[0].probe.detectorPos2D.all() != None:
+                            gridTemp['spos2']=snf.nirs[0].probe.sourcePos2D
+                            gridTemp['dpos2']=snf.nirs[0].probe.detectorPos2D
+                        #Enforce that arrays are column-wise
+                            if np.size(gridTemp['spos3'],1) > np.size(gridTemp['spos3'],0):
+                                gridTemp['spos2'] = np.transpose(gridTemp['spos2'])
+                                gridTemp['dpos2'] = np.transpose(gridTemp['dpos2'])
+                params = dict()
+                params['lambda']= wavelengths
+                tempInfo=ndot.Generate_pad_from_grid(gridTemp,params, info)
+                # Pad rows are ordered by wavelength, then detector, then source
+                Ns = np.shape(gridTemp['spos3'])[0]
+                Nd = np.shape(gridTemp['dpos3'])[0]
+                idxmeaslist = ((info['pairs']['WL'] - 1) * Nd * Ns + (info['pairs']['Det'] - 1) * Ns + info['pairs']['Src'] - 1).astype(np.int64)
+                info['pairs']['Mod'] = tempInfo['pairs']['Mod'][idxmeaslist,:]
+                info['pairs']['r3d']=tempInfo['pairs']['r3d'][idxmeaslist]
+                info['pairs']['r2d'] = tempInfo['pairs']['r2d'][idxmeaslist]
+                info['pairs']['NN'] = tempInfo['pairs']['NN'][idxmeaslist]
+                info['pairs']['lambda'] = tempInfo['pairs']['lambda'][idxmeaslist]
+    
+                avg_r3d = np.mean(info['pairs']['r3d'])
+                if (avg_r3d >=1) & (avg_r3d <=10):# Changed max_log to min_log 2/1/23
+                    mult = 10
+                elif (avg_r3d >=0.1) & (avg_r3d <=1):
+                    mult = 100
+                elif (avg_r3d >=0) & (avg_r3d <=0.1):
+                    mult = 1000
+                else:
+                    mult = 1
+                info['optodes']['spos3'] =np.multiply(gridTemp['spos3'],mult)
+                info['optodes']['dpos3'] = np.multiply(gridTemp['dpos3'],mult)
+                info['pairs']['r3d'] = np.multiply(info['pairs']['r3d'],mult)
+                info['pairs']['r2d'] = np.multiply(info['pairs']['r2d'],mult)
+
+            if hasattr(snf, 'original_header'): 
+                info['paradigm'] = snf.original_header.paradigm
             else:
-                mult = 1
-            info['optodes']['spos3'] =np.multiply(gridTemp['spos3'],mult)
-            info['optodes']['dpos3'] = np.multiply(gridTemp['dpos3'],mult)
-            info['pairs']['r3d'] = np.multiply(info['pairs']['r3d'],mult)
-            info['pairs']['r2d'] = np.multiply(info['pairs']['r2d'],mult)
-
-        if hasattr(snf, 'original_header'): 
-            info['paradigm'] = snf.original_header.paradigm
-        else:
-            if len(snf.nirs[0].data[0].time) == 2 :# Create Time array if one is not provided
-                T = 1/info['system']['framerate']
-                nTp = np.shape(snf.nirs[0].data[0].dataTimeSeries)[0]
-                timeArray = np.array(range(0, nTp-1)*T)
+                info['misc']['time'] = timeArray
+                stims = _h5_indexed(_h5_indexed(h5, 'nirs')[0], 'stim')
+                if len(stims) > 0:
+                    Npulses = len(stims)
+                    stimData = [np.reshape(np.asarray(g['data'][()], dtype = np.float64), (-1, np.shape(g['data'])[-1])) for g in stims]
+                    Total_synchs = np.concatenate([d[:, 0] for d in stimData])
+                    if snf.nirs[0].metaDataTags.TimeUnit == 'ms':
+                        Total_synchs = Total_synchs * 1e-3
+                    Total_synchtypes = np.concatenate([np.tile([i+1], len(d)) for i, d in enumerate(stimData)]).astype(np.float64)
+                    # Keep the events inside the read window
+                    keep = (Total_synchs >= timeArray[0]) & (Total_synchs <= timeArray[-1])
+                    Total_synchs = Total_synchs[keep]
+                    Total_synchtypes = Total_synchtypes[keep]
+                    info['paradigm'] = dict()
+                    sortedIdx = np.argsort(Total_synchs, kind = 'stable')
+                    info['paradigm']['synchtimes'] = Total_synchs[sortedIdx]
+                    info['paradigm']['synchtype'] = Total_synchtypes[sortedIdx]
+                    info['misc']['stimDuration'] = np.array([d[0, 1] if np.size(d) > 0 and np.shape(d)[1] > 1 else 0 for d in stimData])
+                    for j in range(0,Npulses):
+                        label = 'Pulse_'+ str(j + 1)
+                        info['paradigm'][label] = np.array(np.where(info['paradigm']['synchtype'] == j + 1)) + 1
+                        info['paradigm'][label] = np.transpose(info['paradigm'][label])
+                    # Nearest sample of each event (0-based, first sample on ties)
+                    st = info['paradigm']['synchtimes']
+                    if len(timeArray) > 1:
+                        k = np.clip(np.searchsorted(timeArray, st), 1, len(timeArray) - 1)
+                        info['paradigm']['synchpts'] = (k - ((st - timeArray[k - 1]) <= (timeArray[k] - st))).astype(np.float64)
+                    else:
+                        info['paradigm']['synchpts'] = np.zeros(np.shape(st))
+                    info['paradigm']['init_synchpts'] = info['paradigm']['synchpts']   
+    
+            if not hasattr(snf.nirs[0].metaDataTags, 'SubjectID'):
+                info['misc']['subject_id'] = 'default' #required snirf field
             else:
-                timeArray = np.array(snf.nirs[0].data[0].time)
-            if hasattr(snf.nirs[0], 'stim'):
-                Total_synchs = []
-                Total_synchtypes = []
-                Npulses = len(snf.nirs[0].stim)
-                for i in range(0, Npulses):
-                    Total_synchs =  np.append(Total_synchs,snf.nirs[0].stim[i].data[:,0])
-                    Total_synchtypes =  np.append(Total_synchtypes,np.tile([i+1], len(snf.nirs[0].stim[i].data)))
-                info['paradigm'] = dict()
-                info['paradigm']['synchtimes'] = np.sort(Total_synchs)
-                sortedIdx = np.argsort(Total_synchs)
-                info['paradigm']['synchtype'] = Total_synchtypes[sortedIdx]
-                pulsenum = 0
-                for j in range(0,Npulses):
-                    pulsenum = pulsenum +1
-                    info['misc']['stimDuration']  =np.zeros(len(snf.nirs[0].stim[j].data[:,1]))
-                    info['misc']['stimDuration'][j] = snf.nirs[0].stim[j].data[0,1]
-                    label = 'Pulse_'+ str(pulsenum)
-                    info['paradigm'][label] = np.array(np.where(info['paradigm']['synchtype'] == pulsenum)) + 1
-                    info['paradigm'][label] = np.transpose(info['paradigm'][label])
-                info['paradigm']['synchpts'] = np.zeros((np.shape(info['paradigm']['synchtimes'])))    
-                for j in range(0,len(info['paradigm']['synchtimes'])):
-                    info['paradigm']['synchpts'][j] = np.argmin(abs((np.array(timeArray)- info['paradigm']['synchtimes'][j])))
-                info['paradigm']['init_synchpts'] = info['paradigm']['synchpts']   
-        
-        if not hasattr(snf.nirs[0].metaDataTags, 'SubjectID'):
-            info['misc']['subject_id'] = 'default' #required snirf field
-        else:
-            info['misc']['subject_id'] = snf.nirs[0].metaDataTags.SubjectID
+                info['misc']['subject_id'] = snf.nirs[0].metaDataTags.SubjectID
 
     
-    # Order info.pairs and data by wavelength, then by detector
-    if np.shape(info['pairs']['Src'])[0]> 1:
-        info['pairs']['Src'] = np.transpose(info['pairs']['Src'])
-    if np.shape(info['pairs']['Det'])[0] > 1:
-        info['pairs']['Det'] = np.transpose(info['pairs']['Det'])
-    if np.shape( info['pairs']['WL'])[0] > 1:
-        info['pairs']['WL'] = np.transpose(info['pairs']['WL'])
-    info['pairs']['Src'] = np.reshape(info['pairs']['Src'],(len(info['pairs']['Src']),1))
-    info['pairs']['Det'] = np.reshape(info['pairs']['Det'],(len(info['pairs']['Det']),1))
-    info['pairs']['WL'] = np.reshape(info['pairs']['WL'],(len(info['pairs']['WL']),1))
-    info['pairs']['lambda'] = np.reshape(info['pairs']['lambda'],(len(info['pairs']['lambda']),1))
-    info['pairs']['NN'] = np.reshape(info['pairs']['NN'],(len(info['pairs']['NN']),1))
-    lexsorter = np.lexsort((info['pairs']['Det'],info['pairs']['WL']), axis = 0)
-    info['pairs']['Det'] = info['pairs']['Det'][lexsorter]
-    info['pairs']['Src'] = info['pairs']['Src'][lexsorter]
-    info['pairs']['WL'] = info['pairs']['WL'][lexsorter]
-    info['pairs']['lambda'] = info['pairs']['lambda'][lexsorter]
-    info['pairs']['r3d']= info['pairs']['r3d'][lexsorter]
-    info['pairs']['r2d'] = info['pairs']['r2d'][lexsorter]
-    info['pairs']['NN'] = info['pairs']['NN'][lexsorter]
-    info['pairs']['Det'] = np.double(info['pairs']['Det'])
-    info['pairs']['Src'] = np.double(info['pairs']['Src'])
-    info['pairs']['WL'] = np.double(info['pairs']['WL'])
-    info['pairs']['lambda'] = np.double(info['pairs']['lambda'])
-    info['pairs']['r3d']= np.double(info['pairs']['r3d'])
-    info['pairs']['r2d'] = np.double(info['pairs']['r2d'])
-    info['pairs']['NN'] = np.double(info['pairs']['NN'])
-    data = np.squeeze(data[lexsorter])
+        # Order info.pairs and data by wavelength, then by detector
+        lexsorter = np.lexsort((info['pairs']['Det'],info['pairs']['WL']))
+        if channels is not None:
+            lexsorter = lexsorter[np.arange(0, Nm)[channels]]
+        for key in info['pairs']:
+            col = np.asarray(info['pairs'][key])
+            if key != 'Mod':
+                col = np.double(np.reshape(col, (len(col), 1)))
+            info['pairs'][key] = col[lexsorter]
+        data = LazyMeasData([series], lexsorter, cols)
+        if not lazy:
+            data = np.squeeze(data.toarray())
+    except BaseException:
+        h5.close()
+        raise
+    if not lazy:
+        h5.close()
     
 # Save Output NeuroDOT File
     if save_file == 1:
@@ -1115,10 +1565,693 @@ def snirf2ndot(filename, pn, save_file =0, output = None, dtype = []):
         outputs = dict()
         outputs['data'] = data
         outputs['info'] = info
-        spio.savemat(p, {'data':data, 'info':info})
+        spio.savemat(p, {'data':np.asarray(data), 'info':info})
     return data, info    
 
 
+def ndot2snirf(data, info, filename, pn = None, params = None):
+    '''
+    NDOT2SNIRF Writes NeuroDOT "data" and "info" to a file in the SNIRF format.
+
+    NDOT2SNIRF(data, info, filename, pn) writes the MEAS x TIME "data"
+    (an array, a memory map, or a LAZYMEASDATA) to "filename" (in the
+    folder "pn"), with one measurementList entry per row from
+    "info.pairs", the probe from "info.optodes", and one stim group per
+    "Pulse_k" in "info.paradigm". The time series is streamed into a
+    chunked TIME x MEAS HDF5 dataset in blocks of "chunk" samples, so
+    no transposed copy of the whole recording is ever built.
+
+    With "append" set, the time series of "data" is added to the end of
+    an existing file written by NDOT2SNIRF (e.g., for long or online
+    recordings). The measurements must match the file. The events of
+    "info.paradigm" are then taken relative to the first appended
+    sample (from "synchpts", which is then required if there are any
+    events) and added to the stim groups of the same name.
+
+    Params:
+        :chunk:       1024    Samples per HDF5 chunk and per write.
+        :compression: 'gzip'  HDF5 compression filter ('gzip', 'lzf',
+                              or None).
+        :level:       4       gzip compression level (0-9).
+        :append:      False   Append to an existing file.
+
+    See Also: SNIRF2NDOT, LUMO2NDOT.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    if pn is None:
+        pn = ''
+    chunk = int(params.get('chunk', 1024))
+    compression = params.get('compression', 'gzip')
+    level = params.get('level', 4) if compression == 'gzip' else None
+    append = bool(params.get('append', False))
+    fn = os.path.join(pn, filename)
+    if not fn.endswith('.snirf'):
+        fn = fn + '.snirf'
+
+    if not hasattr(data, 'dtype'):
+        data = np.asarray(data)
+    if np.ndim(data) == 1:
+        data = np.reshape(data, (1, -1))
+    Nm, Nt = np.shape(data)
+    framerate = float(info['system']['framerate'])
+    Src = np.asarray(info['pairs']['Src']).astype(np.int32).ravel()
+    Det = np.asarray(info['pairs']['Det']).astype(np.int32).ravel()
+    WL = np.asarray(info['pairs']['WL']).astype(np.int32).ravel()
+    if len(Src) != Nm:
+        raise ValueError('Error: data rows do not match info.pairs.')
+    paradigm = info.get('paradigm', {})
+    if 'misc' in info and 'events' in info['misc']:
+        names = [str(x) for x in info['misc']['events']]
+    else:
+        names = []
+    Npulses = len([k for k in paradigm if k.startswith('Pulse_')])
+    names = names + ['Pulse_' + str(j + 1) for j in range(len(names), Npulses)]
+
+    append = append and os.path.isfile(fn)
+    if append and Npulses > 0 and 'synchpts' not in paradigm:
+        raise ValueError('Error: appended events need info.paradigm.synchpts.')
+
+    with h5py.File(fn, 'a' if append else 'w') as f:
+        if append:
+            dgrp = f['nirs/data1']
+            series = dgrp['dataTimeSeries']
+            if np.shape(series)[1] != Nm:
+                raise ValueError('Error: data rows do not match the measurements in ' + fn + '.')
+            n0 = np.shape(series)[0]
+            series.resize(n0 + Nt, axis = 0)
+            dgrp['time'].resize(n0 + Nt, axis = 0)
+            t0 = n0 / framerate
+            # Events of an appended block are relative to its first sample
+            synchtimes = t0 + np.asarray(paradigm.get('synchpts', []), dtype = np.float64).ravel() / framerate
+        else:
+            f['formatVersion'] = '1.1'
+            nirs = f.create_group('nirs')
+
+            ## Metadata.
+            tags = nirs.create_group('metaDataTags')
+            tags['SubjectID'] = str(info.get('misc', {}).get('subject_id', 'default'))
+            tags['MeasurementDate'] = str(info.get('io', {}).get('date', 'unknown'))
+            tags['MeasurementTime'] = str(info.get('io', {}).get('time', 'unknown'))
+            tags['LengthUnit'] = 'mm'
+            tags['TimeUnit'] = 's'
+            tags['FrequencyUnit'] = 'Hz'
+            tags['framerate'] = framerate
+            if 'unix_time' in info.get('io', {}):
+                tags['UnixTime'] = str(info['io']['unix_time'])
+            if 'CapName' in info.get('optodes', {}):
+                tags['CapName'] = str(info['optodes']['CapName'])
+
+            ## Probe.
+            probe = nirs.create_group('probe')
+            lam = np.asarray(info['pairs']['lambda'], dtype = np.float64).ravel()
+            wavelengths = np.zeros(np.max(WL))
+            wavelengths[WL - 1] = lam
+            probe['wavelengths'] = wavelengths
+            optodes = info.get('optodes', {})
+            for key, name in (('spos3', 'sourcePos3D'), ('dpos3', 'detectorPos3D'), ('spos2', 'sourcePos2D'), ('dpos2', 'detectorPos2D')):
+                if key in optodes:
+                    probe[name] = np.asarray(optodes[key], dtype = np.float64)
+
+            ## Time series and measurement list.
+            dgrp = nirs.create_group('data1')
+            c = max(1, min(chunk, Nt))
+            series = dgrp.create_dataset('dataTimeSeries', shape = (Nt, Nm), maxshape = (None, Nm), dtype = np.dtype(data.dtype),
+                                         chunks = (c, Nm), compression = compression, compression_opts = level)
+            dgrp.create_dataset('time', shape = (Nt,), maxshape = (None,), dtype = np.float64, chunks = (c,))
+            for k in range(0, Nm):
+                g = dgrp.create_group('measurementList' + str(k + 1))
+                g['sourceIndex'] = Src[k]
+                g['detectorIndex'] = Det[k]
+                g['wavelengthIndex'] = WL[k]
+                g['dataType'] = np.int32(1)
+                g['dataTypeIndex'] = np.int32(1)
+            n0 = 0
+            if 'synchtimes' in paradigm:
+                synchtimes = np.asarray(paradigm['synchtimes'], dtype = np.float64).ravel()
+            else:
+                synchtimes = np.asarray(paradigm.get('synchpts', []), dtype = np.float64).ravel() / framerate
+
+        ## Stream the time series, one block of samples at a time.
+        for a in range(0, Nt, chunk):
+            b = min(a + chunk, Nt)
+            series[n0 + a:n0 + b, :] = np.transpose(np.asarray(data[:, a:b]))
+            dgrp['time'][n0 + a:n0 + b] = np.arange(n0 + a, n0 + b) / framerate
+
+        ## Stim groups: [onset, duration, amplitude] per event.
+        nirs = f['nirs']
+        durations = np.asarray(info.get('misc', {}).get('stimDuration', []), dtype = np.float64).ravel()
+        for j in range(0, Npulses):
+            idx = np.asarray(paradigm['Pulse_' + str(j + 1)]).astype(int).ravel() - 1
+            dur = durations[j] if j < len(durations) else 0
+            rows = np.c_[synchtimes[idx], np.full(len(idx), dur), np.ones(len(idx))]
+            stim = [g for g in _h5_indexed(nirs, 'stim') if _h5_str(g['name'][()]) == names[j]]
+            if len(stim) == 0:
+                g = nirs.create_group('stim' + str(len(_h5_indexed(nirs, 'stim')) + 1))
+                g['name'] = names[j]
+                g.create_dataset('data', data = np.reshape(rows, (-1, 3)), maxshape = (None, 3), chunks = True)
+            elif len(idx) > 0:
+                d = stim[0]['data']
+                d.resize(np.shape(d)[0] + len(idx), axis = 0)
+                d[-len(idx):, :] = rows
+
+    return
+
+
+class LazyMeasData:
+    """
+    LAZYMEASDATA A MEAS x TIME data array read on demand from TIME x CHAN blocks.
+
+    data = LAZYMEASDATA(blocks) wraps a list of TIME_i x CHAN array-likes
+    "blocks" (e.g., np.memmap views of raw files or h5py datasets) that
+    follow each other in time, without reading or copying them. "data"
+    has the shape of the MEAS x TIME array formed by concatenating the
+    blocks in time and transposing, and can be indexed like it, e.g.
+    data[:, 100:200] or data[info['pairs']['WL'] == 2, :]. Only the
+    indexed samples are read. Each axis is indexed separately (integers,
+    slices, boolean masks, or index lists). np.asarray(data) reads the
+    whole array.
+
+    data = LAZYMEASDATA(blocks, rows) keeps only the channels "rows"
+    (0-based CHAN indices), in that order, as the measurements.
+
+    data.close() closes the HDF5 files that the blocks are read from, so
+    that they are no longer locked (memory maps hold no open file). It
+    is also called at the end of a "with data:" block. Views made with
+    select() share the files, and cannot be read once they are closed.
+
+    Fields and methods:
+        :blocks:     TIME_i x CHAN array-likes.
+        :rows:       CHAN index of each measurement.
+        :cols:       Global time index of each sample.
+        :shape:      (MEAS, TIME).
+        :select(rows, cols):  LAZYMEASDATA holding the measurements
+                              "rows" and samples "cols" only (indices
+                              into this array; nothing is read).
+        :toarray():  Dense MEAS x TIME array.
+        :close():    Close the files of the blocks.
+
+    See Also: LUMO2NDOT, SNIRF2NDOT, NDOT2SNIRF.
+    """
+
+    def __init__(self, blocks, rows = None, cols = None):
+        self.blocks = list(blocks)
+        lens = [np.shape(b)[0] for b in self.blocks]
+        self._offsets = np.concatenate(([0], np.cumsum(lens))).astype(np.int64)
+        Nc = np.shape(self.blocks[0])[1]
+        self.rows = np.arange(0, Nc) if rows is None else np.asarray(rows, dtype = np.int64).ravel()
+        self.cols = np.arange(0, self._offsets[-1]) if cols is None else np.asarray(cols, dtype = np.int64).ravel()
+
+    @property
+    def shape(self):
+        return (len(self.rows), len(self.cols))
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def dtype(self):
+        return np.dtype(self.blocks[0].dtype)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _index(self, key):
+        # Per-axis index lists into rows/cols; integer indices drop their axis.
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            e = [i for i, k in enumerate(key) if k is Ellipsis][0]
+            key = key[:e] + (slice(None),) * (3 - len(key)) + key[e + 1:]
+        key = key + (slice(None),) * (2 - len(key))
+        if len(key) > 2:
+            raise IndexError('Too many indices for a LazyMeasData.')
+        idx = []
+        drop = []
+        for a, k in enumerate(key):
+            if not isinstance(k, slice) and np.ndim(k) > 1:
+                k = np.ravel(k)
+            ik = np.arange(0, self.shape[a])[k]
+            drop.append(np.ndim(ik) == 0)
+            idx.append(np.atleast_1d(ik))
+        return idx, drop
+
+    def __getitem__(self, key):
+        (im, it), drop = self._index(key)
+        rows = self.rows[im]
+        cols = self.cols[it]
+
+        ## Read each block once, as the hyperslab spanning the requested samples and channels.
+        out = np.empty((len(rows), len(cols)), dtype = self.dtype)
+        if np.size(out) == 0:
+            return np.squeeze(out, axis = tuple(a for a in range(0, 2) if drop[a]))
+        r0 = int(np.min(rows))
+        r1 = int(np.max(rows)) + 1
+        blk = np.searchsorted(self._offsets, cols, side = 'right') - 1
+        for b in np.unique(blk):
+            m = blk == b
+            local = cols[m] - self._offsets[b]
+            lo = int(np.min(local))
+            hi = int(np.max(local)) + 1
+            span = np.asarray(self.blocks[b][lo:hi, r0:r1])
+            out[:, m] = span[local - lo, :][:, rows - r0].T
+        return np.squeeze(out, axis = tuple(a for a in range(0, 2) if drop[a]))
+
+    def select(self, rows = None, cols = None):
+        rows = slice(None) if rows is None else rows
+        cols = slice(None) if cols is None else cols
+        (im, it), _ = self._index((rows, cols))
+        return LazyMeasData(self.blocks, self.rows[im], self.cols[it])
+
+    def toarray(self):
+        return self[:, :]
+
+    def __array__(self, dtype = None, copy = None):
+        data = self.toarray()
+        return data if dtype is None else data.astype(dtype)
+
+    def close(self):
+        for b in self.blocks:
+            ds = getattr(b, 'ds', b) # _MatColumnMajor wraps its dataset
+            if isinstance(ds, h5py.Dataset) and ds.id.valid:
+                ds.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return 'LazyMeasData(shape=' + str(self.shape) + ', blocks=' + str(len(self.blocks)) + ')'
+
+
+def _pad_pairs(grid, wavelengths, src, det, wl):
+    # info.optodes/pairs for the measurements (src, det, wl) (1-based), taken
+    # from the full pad of "grid" and ordered as the pad (wavelength, detector,
+    # source). Also returns the order of the input measurements.
+    params = dict()
+    params['lambda'] = wavelengths
+    pad = ndot.Generate_pad_from_grid(grid, params, dict())
+    Ns = np.shape(grid['spos3'])[0]
+    Nd = np.shape(grid['dpos3'])[0]
+    padidx = (np.asarray(wl, dtype = np.int64) - 1) * Nd * Ns + (np.asarray(det, dtype = np.int64) - 1) * Ns + np.asarray(src, dtype = np.int64) - 1
+    order = np.argsort(padidx, kind = 'stable')
+    padidx = padidx[order]
+
+    info = dict()
+    info['optodes'] = pad['optodes']
+    info['pairs'] = dict()
+    for key in pad['pairs']:
+        info['pairs'][key] = pad['pairs'][key][padidx]
+    return info, order
+
+
+def _lumo_intensity(fn, Nc):
+    # Memory-maps one LUMO intensity file as a TIME x CHAN float32 array.
+    with open(fn, 'rb') as fp:
+        hdr = fp.read(48)
+    if len(hdr) < 48 or hdr[0] != 0x92:
+        raise ValueError('Error: ' + fn + ' is not a LUMO intensity file.')
+    if list(hdr[1:4]) not in ([0, 1, 0], [0, 0, 1]):
+        raise ValueError('Error: unsupported LUMO intensity file version in ' + fn + '.')
+    if hdr[45] != 0:
+        raise ValueError('Error: big-endian LUMO intensity files are not supported.')
+    nchns = int(np.frombuffer(hdr, dtype = '<u8', count = 1, offset = 8)[0])
+    nframes = int(np.frombuffer(hdr, dtype = '<u8', count = 1, offset = 16)[0])
+    if nchns != Nc:
+        raise ValueError('Error: ' + fn + ' holds ' + str(nchns) + ' channels, expected ' + str(Nc) + '.')
+    final = hdr[44] == 0
+    if nframes == 0:
+        return np.zeros((0, nchns), dtype = np.float32), final
+
+    # Samples are stored channel-fastest, i.e. as a row-major TIME x CHAN array.
+    return np.memmap(fn, dtype = '<f4', mode = 'r', offset = 48, shape = (nframes, nchns)), final
+
+
+def lumo2ndot(filename, pn = None, lazy = True):
+    '''
+    LUMO2NDOT Loads a LUMO recording directory into NeuroDOT formatting.
+
+    [data, info] = LUMO2NDOT(filename, pn) reads the ".LUMO" directory
+    "filename" (in the folder "pn"): the recording metadata
+    (metadata.toml, recordingdata.toml), the hardware and cap
+    description (hardware.toml, layout.json), the events (events.toml)
+    and the intensity files listed under [[intensity_files]].
+
+    The intensity files are memory-mapped, not read, and returned in
+    time order as one LAZYMEASDATA "data" of shape MEAS x TIME, so
+    only the samples that are indexed are ever loaded (e.g.,
+    data[:, 0:100], or np.asarray(data) for the whole recording). With
+    "lazy" set to False, "data" is read into a dense array instead.
+
+    Source and detector positions are taken from the layout docks,
+    with each tile (node) in the dock that shares its number. Sources
+    A/B/C of a tile are "optode_a/b/c" and detector channels 0-3
+    (1-4 from file version 0.4) are "optode_1..4". Measurements are ordered by wavelength, then
+    detector, then source, as in GENERATE_PAD_FROM_GRID, and
+    "info.pairs" is built from that pad. Channels flagged as inactive
+    (saturated) in "chans_list_act" are marked in "info.io.saturated".
+
+    Event timestamps are in milliseconds from the first frame (stored
+    as strings in files older than version 0.4). "info.paradigm" holds
+    their times (s), nearest sample points (0-based, as in SNIRF2NDOT)
+    and types, one type (and one "Pulse_k" list) per sorted unique event
+    name. Events outside the recording are dropped.
+
+    See Also: LAZYMEASDATA, SNIRF2NDOT, GENERATE_PAD_FROM_GRID.
+    '''
+    ## Parameters and Initialization.
+    if pn is None:
+        pn = ''
+    fn = os.path.join(pn, filename)
+    if not os.path.isdir(fn):
+        raise ValueError('Error: ' + fn + ' is not a LUMO directory.')
+    with open(os.path.join(fn, 'metadata.toml'), 'rb') as fp:
+        meta = tomllib.load(fp)
+    names = meta.get('file_names', {})
+    version = [int(v) for v in str(meta.get('lumo_file_version', '0.0.0')).split('.')[0:2]]
+    with open(os.path.join(fn, names.get('recordingdata_file', 'recordingdata.toml')), 'rb') as fp:
+        rec = tomllib.load(fp)['variables']
+    with open(os.path.join(fn, names.get('hardware_file', 'hardware.toml')), 'rb') as fp:
+        hw = tomllib.load(fp)
+    with open(os.path.join(fn, names.get('layout_file', 'layout.json')), 'r') as fp:
+        layout = json.load(fp)
+    evfile = os.path.join(fn, names.get('event_file', 'events.toml'))
+    events = []
+    if os.path.isfile(evfile):
+        with open(evfile, 'rb') as fp:
+            events = tomllib.load(fp).get('events', [])
+
+    wavelengths = np.asarray(rec['wavelength'], dtype = np.float64).ravel()
+    Ns = int(rec['n_srcs'])
+    Nd = int(rec['n_dets'])
+    Nc = int(rec['n_chans'])
+    Nwl = len(wavelengths)
+    chans = np.reshape(np.asarray(rec['chans_list'], dtype = np.int64), (-1, 3))
+    if np.shape(chans)[0] != Nc:
+        raise ValueError('Error: chans_list does not match n_chans.')
+
+    ## Intensity files, memory-mapped in time order.
+    files = sorted(meta.get('intensity_files', []), key = lambda f: f['time_range'][0])
+    if len(files) == 0:
+        raise ValueError('Error: ' + fn + ' lists no intensity files.')
+    blocks = []
+    for k, f in enumerate(files):
+        block, final = _lumo_intensity(os.path.join(fn, f['file_name']), Nc)
+        if final != (k == len(files) - 1):
+            raise ValueError('Error: ' + f['file_name'] + ' is out of sequence in ' + fn + '.')
+        blocks.append(block)
+
+    ## Optode positions from the layout docks.
+    docks = dict()
+    for d in layout['docks']:
+        docks[int(str(d['dock_id']).split('_')[-1])] = {o['optode_id']: o for o in d['optodes']}
+    spos2 = np.full((Ns, 2), np.nan)
+    spos3 = np.full((Ns, 3), np.nan)
+    dpos2 = np.full((Nd, 2), np.nan)
+    dpos3 = np.full((Nd, 3), np.nan)
+    det_base = 1 if version[0] == 0 and version[1] < 4 else 0 # detector channels are 0-3 before v0.4, then 1-4
+    for node in hw['Hub']['Group']['Node']:
+        optodes = docks.get(int(node['node_id']))
+        if optodes is None:
+            raise ValueError('Error: no layout dock for node ' + str(node['node_id']) + '.')
+        for s in node.get('Source', []):
+            o = optodes['optode_' + s['description'][3].lower()]
+            c2 = o['coordinates_2d']
+            c3 = o['coordinates_3d']
+            spos2[s['group_location_index'] - 1, :] = [c2['x'], c2['y']]
+            spos3[s['group_location_index'] - 1, :] = [c3['x'], c3['y'], c3['z']]
+        for d in node.get('Detector', []):
+            ch = int(d['description'].split()[-1]) + det_base
+            if 'optode_' + str(ch) not in optodes:
+                raise ValueError('Error: detector "' + d['description'] + '" of node ' + str(node['node_id'])
+                                 + ' has no optode_' + str(ch) + ' in the layout dock.')
+            o = optodes['optode_' + str(ch)]
+            c2 = o['coordinates_2d']
+            c3 = o['coordinates_3d']
+            dpos2[d['group_location_index'] - 1, :] = [c2['x'], c2['y']]
+            dpos3[d['group_location_index'] - 1, :] = [c3['x'], c3['y'], c3['z']]
+
+    ## Pairs: order the channels as the pad (wavelength, detector, source).
+    grid = dict()
+    grid['spos2'] = spos2
+    grid['spos3'] = spos3
+    grid['dpos2'] = dpos2
+    grid['dpos3'] = dpos3
+    info, order = _pad_pairs(grid, wavelengths, chans[:, 0], chans[:, 1], chans[:, 2])
+
+    ## System and io.
+    framerate = float(rec['framerate'])
+    info['system'] = dict()
+    info['system']['framerate'] = framerate
+    info['system']['init_framerate'] = framerate
+    info['io'] = dict()
+    info['io']['Ns'] = Ns
+    info['io']['Nd'] = Nd
+    info['io']['Nwl'] = Nwl
+    if 't_0' in rec:
+        info['io']['unix_time'] = rec['t_0']
+    if 'chans_list_act' in rec:
+        act = np.asarray(rec['chans_list_act']).ravel()
+        info['io']['saturated'] = act[order] == 0
+    info['io']['lumo_file_version'] = meta.get('lumo_file_version')
+    info['misc'] = dict()
+    info['misc']['subject_id'] = 'default'
+
+    ## Data.
+    data = LazyMeasData(blocks, order)
+    Nt = data.shape[1]
+    if not lazy:
+        data = data.toarray()
+
+    ## Paradigm.
+    if len(events) > 0:
+        # Timestamps are in ms from the first frame in every file version
+        ts = np.array([float(e['Timestamp']) for e in events]) / 1e3
+        marks = np.array([str(e['name']) for e in events])
+        labels = np.unique(marks)
+        # Keep the events inside the recording, as SNIRF2NDOT does
+        keep = (ts >= 0) & (ts <= (Nt - 1) / framerate)
+        ts = ts[keep]
+        marks = marks[keep]
+        sortedIdx = np.argsort(ts, kind = 'stable')
+        ts = ts[sortedIdx]
+        marks = marks[sortedIdx]
+        synchtype = np.searchsorted(labels, marks)
+        info['paradigm'] = dict()
+        info['paradigm']['synchtimes'] = ts
+        info['paradigm']['synchtype'] = (synchtype + 1).astype(np.float64)
+        for j in range(0, len(labels)):
+            label = 'Pulse_' + str(j + 1)
+            info['paradigm'][label] = np.transpose(np.array(np.where(info['paradigm']['synchtype'] == j + 1))) + 1
+        # Nearest frame (0-based, first frame on ties)
+        info['paradigm']['synchpts'] = np.ceil(np.maximum(ts * framerate - 0.5, 0))
+        info['paradigm']['init_synchpts'] = info['paradigm']['synchpts']
+        info['misc']['events'] = list(labels)
+
+    return data, info
+
+
+class _MatColumnMajor:
+    # TIME x CHAN view of a CHAN x TIME HDF5 dataset: a MATLAB v7.3 TIME x CHAN
+    # matrix as stored on disk (column-major).
+    def __init__(self, ds):
+        self.ds = ds
+        self.shape = (ds.shape[1], ds.shape[0])
+        self.dtype = ds.dtype
+
+    def __getitem__(self, key):
+        return np.transpose(self.ds[key[1], key[0]])
+
+
+def _mat_field(value):
+    # MATLAB numeric field as a 2-D array, char field as a string.
+    if isinstance(value, h5py.Dataset):
+        if value.attrs.get('MATLAB_class') == b'char':
+            return ''.join(chr(c) for c in np.ravel(value[()], order = 'F'))
+        return np.atleast_2d(np.transpose(value[()]))
+    value = np.asarray(value)
+    if value.dtype.kind == 'U':
+        return str(value.item()) if value.size > 0 else ''
+    return np.atleast_2d(value)
+
+
+def _homer_vars(fn, names, lazy = ()):
+    # Reads only the variables "names" of a Homer .nirs/.SD3D file. Structs are
+    # returned as dicts of fields and matrices as arrays, except that v7.3
+    # (HDF5) matrices named in "lazy" stay on disk as h5py datasets (N x TIME,
+    # as stored); the file is then left open, owned by those datasets.
+    out = dict()
+    if h5py.is_hdf5(fn):
+        f = h5py.File(fn, 'r')
+        try:
+            for name in names:
+                if name in f:
+                    if isinstance(f[name], h5py.Group):
+                        out[name] = {key: _mat_field(f[name][key]) for key in f[name].keys()}
+                    elif f[name].attrs.get('MATLAB_class') == b'cell':
+                        out[name] = [_mat_field(f[ref]) for ref in np.ravel(f[name][()], order = 'F')]
+                    elif name in lazy:
+                        out[name] = f[name]
+                    else:
+                        out[name] = np.transpose(f[name][()])
+        except BaseException:
+            f.close()
+            raise
+        if not any(isinstance(x, h5py.Dataset) for x in out.values()):
+            f.close()
+    else:
+        present = [v[0] for v in spio.whosmat(fn)]
+        m = spio.loadmat(fn, variable_names = [n for n in names if n in present], struct_as_record = False)
+        for name in names:
+            if name in m:
+                value = m[name]
+                if value.dtype == object and value.size > 0 and isinstance(value.flat[0], spio.matlab.mat_struct):
+                    s = value.flat[0]
+                    out[name] = {key: _mat_field(getattr(s, key)) for key in s._fieldnames}
+                elif value.dtype == object:
+                    out[name] = [_mat_field(v) for v in value.ravel(order = 'F')]
+                else:
+                    out[name] = value
+    return out
+
+
+def _homer_info(SD, SD3D = None):
+    # info.optodes/pairs from a Homer SD (and optional SD3D) structure, and the
+    # order of the MeasList rows.
+    def pos(S, key):
+        scale = {'cm': 10, 'm': 1000}.get(str(S.get('SpatialUnit', 'mm')).strip().lower(), 1)
+        return np.reshape(np.asarray(S[key], dtype = np.float64), (-1, np.shape(S[key])[-1])) * scale
+
+    grid = dict()
+    if SD3D is not None:
+        grid['spos3'] = pos(SD3D, 'SrcPos')
+        grid['dpos3'] = pos(SD3D, 'DetPos')
+    if SD is not None:
+        grid['spos2'] = pos(SD, 'SrcPos')[:, 0:2]
+        grid['dpos2'] = pos(SD, 'DetPos')[:, 0:2]
+        if SD3D is None:
+            grid['spos3'] = pos(SD, 'SrcPos')
+            grid['dpos3'] = pos(SD, 'DetPos')
+    S = SD if SD is not None else SD3D
+    ml = np.reshape(np.asarray(S['MeasList']), (-1, 4)).astype(np.int64)
+    wavelengths = np.asarray(S['Lambda'], dtype = np.float64).ravel()
+    info, order = _pad_pairs(grid, wavelengths, ml[:, 0], ml[:, 1], ml[:, 3])
+
+    info['io'] = dict()
+    info['io']['Ns'] = np.shape(grid['spos3'])[0]
+    info['io']['Nd'] = np.shape(grid['dpos3'])[0]
+    info['io']['Nwl'] = len(wavelengths)
+    if 'MeasListAct' in S:
+        info['io']['MeasListAct'] = np.asarray(S['MeasListAct']).ravel()[order]
+    if SD3D is not None and 'Landmarks' in SD3D:
+        info['optodes']['Landmarks'] = pos(SD3D, 'Landmarks')
+    return info, order
+
+
+def sd3d2ndot(filename, pn = None):
+    '''
+    SD3D2NDOT Loads a Homer/AtlasViewer .SD3D probe file into NeuroDOT formatting.
+
+    info = SD3D2NDOT(filename, pn) reads the SD3D structure (variable
+    "SD3D" or "SD_3D") of "filename" (in the folder "pn") and returns
+    "info.optodes" (spos3/dpos3, in mm), "info.pairs" for the
+    measurements of its "MeasList", built with GENERATE_PAD_FROM_GRID
+    and ordered by wavelength, then detector, then source, and
+    "info.io" (Ns, Nd, Nwl, MeasListAct). Only the SD3D variable is
+    read.
+
+    See Also: NIRS2NDOT, GENERATE_PAD_FROM_GRID.
+    '''
+    fn = os.path.join(pn if pn is not None else '', filename)
+    v = _homer_vars(fn, ['SD3D', 'SD_3D'])
+    SD3D = v.get('SD3D', v.get('SD_3D'))
+    if SD3D is None:
+        raise ValueError('Error: no SD3D structure in ' + fn + '.')
+    info, _ = _homer_info(None, SD3D)
+    return info
+
+
+def nirs2ndot(filename, pn = None, aux = None, lazy = True):
+    '''
+    NIRS2NDOT Loads a Homer .nirs file into NeuroDOT formatting.
+
+    [data, info] = NIRS2NDOT(filename, pn) reads the variables "d", "t",
+    "s", "SD" (and "SD3D", "CondNames" if present) of the Homer file
+    "filename" (in the folder "pn"), and nothing else. "data" is the
+    MEAS x TIME LAZYMEASDATA view of "d", with rows ordered as
+    "info.pairs". For MATLAB v7.3 files "d" is read from disk only when
+    indexed, and the file stays open until data.close() is called. With
+    "lazy" set to False, "data" is a dense array and the file is closed.
+
+    "info.optodes" takes 3D positions from SD3D (if present) and 2D
+    positions from SD, in mm. "info.pairs" is built with
+    GENERATE_PAD_FROM_GRID and ordered by wavelength, then detector,
+    then source. "info.paradigm" lists the onsets in "s" (0-based
+    synchpts, as in SNIRF2NDOT), with one type (and one "Pulse_k" list)
+    per column of "s".
+
+    [data, info] = NIRS2NDOT(filename, pn, aux) also reads the TIME x N
+    variables named in the list "aux" (e.g., ['aux']) into
+    "info.misc".
+
+    See Also: SD3D2NDOT, SNIRF2NDOT, LAZYMEASDATA.
+    '''
+    ## Parameters and Initialization.
+    if aux is None:
+        aux = []
+    fn = os.path.join(pn if pn is not None else '', filename)
+    v = _homer_vars(fn, ['d', 't', 's', 'SD', 'SD3D', 'CondNames'] + list(aux), ['d'] if lazy else [])
+    for name in ('d', 't', 'SD'):
+        if name not in v:
+            raise ValueError('Error: no "' + name + '" variable in ' + fn + '.')
+
+    ## Optodes and pairs.
+    info, order = _homer_info(v['SD'], v.get('SD3D'))
+
+    ## Time series, as TIME x MEAS blocks.
+    d = v['d']
+    block = _MatColumnMajor(d) if isinstance(d, h5py.Dataset) else d
+    data = LazyMeasData([block], order)
+    t = np.asarray(v['t']).ravel()
+    Nt = data.shape[1]
+    if not lazy:
+        data = data.toarray()
+
+    info['system'] = dict()
+    info['system']['framerate'] = 1/np.mean(np.diff(t))
+    info['system']['init_framerate'] = info['system']['framerate']
+    info['misc'] = dict()
+    info['misc']['subject_id'] = 'default'
+    info['misc']['time'] = t
+    for name in aux:
+        if name in v:
+            info['misc'][name] = np.asarray(v[name])
+
+    ## Paradigm.
+    if 's' in v:
+        s = np.reshape(np.asarray(v['s']), (Nt, -1))
+        synchpts, synchtype = np.nonzero(s)
+        sortedIdx = np.argsort(synchpts, kind = 'stable')
+        synchpts = synchpts[sortedIdx]
+        synchtype = synchtype[sortedIdx] + 1
+        info['paradigm'] = dict()
+        info['paradigm']['synchtimes'] = t[synchpts]
+        info['paradigm']['synchtype'] = synchtype.astype(np.float64)
+        for j in range(0, np.shape(s)[1]):
+            label = 'Pulse_' + str(j + 1)
+            info['paradigm'][label] = np.transpose(np.array(np.where(synchtype == j + 1))) + 1
+        info['paradigm']['synchpts'] = synchpts.astype(np.float64)
+        info['paradigm']['init_synchpts'] = info['paradigm']['synchpts']
+        if 'CondNames' in v:
+            info['misc']['events'] = list(v['CondNames'])
+
+    return data, info
+
+
 def todict(matobj):
     '''
     TODICT Recursively constructs from matobjects nested dictionaries
@@ -1137,42 +2270,47 @@ def Write_4dfp_Header(header, filename, pn):
     '''
     WRITE_4DFP_HEADER Writes a 4dfp header to a .ifh file.
 
-    WRITE_4DFP_HEADER(header, filename) writes the input "header" in 4dfp
-    format to an .ifh file specified by "filename".
+    WRITE_4DFP_HEADER(header, filename, pn) writes the input "header" in
+    4dfp format to an .ifh file specified by "filename" (without the
+    .ifh extension) in the folder "pn".
     
     See Also: SAVEVOLUMETRICDATA.
     '''
     ## Parameters and Initialization
+    if pn is None:
+        pn = ''
+    name = os.path.basename(filename)
+    if name.endswith('.4dfp'):
+        name = name + '.img'
     ## Read text.    
-    os.chdir(pn)
-    with open(filename + ".ifh", 'w') as fp:
+    with open(os.path.join(pn, filename + ".ifh"), 'w') as fp:
     ## Print input header to file.
         print('INTERFILE :=\n', file = fp)
-        print('version of keys := ' + header['version_of_keys'] +'\n', file = fp)
+        print('version of keys := ' + str(header.get('version_of_keys', '3.3')) +'\n', file = fp)
         print('image modality := dot\n', file = fp)
         print('originating system := Neuro-DOT\n', file = fp)
         print('conversion program := MATLABto4dfp\n', file = fp)
         print('original institution := Washington University\n', file = fp)
-        print('number format := ' +  header['format'] + '\n', file = fp)
-        print('name of data file := ' + filename + '\n', file = fp)
-        print('number of bytes per pixel := ' +  str(header['bytes_per_pixel']) +'\n', file = fp)
+        print('number format := ' +  str(header.get('format', 'float')) + '\n', file = fp)
+        print('name of data file := ' + name + '\n', file = fp)
+        print('number of bytes per pixel := ' +  str(header.get('bytes_per_pixel', 4)) +'\n', file = fp)
 
-        if header['byte'] =='b':
+        if header.get('byte', 'l') =='b':
             byte = 'big'
-        elif header['byte'] == 'l':
+        else:
             byte = 'little'
     
         print('imagedata byte order := ' +  byte +  'endian\n', file = fp)
 
-        if header.acq == 'transverse':
+        if header['acq'] == 'transverse':
                 print( 'orientation := 2\n', file = fp)
-        elif header.acq =='coronal':
+        elif header['acq'] =='coronal':
                 print( 'orientation := 3\n', file = fp)
-        elif header.acq == 'sagittal':
+        elif header['acq'] == 'sagittal':
                 print( 'orientation := 4\n', file = fp)
         
 
-        print('number of dimensions := ' + str(header['nDim']) +  '\n', file = fp)
+        print('number of dimensions := ' + str(header.get('nDim', 4)) +  '\n', file = fp)
         print('matrix size [1] := ' + str(header['nVx']) + '\n', file = fp)
         print('matrix size [2] := ' + str(header['nVy']) + '\n', file = fp)
         print('matrix size [3] := ' + str(header['nVz']) + '\n', file = fp)
@@ -1181,8 +2319,8 @@ def Write_4dfp_Header(header, filename, pn):
         print('scaling factor (mm/pixel) [2] := ' + str(header['mmy']) + '\n', file = fp)
         print('scaling factor (mm/pixel) [3] := ' + str(header['mmz']) + '\n', file = fp)
         if 'mmppix' in header:
-            print('mmppix := ' + str(header['mmppix']) + '\n', file = fp)
+            print('mmppix := ' + ' '.join(str(x) for x in np.ravel(header['mmppix'])) + '\n', file = fp)
         if 'center' in header:
-            print('center := ' + str(header['center']) + '\n', file = fp)
+            print('center := ' + ' '.join(str(x) for x in np.ravel(header['center'])) + '\n', file = fp)
 
-    return 
\ No newline at end of file
+    return
@@ -0,0 +1,384 @@
+# General imports
+import os
+import json
+import time
+import hashlib
+import argparse
+import h5py
+import numpy as np
+import scipy.io as spio
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import neuro_dot as ndot
+
+
+
+# Run formats, by file (or, for LUMO, directory) extension.
+_RUN_FORMATS = {'.snirf': 'snirf', '.lumo': 'lumo', '.nirs': 'nirs', '.mat': 'mat'}
+_OUT_EXT = '.ndot'
+# Peak memory of the quality check, in float64 copies of the data.
+_QC_COPIES = 4
+
+
+def discover_runs(root, formats = None):
+    '''
+    DISCOVER_RUNS Finds the recordings under a study directory.
+
+    runs = DISCOVER_RUNS(root) walks the folder "root" and returns a
+    sorted list of (path, format) pairs, one per run: ".snirf" files,
+    ".LUMO" directories, Homer ".nirs" files and NeuroDOT ".mat" files.
+    LUMO directories, A-matrix stores (".Astore") and ingest outputs
+    (".ndot") are not searched.
+
+    runs = DISCOVER_RUNS(root, formats) keeps only the formats listed
+    (e.g., ['snirf', 'lumo']).
+
+    See Also: INGEST_STUDY.
+    '''
+    if formats is None:
+        formats = list(_RUN_FORMATS.values())
+    runs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        keep = []
+        for d in sorted(dirnames):
+            ext = os.path.splitext(d)[1].lower()
+            if ext == '.lumo':
+                if 'lumo' in formats:
+                    runs.append((os.path.join(dirpath, d), 'lumo'))
+            elif ext not in ('.astore', _OUT_EXT):
+                keep.append(d)
+        dirnames[:] = keep
+        for f in filenames:
+            fmt = _RUN_FORMATS.get(os.path.splitext(f)[1].lower())
+            if fmt is not None and fmt != 'lumo' and fmt in formats:
+                runs.append((os.path.join(dirpath, f), fmt))
+
+    return sorted(runs)
+
+
+def source_hash(path, chunk = 1 << 20):
+    '''
+    SOURCE_HASH Returns the SHA-256 of a run's source files.
+
+    h = SOURCE_HASH(path) hashes the file "path" in blocks of "chunk"
+    bytes. For a directory (e.g., a ".LUMO" run), the relative name and
+    contents of every file in it are hashed, in sorted order.
+
+    See Also: INGEST_STUDY.
+    '''
+    h = hashlib.sha256()
+    if os.path.isdir(path):
+        files = []
+        for dirpath, _, filenames in os.walk(path):
+            files.extend(os.path.join(dirpath, f) for f in filenames)
+        files = sorted(files)
+    else:
+        files = [path]
+    for fn in files:
+        if os.path.isdir(path):
+            h.update(os.path.relpath(fn, path).replace(os.sep, '/').encode() + b'\0')
+        with open(fn, 'rb') as f:
+            for block in iter(lambda: f.read(chunk), b''):
+                h.update(block)
+
+    return h.hexdigest()
+
+
+def _is_ndot_mat(path):
+    # True if the .mat file holds NeuroDOT "data" and "info" variables.
+    # Files that cannot be listed (e.g., MATLAB tables) are not runs.
+    try:
+        names = [v[0] for v in spio.whosmat(path)]
+    except NotImplementedError: # MATLAB v7.3
+        try:
+            with h5py.File(path, 'r') as f:
+                names = list(f.keys())
+        except Exception:
+            return False
+    except Exception:
+        return False
+    return 'data' in names and 'info' in names
+
+
+def _load_run(path, fmt):
+    # Loads one run as (data, info), with "data" left on disk where the
+    # loader allows it.
+    pn, fn = os.path.split(path)
+    if fmt == 'snirf':
+        return ndot.snirf2ndot(fn, pn + os.sep, lazy = True)
+    if fmt == 'lumo':
+        return ndot.lumo2ndot(fn, pn, lazy = True)
+    if fmt == 'nirs':
+        return ndot.nirs2ndot(fn, pn, lazy = True)
+    try:
+        v = ndot.loadmat(path, ['data', 'info'], cache = False)
+    except NotImplementedError: # MATLAB v7.3
+        v = ndot.loadmat7p3(path, ['data', 'info'], cache = False)
+    if 'data' not in v or 'info' not in v:
+        raise ValueError('Error: ' + path + ' has no "data" and "info" variables.')
+
+    return v['data'], v['info']
+
+
+def ingest_run(path, fmt, out_dir, params = None):
+    '''
+    INGEST_RUN Converts, checks and stores one run.
+
+    entry = INGEST_RUN(path, fmt, out_dir, params) loads the run "path"
+    of format "fmt" (see DISCOVER_RUNS) and writes it to the folder
+    "out_dir" as:
+        :data.npy: the MEAS x TIME light levels, in "dtype", copied
+                   from the source in blocks of time points.
+        :info.mat: the NeuroDOT "info" structure, with the
+                   "info.MEAS" good-measurement table of FINDGOODMEAS
+                   (computed on the LOGMEAN of the stored data).
+    Load the run again with np.load(..., mmap_mode = 'r') and LOADMAT.
+
+    "entry" is the manifest record of the run: its "sha256" (see
+    SOURCE_HASH), size, format, data shape and type, framerate,
+    duration, the number of good measurements and the "status"
+    ('converted', or 'failed' with the "error"). A failed quality check
+    is recorded in "qc_error" and does not fail the run.
+
+    The memory used stays within "max_memory": the blocks copied are
+    sized to fit it, and the quality check, which holds a few float64
+    copies of the whole run, is skipped (with a "qc_error") for runs
+    too large for it.
+
+    Params:
+        :dtype:      'float32' Type of the stored data.
+        :max_memory: 4 GB      Memory budget of the conversion (0: none).
+        :bthresh:    0.075     Noise threshold of FINDGOODMEAS.
+        :sha256:     (none)    Source hash, if already computed.
+
+    See Also: INGEST_STUDY, FINDGOODMEAS, SOURCE_HASH.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    dtype = np.dtype(params.get('dtype', 'float32'))
+    max_memory = int(params.get('max_memory', 4 * 2**30))
+    bthresh = float(params.get('bthresh', 0.075))
+    entry = dict()
+    entry['format'] = fmt
+    entry['sha256'] = params['sha256'] if params.get('sha256') else source_hash(path)
+    entry['size'] = sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(path) for f in fs) \
+        if os.path.isdir(path) else os.path.getsize(path)
+    entry['output'] = out_dir
+    t_start = time.time()
+    try:
+        data, info = _load_run(path, fmt)
+        try:
+            if np.ndim(data) == 1:
+                data = np.reshape(data, (1, -1))
+            Nm, Nt = np.shape(data)[0:2]
+
+            ## Stored data, copied in blocks of time points.
+            chunk = Nt
+            if max_memory > 0: # source block, float64 at most, plus its cast
+                chunk = int(max(1, min(Nt, max_memory // (2 * 8 * max(Nm, 1)))))
+            os.makedirs(out_dir, exist_ok = True)
+            fn = os.path.join(out_dir, 'data.npy')
+            out = np.lib.format.open_memmap(fn + '.tmp', mode = 'w+', dtype = dtype, shape = (Nm, Nt))
+            for t0 in range(0, Nt, chunk):
+                out[:, t0:t0 + chunk] = np.asarray(data[:, t0:t0 + chunk])
+            out.flush()
+            del out
+        finally:
+            if isinstance(data, ndot.LazyMeasData):
+                data.close() # Release the source file
+        del data
+        os.replace(fn + '.tmp', fn)
+
+        ## Quality check.
+        data = np.load(fn, mmap_mode = 'r')
+        entry['qc_error'] = None
+        if max_memory > 0 and _QC_COPIES * 8 * Nm * Nt > max_memory:
+            entry['qc_error'] = 'skipped: run larger than the memory budget'
+        else:
+            try:
+                info = ndot.FindGoodMeas(ndot.logmean(np.asarray(data, dtype = np.float64))[0], info, bthresh)
+            except Exception as e:
+                entry['qc_error'] = type(e).__name__ + ': ' + str(e)
+        spio.savemat(os.path.join(out_dir, 'info.mat'), {'info': info}, do_compression = True)
+
+        entry['shape'] = [int(Nm), int(Nt)]
+        entry['dtype'] = dtype.name
+        framerate = float(np.ravel(info.get('system', {}).get('framerate', np.nan))[0])
+        entry['framerate'] = None if np.isnan(framerate) else framerate
+        entry['duration'] = None if np.isnan(framerate) else Nt / framerate
+        entry['Nwl'] = int(len(np.unique(info['pairs']['WL']))) if 'pairs' in info else None
+        if 'MEAS' in info and 'GI' in info['MEAS']:
+            entry['n_good'] = int(np.sum(info['MEAS']['GI']))
+        else:
+            entry['n_good'] = None
+        entry['bthresh'] = bthresh
+        entry['status'] = 'converted'
+        entry['error'] = None
+    except Exception as e:
+        entry['status'] = 'failed'
+        entry['error'] = type(e).__name__ + ': ' + str(e)
+    entry['seconds'] = time.time() - t_start
+    entry['converted'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    return entry
+
+
+def _ingest_worker(path, fmt, out_dir, params, previous):
+    # Hashes the source in the worker, and skips the run if the hash
+    # and the outputs match the previous manifest entry.
+    if fmt == 'mat' and not _is_ndot_mat(path):
+        return {'status': 'ignored', 'format': fmt, 'error': None}
+    h = source_hash(path)
+    if previous is not None and previous.get('status') in ('converted', 'unchanged') and previous.get('sha256') == h \
+            and os.path.isfile(os.path.join(out_dir, 'data.npy')) and os.path.isfile(os.path.join(out_dir, 'info.mat')):
+        entry = dict(previous)
+        entry['status'] = 'unchanged'
+        return entry
+    params = dict(params)
+    params['sha256'] = h
+
+    return ingest_run(path, fmt, out_dir, params)
+
+
+def _write_manifest(fn, manifest):
+    # Replaces the manifest in one step, so an interrupted ingest leaves
+    # the previous (or a complete) manifest.
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+    os.replace(fn + '.tmp', fn)
+
+
+def ingest_study(root, out_dir = None, params = None):
+    '''
+    INGEST_STUDY Converts every run of a study into NeuroDOT files.
+
+    manifest = INGEST_STUDY(root, out_dir, params) finds the runs under
+    the folder "root" (see DISCOVER_RUNS) and converts each of them with
+    INGEST_RUN in a pool of worker processes. Each run is written to
+    "out_dir" (default: root/ndot) under its path relative to "root",
+    plus ".ndot" (e.g., sub01/run1.snirf.ndot/data.npy).
+
+    The manifest ("out_dir"/manifest.json) has one entry per run, keyed
+    by its relative path. It is saved as each run finishes. Runs whose
+    source hash matches a converted manifest entry are not converted
+    again (their status is 'unchanged'). Runs whose source no longer
+    exists are dropped from the manifest (their outputs are left in
+    place); runs left out by "formats" keep their entries.
+
+    Each worker converts one run at a time within a budget of
+    "max_memory" bytes (see INGEST_RUN). SNIRF, LUMO and v7.3 files are
+    memory-mapped or read in blocks, so the total memory used stays near
+    "workers" times "max_memory" whatever the size of those runs.
+
+    ".mat" files without NeuroDOT "data" and "info" variables (e.g.,
+    A-matrices or group results) are listed as 'ignored'.
+
+    Params:
+        :workers:    (CPUs)  Number of worker processes.
+        :max_memory: 4 GB    Memory budget per worker (0: none).
+        :formats:    (all)   Formats to ingest (see DISCOVER_RUNS).
+        :force:      False   Convert all runs, changed or not.
+        :verbose:    True    Print one line per run.
+        (plus the parameters of INGEST_RUN)
+
+    See Also: INGEST_RUN, DISCOVER_RUNS, INGEST_MAIN.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    root = os.path.abspath(root)
+    if out_dir is None:
+        out_dir = os.path.join(root, 'ndot')
+    out_dir = os.path.abspath(out_dir)
+    workers = int(params.get('workers', os.cpu_count() or 1))
+    force = bool(params.get('force', False))
+    verbose = bool(params.get('verbose', True))
+    run_params = {k: params[k] for k in ('dtype', 'max_memory', 'bthresh') if k in params}
+
+    os.makedirs(out_dir, exist_ok = True)
+    mfn = os.path.join(out_dir, 'manifest.json')
+    manifest = {'version': 1, 'root': root, 'runs': {}}
+    if os.path.isfile(mfn):
+        with open(mfn) as f:
+            manifest['runs'] = json.load(f).get('runs', {})
+
+    runs = [r for r in discover_runs(root, params.get('formats')) if not r[0].startswith(out_dir + os.sep)]
+    names = [os.path.relpath(path, root).replace(os.sep, '/') for path, _ in runs]
+    # Runs left out by "formats" keep their entries; only deleted sources are dropped.
+    manifest['runs'] = {k: v for k, v in manifest['runs'].items() if os.path.exists(os.path.join(root, k))}
+
+    ## Conversion in the worker pool.
+    with ProcessPoolExecutor(max_workers = max(1, workers)) as pool:
+        jobs = dict()
+        for (path, fmt), name in zip(runs, names):
+            previous = None if force else manifest['runs'].get(name)
+            jobs[pool.submit(_ingest_worker, path, fmt, os.path.join(out_dir, name + _OUT_EXT),
+                             run_params, previous)] = name
+        for job in as_completed(jobs):
+            name = jobs[job]
+            try:
+                entry = job.result()
+            except Exception as e: # e.g., a worker killed for running out of memory
+                entry = {'status': 'failed', 'error': type(e).__name__ + ': ' + str(e)}
+            entry['source'] = name
+            if 'output' in entry:
+                entry['output'] = os.path.relpath(entry['output'], out_dir).replace(os.sep, '/')
+            manifest['runs'][name] = entry
+            _write_manifest(mfn, manifest)
+            if verbose:
+                print(entry['status'].ljust(10) + name + ('' if not entry.get('error') else '  (' + entry['error'] + ')'))
+    _write_manifest(mfn, manifest)
+
+    return manifest
+
+
+def _parse_bytes(text):
+    # '512M', '4G', '1.5g' or a number of bytes.
+    text = str(text).strip().upper().rstrip('B')
+    scale = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    if text and text[-1] in scale:
+        return int(float(text[:-1]) * scale[text[-1]])
+    return int(float(text))
+
+
+def ingest_main(argv = None):
+    '''
+    INGEST_MAIN Command-line entry point of INGEST_STUDY (neurodot-ingest).
+
+    neurodot-ingest ROOT [-o OUT] [-j WORKERS] [-m MAX_MEMORY] [--dtype
+    DTYPE] [--bthresh BTHRESH] [--formats snirf,lumo,nirs,mat] [--force]
+
+    Returns 1 if any run failed, 0 otherwise.
+
+    See Also: INGEST_STUDY.
+    '''
+    parser = argparse.ArgumentParser(prog = 'neurodot-ingest',
+                                     description = 'Convert the SNIRF, LUMO, .nirs and .mat runs of a study '
+                                                   'into NeuroDOT files, with a manifest of the runs.')
+    parser.add_argument('root', help = 'study directory to search for runs')
+    parser.add_argument('-o', '--output', default = None, help = 'output directory (default: ROOT/ndot)')
+    parser.add_argument('-j', '--workers', type = int, default = os.cpu_count() or 1, help = 'worker processes')
+    parser.add_argument('-m', '--max-memory', default = '4G', help = 'memory budget per worker, e.g. 2G (0: none)')
+    parser.add_argument('--dtype', default = 'float32', help = 'type of the stored data')
+    parser.add_argument('--bthresh', type = float, default = 0.075, help = 'FindGoodMeas noise threshold')
+    parser.add_argument('--formats', default = None, help = 'comma-separated formats to ingest')
+    parser.add_argument('--force', action = 'store_true', help = 'convert unchanged runs again')
+    parser.add_argument('-q', '--quiet', action = 'store_true', help = 'print only the summary')
+    args = parser.parse_args(argv)
+
+    params = dict()
+    params['workers'] = args.workers
+    params['max_memory'] = _parse_bytes(args.max_memory)
+    params['dtype'] = args.dtype
+    params['bthresh'] = args.bthresh
+    if args.formats:
+        params['formats'] = [f.strip().lower() for f in args.formats.split(',')]
+    params['force'] = args.force
+    params['verbose'] = not args.quiet
+    manifest = ingest_study(args.root, args.output, params)
+
+    status = [e['status'] for e in manifest['runs'].values()]
+    print(', '.join(str(status.count(s)) + ' ' + s for s in ('converted', 'unchanged', 'ignored', 'failed')))
+
+    return 1 if 'failed' in status else 0
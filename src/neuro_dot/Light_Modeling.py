@@ -1,6 +1,9 @@
 # General imports
 import sys
 import math
+import os
+import time
+import concurrent.futures as cf
 
 import scipy.io as spio
 import scipy.signal as sig
@@ -14,6 +17,9 @@ import sympy as sym
 import scipy.optimize as ops
 import scipy.ndimage as ndi
 import scipy.interpolate
+import scipy.sparse as sps
+import scipy.sparse.linalg as spla
+import scipy.spatial as spt
 import numpy.matlib as mlb
 import numpy.matlib as nm
 import functools as ft
@@ -28,44 +34,65 @@ from numpy.linalg import norm
 import neuro_dot as ndot
 
 
-def calc_NN(info_in, dr):
+def calc_NN(info_in, dr, edges = None, dist = 'r3d', return_idx = False):
     '''
     CALC_NN Calculates the Nearest Neigbor value for all measurement pairs.
 
     Inputs:
         :info_in: info structure containing data measurement list
         :dr: minimum separation for sources and detectors to be grouped into. (default = 10 mm) NOTE: distances are in millimeters
+        :edges: optional custom bin edges (mm, ascending). Pairs with edges[k] <= r < edges[k+1] fall in bin k.
+            Default: [0, 2*dr, 3*dr, ...] when dr > 9, otherwise [0, dr, 2*dr, ...].
+        :dist: separation used for the classification, 'r3d' (default) or 'r2d'
+        :return_idx: if True, also return the per-NN index lists
         
     Outputs:
         :info_out: info structure containing updated data measurement list with "info.pairs.NN"
+        :NNidx: (only if return_idx) list where NNidx[k-1] holds the measurement indices with NN == k
+
+    Each occupied bin is numbered consecutively (empty bins are skipped), so
+    NN == 1 is the shortest occupied separation bin. Pairs outside all
+    bins get NN = 0. All pairs are classified in a single pass.
     '''
     ## Parameters and Initialization
     info_out = info_in
     if dr is None:
         dr = 10 #default = 10mm minimum separation for SD to be grouped into different neighbors
-    Nm = len(info_in['pairs']['r3d'])
-    NN=np.zeros((Nm)) #initialize NN vector
+    r = np.asarray(info_in['pairs'][dist], dtype = np.float64).ravel()
+    Nm = len(r)
+    NN = np.zeros((Nm)) #initialize NN vector
+    if Nm == 0:
+        info_out['pairs']['NN'] = NN
+        return (info_out, []) if return_idx else info_out
+
+    ## Bin edges
+    RadMaxR = np.ceil(np.max(r)) #maximum SD separation across all SD pairs
+    if edges is None:
+        edges = np.arange(0, np.max(r) + 2 * dr, dr)
+        if dr > 9: # first neighbor spans [0, 2*dr)
+            edges = np.delete(edges, 1)
+        custom = False
+    else:
+        edges = np.sort(np.asarray(edges, dtype = np.float64).ravel())
+        custom = True
+
     ## Calculate NN's
-    RadMaxR=np.ceil(np.max(info_in['pairs']['r3d'])) #maximum SD separation across all SD pairs
-    d=0; # s-d distance
-    c=0; # which nn are we on?
-    while np.any(info_in['pairs']['r3d']>d): # as long as there are still s-d pairs left to group
-        if ((d==0) & (dr>9)):
-            nnkeep=np.argwhere(np.logical_and(np.where(info_in['pairs']['r3d']>=d,1,0), np.where(info_in['pairs']['r3d']<(d+(2*dr)),1,0)))
-            d=d+dr
-            nnkeep = nnkeep[:,0]
-        else:            
-            nnkeep=np.argwhere(np.logical_and(np.where(info_in['pairs']['r3d']>=d,1,0), np.where(info_in['pairs']['r3d']<(d+dr),1,0)))
-            nnkeep = nnkeep[:,0]
-        # find pairs within 1 mm range
-        if nnkeep != []: # if we find pairs
-            c=c+1 # increment nn count
-            NN[nnkeep]=c
-            if c>RadMaxR: 
-                break # stop at nn9
-        d=d+dr # incremement search distance
-    info_out['pairs']['NN']=NN
-    return info_out
+    b = np.searchsorted(edges, r, side = 'right') - 1 # bin of every pair
+    valid = np.logical_and(b >= 0, b < len(edges) - 1)
+    occupied = np.unique(b[valid])
+    NN[valid] = np.searchsorted(occupied, b[valid]) + 1 # consecutive numbering of occupied bins
+    if not custom:
+        NN[NN > RadMaxR + 1] = 0 # stop at nn RadMaxR+1
+    info_out['pairs']['NN'] = NN
+
+    if not return_idx:
+        return info_out
+
+    ## Per-NN index lists
+    NNint = NN.astype(np.int64)
+    counts = np.bincount(NNint)
+    NNidx = np.split(np.argsort(NNint, kind = 'stable'), np.cumsum(counts)[:-1])[1:]
+    return info_out, NNidx
 
 def Generate_pad_from_grid(grid, params, info):
     '''
@@ -78,6 +105,10 @@ def Generate_pad_from_grid(grid, params, info):
     The input: "params" can be used to pass in mod type (default is 'CW'
     but can be the modulation frequency if fd) and wavelength(s) of the 
     data in field 'lambda'.
+
+    The input: "info" is not modified. Its fields (including any existing
+    "optodes" entries) are carried over to the output, whose "optodes"
+    are updated from "grid" and whose "pairs" are rebuilt.
     
     Params:
         :dr: Minimum separation for sources and detectors to be grouped into different neighbors.
@@ -88,6 +119,11 @@ def Generate_pad_from_grid(grid, params, info):
             Defaults to 0, where 3D coordinates are used. 
             If set to 1, 2D coordinates will be used for NN classification.
         :CapName: Name for your pad file.
+        :NNedges: Optional custom NN bin edges passed to CALC_NN.
+        :rmax: Optional maximum 3D source-detector separation. Pairs farther
+            apart are never generated. Default: none (all Ns*Nd pairs).
+
+    Measurements are ordered by wavelength, then detector, then source.
     '''
     ## Parameters and Initialization
 
@@ -98,115 +134,100 @@ def Generate_pad_from_grid(grid, params, info):
         params = dict()
     if not('dr' in params):
         params['dr']=10 # defaults to 10mm
-    else:
-        dr = params['dr']
-    if params['lambda'] is None:
+    if params.get('lambda') is None:
         params['lambda'] = [750,850]
     if not('Mod' in params):
         params['Mod'] = 'CW'
     if not('pos2' in params):
         params['pos2'] = 0
+    rmax = params.get('rmax')
 
     # Optode positions
     # Make generalizable (can be either 2D or 3D) optode pos
     # Defaults to 3D pos if 2D pos not part of input grid structure
     if not('spos' in grid):
-        if 'spos2' in grid and 'spos2'!= None:
+        if grid.get('spos2') is not None:
             grid['spos'] = grid['spos2']
         else:
             grid['spos'] = grid['spos3']
-    
 
-    if 'dpos' in grid:
-        if 'dpos2' in grid and 'dpos2'!= None:
+    if not('dpos' in grid):
+        if grid.get('dpos2') is not None:
             grid['dpos'] = grid['dpos2']
         else:
             grid['dpos'] = grid['dpos3']
     # If 3D not supplied as input, set to 2D pos where col3 is all zeros
     if not('spos3' in grid):
-        zarray = np.zeros(len(grid['spos']),1)
-        grid['spos3'] = np.hstack(grid['spos'],zarray)
+        grid['spos3'] = np.hstack((grid['spos'][:, 0:2], np.zeros((len(grid['spos']), 1))))
     
     if not('dpos3' in grid):
-        zarray = np.zeros(len(grid['spos']),1)
-        grid['dpos3'] = np.hstack(grid['dpos'],zarray)
+        grid['dpos3'] = np.hstack((grid['dpos'][:, 0:2], np.zeros((len(grid['dpos']), 1))))
 
-    # Calculate number of sources, detectors, measurements, and wavelengths
+    # Calculate number of sources, detectors and wavelengths
     Ns = np.shape(grid['spos3'])[0]
     Nd = np.shape(grid['dpos3'])[0]
-    Nm = Ns*Nd
     Nwl = len(params['lambda'])
 
-    # Initialize SD separations and measurement list
-    # Note: these are all for a single wavelength, and will get replicated 
-    #   in a below section of the function for all other WL
-    r2 = np.zeros((Nm,1)) #2D SD separations
-    r3 = np.zeros((Nm,1)) #3D SD separations
-    measList = np.zeros((Nm,2)) #basic measurement list that only has [Src, Det]
-
 
     ## Populate info.optodes structure
+    # Shallow copies so the caller's info is left untouched
+    info = dict(info)
+    info['optodes'] = dict(info.get('optodes', {}))
 
     # Detectors
     if 'CapName' in params:
         info['optodes']['CapName'] = params['CapName']
-    if 'dpos3' in grid:
-        info['optodes']['dpos3'] = grid['dpos3']
-    if 'dpos2' in grid and 'dpos2' != None: # if 2d detector positions and dpos2 isn't none
+    info['optodes']['dpos3'] = grid['dpos3']
+    if grid.get('dpos2') is not None: # if 2d detector positions are given
         info['optodes']['dpos2'] = grid['dpos2']
-    elif 'dpos' in grid: # if no 2d detector positions and dpos is there
+    else:                             # otherwise use dpos (2D if present, else 3D)
         info['optodes']['dpos2'] = grid['dpos']
-    else:           
-        info['optodes']['dpos2'] = grid['dpos3'] # if no 2d detector pos and no dpos
-    
 
     # Sources
-    if 'spos3' in grid:
-        info['optodes']['spos3'] = grid['spos3']
-    if 'spos2' in grid and 'spos2'!= None:
+    info['optodes']['spos3'] = grid['spos3']
+    if grid.get('spos2') is not None:
         info['optodes']['spos2'] = grid['spos2']
-    elif 'spos' in grid:
-        info['optodes']['spos2'] = grid['spos']
     else:
-        info['optodes']['spos2'] = grid['spos3']
+        info['optodes']['spos2'] = grid['spos']
 
     ## Make Measlist, r3d, and r2d
-    m = 0
-
-    for d in range(1, Nd+1):# 1:Nd:
-        for s in range(1, Ns+1):#= 1:Ns
-            measList[m,0] = s
-            measList[m,1] = d
-            r2[m] = norm(info['optodes']['spos2'][s-1,:]-info['optodes']['dpos2'][d-1,:])
-            # print('R2: ', r2)
-            r3[m] = norm(info['optodes']['spos3'][s-1,:]-info['optodes']['dpos3'][d-1,:])
-            m+=1
-
-    ## Populate info.pairs structure
-    info = dict()
+    spos3 = np.asarray(info['optodes']['spos3'], dtype = np.float64)
+    dpos3 = np.asarray(info['optodes']['dpos3'], dtype = np.float64)
+    spos2 = np.asarray(info['optodes']['spos2'], dtype = np.float64)
+    dpos2 = np.asarray(info['optodes']['dpos2'], dtype = np.float64)
+    if rmax is None:
+        # Full Nd x Ns distance kernels, raveled detector-major
+        r3 = spt.distance.cdist(dpos3, spos3).ravel()
+        r2 = spt.distance.cdist(dpos2, spos2).ravel()
+        det, src = np.divmod(np.arange(Nd * Ns), Ns)
+    else:
+        # Only pairs within rmax are ever generated
+        near = spt.cKDTree(dpos3).sparse_distance_matrix(spt.cKDTree(spos3), rmax, output_type = 'ndarray')
+        order = np.lexsort((near['j'], near['i']))
+        det = near['i'][order].astype(np.int64)
+        src = near['j'][order].astype(np.int64)
+        r3 = near['v'][order]
+        r2 = np.sqrt(np.sum((spos2[src, :] - dpos2[det, :])**2, axis = 1))
+    Nm = len(src)
+
+    ## Populate info.pairs structure, replicated for each wavelength
     info['pairs'] = dict()
-    info['pairs']['Src'] = np.tile(measList[:,0],[Nwl,1]).flatten()
-    print('src in generate pad from grid: ', info['pairs']['Src'])
-    info['pairs']['Det'] = np.tile(measList[:,1],[Nwl,1]).flatten()
+    info['pairs']['Src'] = np.tile(src + 1, Nwl).astype(np.float64)
+    info['pairs']['Det'] = np.tile(det + 1, Nwl).astype(np.float64)
     # info.pairs.NN will be created and populated below
-    narray = np.zeros(np.size(info['pairs']['Src']))
-    narray2 = np.zeros(np.size(info['pairs']['Src']))
-    narray[:] = np.nan
-    narray2[:] = np.nan
-    info['pairs']['WL'] = narray2
-    info['pairs']['lambda'] = narray
+    info['pairs']['WL'] = np.repeat(np.arange(1, Nwl + 1), Nm).astype(np.float64)
+    info['pairs']['lambda'] = np.repeat(np.asarray(params['lambda'], dtype = np.float64), Nm)
     info['pairs']['Mod'] = np.tile(params['Mod'],[Nm*Nwl,1])
-    info['pairs']['r2d'] = np.tile(r2,[Nwl,1])
-    info['pairs']['r3d'] = np.tile(r3,[Nwl,1])
-
-    # Make sure WL and Lambda reflect both wavelengths
-    for j in range(1, Nwl+1): 
-        info['pairs']['WL'][Nm*(j-1):Nm*j] = np.multiply(np.ones((Nm)),j)
-        info['pairs']['lambda'][Nm*(j-1)+1:Nm*j] = params['lambda'][j-1]
+    info['pairs']['r2d'] = np.tile(np.reshape(r2, (Nm, 1)),[Nwl,1])
+    info['pairs']['r3d'] = np.tile(np.reshape(r3, (Nm, 1)),[Nwl,1])
 
 
     ## Populate NN's 
-    info = ndot.calc_NN(info,params['dr']) #updated number of measurment calculation within calc_NN to be based on length of r3d
+    if params['pos2']:
+        dist = 'r2d'
+    else:
+        dist = 'r3d'
+    info = ndot.calc_NN(info, params['dr'], params.get('NNedges'), dist) #updated number of measurment calculation within calc_NN to be based on length of r3d
 
     return info
     
@@ -215,7 +236,7 @@ def makeFlatFieldRecon(A, iA):
     MAKEFLATFIELDRECON Generates the flat field reconstruction of a given "A" sensitivity matrix.
 
     Inputs:
-        :A: "A" sensitivity matrix
+        :A: "A" sensitivity matrix (dense array or scipy.sparse matrix)
         :iA: inverted "A" sensitivity matrix
     
     Outputs:
@@ -225,9 +246,848 @@ def makeFlatFieldRecon(A, iA):
     ff = np.ones(shape = (np.shape(A)[1], 1))
 
     ## Simulated Measurements
-    ysim = A.astype(np.float64) @ ff.astype(np.float64)
+    if sps.issparse(A):
+        ysim = np.asarray(A.astype(np.float64) @ ff) # Scales with nnz(A)
+    else:
+        ysim = A.astype(np.float64) @ ff.astype(np.float64)
 
     ## Flat Field Reconstruction
     Asens = iA.astype(np.float64) @ ysim.astype(np.float64)
 
-    return Asens
\ No newline at end of file
+    return Asens
+
+
+def diffusion_Green(src, pts, mua, musp, params = None):
+    '''
+    DIFFUSION_GREEN Evaluates the diffusion-approximation Green's function of a homogeneous half space or slab.
+
+    G = DIFFUSION_GREEN(src, pts, mua, musp) returns the Ns x Npts fluence
+    "G" at the points "pts" due to unit point sources entering the medium
+    at "src". Both are given in a local frame where the first two columns
+    are lateral coordinates (mm) and the third column is the depth below
+    the surface (mm). Each source is placed one transport mean free path
+    (1/musp) below its surface position, and the boundary is handled with
+    the extrapolated-boundary method of images. "mua" and "musp" are the
+    absorption and reduced scattering coefficients in mm^-1.
+
+    G = DIFFUSION_GREEN(src, pts, mua, musp, params) allows the user to
+    specify parameters.
+
+    Params:
+        :n:         1.4             Refractive index of the medium.
+        :fmod:      0               Modulation frequency in MHz. If
+                                    nonzero, "G" is complex
+                                    (frequency domain).
+        :geometry:  'semi-infinite' 'semi-infinite' or 'slab'.
+        :thickness: (none)          Slab thickness in mm (required for
+                                    'slab').
+        :Nimages:   10              Number of image-source pairs on each
+                                    side of the slab.
+        :rmin:      0.5             Minimum distance (mm) to any source or
+                                    image, regularizing the singularity
+                                    at the source.
+
+    See Also: MAKEA_DIFFUSION.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    n = params.get('n', 1.4)
+    fmod = params.get('fmod', 0)
+    geometry = params.get('geometry', 'semi-infinite')
+    c = 2.99792458e11 / n                                       # Speed of light in the medium (mm/s)
+
+    D = 1 / (3 * (mua + musp))
+    omega = 2 * np.pi * fmod * 1e6
+    k = np.sqrt((mua + 1j * omega / c) / D) if fmod else np.sqrt(mua / D)
+    Reff = -1.440 / n**2 + 0.710 / n + 0.668 + 0.0636 * n       # Effective reflection coefficient
+    zb = 2 * D * (1 + Reff) / (1 - Reff)                        # Extrapolated boundary distance
+    z0 = 1 / musp                                               # Isotropic source depth
+    rmin = params.get('rmin', 0.5)
+
+    ## Image sources.
+    if geometry == 'semi-infinite':
+        zpos = np.array([z0])
+        zneg = np.array([-z0 - 2 * zb])
+    elif geometry == 'slab':
+        if params.get('thickness') is None:
+            raise ValueError('Error: params["thickness"] is required for a slab geometry.')
+        L = params['thickness']
+        m = np.arange(-params.get('Nimages', 10), params.get('Nimages', 10) + 1)
+        zpos = 2 * m * (L + 2 * zb) + z0
+        zneg = 2 * m * (L + 2 * zb) - 2 * zb - z0
+    else:
+        raise ValueError("Error: geometry must be 'semi-infinite' or 'slab'.")
+
+    ## Sum image contributions (lateral distance computed once).
+    src = np.atleast_2d(np.asarray(src, dtype = np.float64))
+    pts = np.atleast_2d(np.asarray(pts, dtype = np.float64))
+    rho2 = spt.distance.cdist(src[:, 0:2], pts[:, 0:2], 'sqeuclidean')
+    depth = pts[None, :, 2] - src[:, None, 2]
+    G = np.zeros(np.shape(rho2), dtype = np.complex128 if fmod else np.float64)
+    for zp, zn in zip(zpos, zneg):
+        rp = np.maximum(np.sqrt(rho2 + (depth - zp)**2), rmin)
+        rn = np.maximum(np.sqrt(rho2 + (depth - zn)**2), rmin)
+        G = G + np.exp(-k * rp) / rp - np.exp(-k * rn) / rn
+    G = G / (4 * np.pi * D)
+
+    if geometry == 'slab':
+        G[:, np.logical_or(pts[:, 2] < 0, pts[:, 2] > params['thickness'])] = 0
+    else:
+        G[:, pts[:, 2] < 0] = 0
+
+    return G
+
+
+def makeA_diffusion(info, dim, params = None):
+    '''
+    MAKEA_DIFFUSION Generates a sensitivity "A" matrix from an analytic diffusion forward model.
+
+    [A, infoA] = MAKEA_DIFFUSION(info, dim, params) computes the MEAS x VOX
+    sensitivity matrix "A" for the measurement list in "info.pairs" (Src,
+    Det, WL), the optode positions "info.optodes.spos3/dpos3" and the
+    voxels "dim.Good_Vox" of the voxel space "dim" (all voxels if Good_Vox
+    is absent), for a homogeneous semi-infinite or slab medium.
+    Optode and voxel coordinates must be in the same space (see
+    GOODVOX_COORDS). The output "infoA" holds "tissue.dim", "pairs" and
+    "optodes", as in the A-matrix files used by the reconstruction
+    pipeline.
+
+    With the default Rytov sensitivity, row m of "A" is
+        A(m, j) = G(rs, rj) * G(rj, rd) / G(rs, rd) * dV
+    so that the logmean data y = -log(Phi/Phi_0) satisfies y = A * dmua.
+    Sources and (adjoint) detectors are both placed 1/musp below the
+    surface, so the rows of "A" sum to the mean partial path length.
+    In the frequency domain "A" is complex; TIKHONOV_INVERT_AMAT splits it
+    into [Re; Im] rows to match the output of LOGMEAN.
+
+    Params:
+        :mua:       0.01            Absorption coefficient per wavelength
+                                    (mm^-1), indexed by info.pairs.WL.
+        :musp:      1.0             Reduced scattering per wavelength
+                                    (mm^-1), indexed by info.pairs.WL.
+        :sens:      'rytov'         'rytov' or 'born' (A = Gs * Gd * dV).
+        :normal:    [0, 0, -1]      Unit vector pointing into the tissue.
+                                    The surface is the plane normal to it
+                                    through the mean optode position;
+                                    optodes are projected onto it.
+        :rmin:      (half voxel)    Singularity cutoff of DIFFUSION_GREEN.
+        :chunk:     4096            Number of voxels per work unit.
+        :workers:   (cpu count)     Number of worker processes. Use 1 to
+                                    run in the current process.
+        (plus the n, fmod, geometry, thickness and Nimages parameters
+        of DIFFUSION_GREEN)
+
+    See Also: DIFFUSION_GREEN, TIKHONOV_INVERT_AMAT, GOODVOX_COORDS.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    sens = params.get('sens', 'rytov')
+    if sens not in ('rytov', 'born'):
+        raise ValueError("Error: sens must be 'rytov' or 'born'.")
+    chunk = int(params.get('chunk', 4096))
+    workers = params.get('workers', None)
+
+    dim = dict(dim)
+    if 'Good_Vox' not in dim:
+        dim['Good_Vox'] = np.arange(1, int(dim['nVx']) * int(dim['nVy']) * int(dim['nVz']) + 1)
+    if 'mmppix' in dim:
+        dV = np.prod(np.abs(np.asarray(dim['mmppix'], dtype = np.float64)))
+    else:
+        dV = float(dim['sV'])**3
+
+    Src = np.asarray(info['pairs']['Src']).astype(int).ravel() - 1
+    Det = np.asarray(info['pairs']['Det']).astype(int).ravel() - 1
+    WL = np.asarray(info['pairs']['WL']).astype(int).ravel() - 1
+    Nwl = WL.max() + 1
+    mua = np.broadcast_to(np.asarray(params.get('mua', 0.01), dtype = np.float64), (Nwl,))
+    musp = np.broadcast_to(np.asarray(params.get('musp', 1.0), dtype = np.float64), (Nwl,))
+
+    ## Local frame: two lateral axes and depth along the inward normal.
+    normal = np.asarray(params.get('normal', [0, 0, -1]), dtype = np.float64)
+    normal = normal / np.linalg.norm(normal)
+    ax1 = np.cross(normal, [1, 0, 0] if abs(normal[0]) < 0.9 else [0, 1, 0])
+    ax1 = ax1 / np.linalg.norm(ax1)
+    ax2 = np.cross(normal, ax1)
+    R = np.stack((ax1, ax2, normal), axis = 1)
+    spos = np.asarray(info['optodes']['spos3'], dtype = np.float64) @ R
+    dpos = np.asarray(info['optodes']['dpos3'], dtype = np.float64) @ R
+    surf = np.mean(np.concatenate((spos[:, 2], dpos[:, 2])))
+    spos[:, 2] = 0
+    dpos[:, 2] = 0
+    vox = ndot.GoodVox_coords(dim) @ R
+    vox[:, 2] = vox[:, 2] - surf
+
+    gparams = {key: params[key] for key in ('n', 'fmod', 'geometry', 'thickness', 'Nimages') if key in params}
+    gparams['rmin'] = params.get('rmin', 0.5 * dV**(1 / 3))
+
+    ## Source-detector fluence for Rytov normalization.
+    Gsd = np.ones(len(Src), dtype = np.complex128 if params.get('fmod', 0) else np.float64)
+    if sens == 'rytov':
+        for w in range(0, Nwl):
+            m = WL == w
+            if np.any(m):
+                dpt = dpos.copy()
+                dpt[:, 2] = 1 / musp[w] # Adjoint source depth
+                G = diffusion_Green(spos, dpt, mua[w], musp[w], gparams) # Ns x Nd
+                Gsd[m] = G[Src[m], Det[m]]
+
+    ## Evaluate voxel chunks, in parallel if requested.
+    jobs = [(vox[k:k + chunk, :], spos, dpos, Src, Det, WL, mua, musp, Gsd, dV, gparams) for k in range(0, np.shape(vox)[0], chunk)]
+    if workers == 1 or len(jobs) == 1:
+        blocks = [_makeA_diffusion_chunk(job) for job in jobs]
+    else:
+        with cf.ProcessPoolExecutor(max_workers = workers) as pool:
+            blocks = list(pool.map(_makeA_diffusion_chunk, jobs))
+    A = np.concatenate(blocks, axis = 1)
+
+    ## Output structure.
+    infoA = dict()
+    infoA['tissue'] = {'dim': dim}
+    infoA['pairs'] = info['pairs']
+    infoA['optodes'] = info['optodes']
+
+    return A, infoA
+
+
+def _makeA_diffusion_chunk(job):
+    # One MAKEA_DIFFUSION work unit: A columns for a chunk of voxels (module level so it can be pickled).
+    vox, spos, dpos, Src, Det, WL, mua, musp, Gsd, dV, gparams = job
+    block = np.zeros((len(Src), np.shape(vox)[0]), dtype = Gsd.dtype)
+    for w in range(0, len(mua)):
+        m = WL == w
+        if not np.any(m):
+            continue
+        Gs = diffusion_Green(spos, vox, mua[w], musp[w], gparams)
+        Gd = diffusion_Green(dpos, vox, mua[w], musp[w], gparams)
+        block[m, :] = Gs[Src[m], :] * Gd[Det[m], :] / Gsd[m, None] * dV
+    return block
+
+
+
+def mesh_from_segmentation(seg, dim, params = None):
+    '''
+    MESH_FROM_SEGMENTATION Builds a tetrahedral mesh from a segmented (labeled) volume.
+
+    mesh = MESH_FROM_SEGMENTATION(seg, dim) splits every voxel of the
+    X x Y x Z label volume "seg" with a nonzero label (e.g., the
+    Segmented_MNI152nl atlases) into six tetrahedra sharing its corners.
+    All voxels use the same split, so the mesh is conforming. Node
+    coordinates follow the voxel-space convention of "dim" (mmppix and
+    center, see GOODVOX_COORDS; dim.sV scaling otherwise). The output
+    structure "mesh" contains:
+        :nodes:    Nn x 3 node coordinates (mm).
+        :elements: Ne x 4 node indices (1-based, as in NeuroDOT meshes).
+        :region:   Ne x 1 tissue label of each element.
+
+    mesh = MESH_FROM_SEGMENTATION(seg, dim, params) allows the user to
+    specify parameters.
+
+    Params:
+        :step:   1       Use every "step"-th voxel along each axis (coarser
+                         mesh with step-times larger elements).
+        :labels: (all)   Labels to include in the mesh.
+
+    See Also: MAKEA_FEM, GOODVOX_COORDS.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    step = int(params.get('step', 1))
+    seg = np.asarray(seg)[::step, ::step, ::step]
+    if 'labels' in params:
+        inmesh = np.isin(seg, params['labels'])
+    else:
+        inmesh = seg > 0
+    nV = np.array(np.shape(seg))
+    if 'mmppix' in dim and 'center' in dim:
+        dr = np.asarray(dim['mmppix'], dtype = np.float64) * step
+        center = np.asarray(dim['center'], dtype = np.float64) - np.asarray(dim['mmppix'], dtype = np.float64) * (np.array([int(dim['nVx']), int(dim['nVy']), int(dim['nVz'])]) - step * nV)
+    else:
+        dr = -np.full(3, float(dim['sV']) * step)
+        center = dr * nV
+
+    ## Corners of every included voxel, numbered on the (nV+1) corner grid.
+    ijk = np.argwhere(inmesh)
+    region = seg[inmesh]
+    offsets = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0], [0, 0, 1], [1, 0, 1], [0, 1, 1], [1, 1, 1]])
+    corners = ijk[:, None, :] + offsets[None, :, :]
+    cid = corners[:, :, 0] + (nV[0] + 1) * (corners[:, :, 1] + (nV[1] + 1) * corners[:, :, 2])
+    uid, inv = np.unique(cid.ravel(), return_inverse = True)
+    inv = np.reshape(inv, np.shape(cid))
+    cijk = np.transpose(np.array(np.unravel_index(uid, nV + 1, order = 'F'), dtype = np.float64))
+    nodes = dr * (nV - (cijk - 0.5)) - center
+
+    ## Kuhn split of each cube into six tetrahedra (paths 000 -> 111).
+    kuhn = np.array([[0, 1, 3, 7], [0, 1, 5, 7], [0, 2, 3, 7], [0, 2, 6, 7], [0, 4, 5, 7], [0, 4, 6, 7]])
+    elements = np.reshape(inv[:, kuhn], (-1, 4))
+
+    mesh = dict()
+    mesh['nodes'] = nodes
+    mesh['elements'] = elements + 1
+    mesh['region'] = np.repeat(region, 6)
+
+    return mesh
+
+
+def mesh_interp_matrix(mesh, pts, Ncand = 16):
+    '''
+    MESH_INTERP_MATRIX Builds a sparse linear-interpolation operator from mesh nodes to points.
+
+    P = MESH_INTERP_MATRIX(mesh, pts) returns the Npts x Nn sparse matrix
+    "P" of barycentric weights, so that P * f interpolates the nodal
+    field f at the points "pts" (Npts x 3). Points outside the mesh get an
+    all-zero row. Candidate elements are found with a KD-tree over element
+    centroids ("Ncand" nearest per point).
+
+    See Also: MAKEA_FEM, MESH_FROM_SEGMENTATION.
+    '''
+    nodes = np.asarray(mesh['nodes'], dtype = np.float64)
+    elem = np.asarray(mesh['elements']).astype(np.int64) - 1
+    pts = np.atleast_2d(np.asarray(pts, dtype = np.float64))
+    Npts = np.shape(pts)[0]
+    Ncand = min(Ncand, np.shape(elem)[0])
+
+    ## Inverse affine map of every element.
+    X0 = nodes[elem[:, 0], :]
+    T = np.stack((nodes[elem[:, 1], :] - X0, nodes[elem[:, 2], :] - X0, nodes[elem[:, 3], :] - X0), axis = 2)
+    iT = np.linalg.inv(T)
+
+    ## Barycentric coordinates in the nearest candidate elements.
+    _, cand = spt.cKDTree(np.mean(nodes[elem, :], axis = 1)).query(pts, k = Ncand)
+    cand = np.reshape(cand, (Npts, Ncand))
+    lam = np.einsum('pcij,pcj->pci', iT[cand], pts[:, None, :] - X0[cand])
+    bary = np.concatenate((1 - np.sum(lam, axis = 2, keepdims = True), lam), axis = 2)
+    inside = np.all(bary >= -1e-9, axis = 2)
+    found = np.any(inside, axis = 1)
+    first = np.argmax(inside, axis = 1)
+    e = cand[np.arange(Npts), first]
+    w = bary[np.arange(Npts), first, :]
+
+    rows = np.repeat(np.flatnonzero(found), 4)
+    cols = elem[e[found], :].ravel()
+    P = sps.csr_matrix((w[found, :].ravel(), (rows, cols)), shape = (Npts, np.shape(nodes)[0]))
+
+    return P
+
+
+def FEM_diffusion_system(mesh, mua, musp, params = None):
+    '''
+    FEM_DIFFUSION_SYSTEM Assembles the sparse finite-element diffusion system of a tetrahedral mesh.
+
+    [K, info_fem] = FEM_DIFFUSION_SYSTEM(mesh, mua, musp) assembles the
+    Nn x Nn sparse matrix "K" of the diffusion equation
+        -div(D grad(Phi)) + (mua + i*omega/c) Phi = q
+    with linear elements and a Robin (partial current) boundary condition,
+    from per-element absorption "mua" and reduced scattering "musp"
+    (mm^-1, scalars or Ne x 1). "info_fem" contains the boundary faces,
+    their outward normals, the lumped nodal volumes ("Vn") and the
+    diffusion coefficient per element.
+
+    Params:
+        :n:    1.4  Refractive index.
+        :fmod: 0    Modulation frequency in MHz (complex system if nonzero).
+
+    See Also: MAKEA_FEM.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    n = params.get('n', 1.4)
+    fmod = params.get('fmod', 0)
+    c = 2.99792458e11 / n
+    nodes = np.asarray(mesh['nodes'], dtype = np.float64)
+    elem = np.asarray(mesh['elements']).astype(np.int64) - 1
+    Nn = np.shape(nodes)[0]
+    Ne = np.shape(elem)[0]
+    mua = np.broadcast_to(np.asarray(mua, dtype = np.float64).ravel(), (Ne,))
+    musp = np.broadcast_to(np.asarray(musp, dtype = np.float64).ravel(), (Ne,))
+    D = 1 / (3 * (mua + musp))
+    kappa = mua + 1j * 2 * np.pi * fmod * 1e6 / c if fmod else mua
+
+    ## Element volumes and basis gradients.
+    X0 = nodes[elem[:, 0], :]
+    T = np.stack((nodes[elem[:, 1], :] - X0, nodes[elem[:, 2], :] - X0, nodes[elem[:, 3], :] - X0), axis = 1)
+    V = np.abs(np.linalg.det(T)) / 6
+    g = np.linalg.inv(T)                                            # columns: grads of basis 1..3
+    grads = np.concatenate((-np.sum(g, axis = 2, keepdims = True), g), axis = 2)   # Ne x 3 x 4
+
+    ## Stiffness and mass contributions.
+    Ke = (D * V)[:, None, None] * np.einsum('eki,ekj->eij', grads, grads)
+    Me = (V / 20)[:, None, None] * (np.ones((4, 4)) + np.eye(4))[None, :, :]
+    Ae = Ke + kappa[:, None, None] * Me
+    rows = np.repeat(elem, 4, axis = 1).ravel()
+    cols = np.tile(elem, (1, 4)).ravel()
+
+    ## Boundary faces (faces owned by a single element) and outward normals.
+    fidx = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])
+    faces = np.reshape(elem[:, fidx], (-1, 3))
+    opp = np.reshape(elem, (-1,))
+    sfaces = np.sort(faces, axis = 1)
+    _, first, counts = np.unique(sfaces, axis = 0, return_index = True, return_counts = True)
+    bf = first[counts == 1]
+    bfaces = faces[bf, :]
+    bopp = opp[bf]
+    a = nodes[bfaces[:, 0], :]
+    nrm = np.cross(nodes[bfaces[:, 1], :] - a, nodes[bfaces[:, 2], :] - a)
+    area = np.linalg.norm(nrm, axis = 1) / 2
+    flip = np.sum(nrm * (nodes[bopp, :] - a), axis = 1) > 0
+    nrm[flip, :] = -nrm[flip, :]
+    nrm = nrm / (2 * area[:, None])
+
+    ## Robin boundary term: Phi + 2*A*D*dPhi/dn = 0.
+    Reff = -1.440 / n**2 + 0.710 / n + 0.668 + 0.0636 * n
+    Acoef = (1 + Reff) / (1 - Reff)
+    Be = (area / 12 / (2 * Acoef))[:, None, None] * (np.ones((3, 3)) + np.eye(3))[None, :, :]
+    rows = np.concatenate((rows, np.repeat(bfaces, 3, axis = 1).ravel()))
+    cols = np.concatenate((cols, np.tile(bfaces, (1, 3)).ravel()))
+    vals = np.concatenate((Ae.ravel(), Be.ravel()))
+    K = sps.csc_matrix((vals, (rows, cols)), shape = (Nn, Nn))
+
+    ## Lumped nodal volumes.
+    Vn = np.bincount(elem.ravel(), weights = np.repeat(V / 4, 4), minlength = Nn)
+
+    info_fem = dict()
+    info_fem['bfaces'] = bfaces
+    info_fem['bnormals'] = nrm
+    info_fem['Vn'] = Vn
+    info_fem['D'] = D
+
+    return K, info_fem
+
+
+def makeA_FEM(mesh, info, dim, params = None):
+    '''
+    MAKEA_FEM Generates a sensitivity "A" matrix with a finite-element diffusion model on a head mesh.
+
+    [A, infoA] = MAKEA_FEM(mesh, info, dim, params) computes the MEAS x VOX
+    Rytov sensitivity matrix "A" for the measurement list in "info.pairs"
+    and optode positions "info.optodes.spos3/dpos3", on the tetrahedral
+    "mesh" (see MESH_FROM_SEGMENTATION), sampled on the voxels
+    "dim.Good_Vox" of the voxel space "dim" so that it can be passed to
+    TIKHONOV_INVERT_AMAT.
+
+    For each wavelength the FEM system is assembled and LU-factorized
+    once; all source fields and all adjoint (detector) fields are then
+    obtained from that single factorization. Each optode is snapped to
+    the nearest boundary node and moved 1/musp inside along the inward
+    normal. The sensitivity density of measurement m at each node is
+        Phi_s * Phi_d / Phi_sd,
+    which is interpolated to the voxel centers and multiplied by the
+    voxel volume.
+
+    Params:
+        :mua:   0.01    Absorption (mm^-1). Scalar, 1 x WL, or
+                        LABEL x WL (row = element region label).
+        :musp:  1.0     Reduced scattering (mm^-1), same shapes as mua.
+        :chunk: 1024    Measurements per Jacobian block.
+        (plus the n and fmod parameters of FEM_DIFFUSION_SYSTEM)
+
+    See Also: FEM_DIFFUSION_SYSTEM, MESH_FROM_SEGMENTATION, MAKEA_DIFFUSION.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    chunk = int(params.get('chunk', 1024))
+    dim = dict(dim)
+    if 'Good_Vox' not in dim:
+        dim['Good_Vox'] = np.arange(1, int(dim['nVx']) * int(dim['nVy']) * int(dim['nVz']) + 1)
+    if 'mmppix' in dim:
+        dV = np.prod(np.abs(np.asarray(dim['mmppix'], dtype = np.float64)))
+    else:
+        dV = float(dim['sV'])**3
+
+    Src = np.asarray(info['pairs']['Src']).astype(int).ravel() - 1
+    Det = np.asarray(info['pairs']['Det']).astype(int).ravel() - 1
+    WL = np.asarray(info['pairs']['WL']).astype(int).ravel() - 1
+    Nwl = WL.max() + 1
+    spos = np.asarray(info['optodes']['spos3'], dtype = np.float64)
+    dpos = np.asarray(info['optodes']['dpos3'], dtype = np.float64)
+    Ns = np.shape(spos)[0]
+    region = np.asarray(mesh['region']).astype(int).ravel()
+
+    def element_props(key, default, w):
+        prop = np.asarray(params.get(key, default), dtype = np.float64)
+        if prop.ndim == 2:
+            return prop[region, w]
+        return np.broadcast_to(prop, (Nwl,))[w]
+
+    Pv = mesh_interp_matrix(mesh, ndot.GoodVox_coords(dim))         # VOX x NODE
+    fmod = params.get('fmod', 0)
+    A = np.zeros((len(Src), np.shape(Pv)[0]), dtype = np.complex128 if fmod else np.float64)
+
+    for w in range(0, Nwl):
+        m_w = np.flatnonzero(WL == w)
+        if len(m_w) == 0:
+            continue
+        mua = element_props('mua', 0.01, w)
+        musp = element_props('musp', 1.0, w)
+
+        ## Assemble and factorize once per wavelength.
+        K, info_fem = FEM_diffusion_system(mesh, mua, musp, params)
+        lu = spla.splu(K, permc_spec = 'MMD_AT_PLUS_A', diag_pivot_thresh = 0, options = dict(SymmetricMode = True)) # K is (complex) symmetric
+
+        ## Optode source positions: 1/musp inside along the inward normal.
+        nodes = np.asarray(mesh['nodes'], dtype = np.float64)
+        bnodes = np.unique(info_fem['bfaces'])
+        nsum = np.zeros((np.shape(nodes)[0], 3))
+        np.add.at(nsum, info_fem['bfaces'].ravel(), np.repeat(info_fem['bnormals'], 3, axis = 0))
+        opt = np.concatenate((spos, dpos), axis = 0)
+        _, near = spt.cKDTree(nodes[bnodes, :]).query(opt)
+        near = bnodes[near]
+        nout = nsum[near, :] / np.linalg.norm(nsum[near, :], axis = 1, keepdims = True)
+        elem = np.asarray(mesh['elements']).astype(np.int64).ravel() - 1
+        musp_n = np.bincount(elem, weights = np.repeat(np.broadcast_to(musp, (len(region),)), 4), minlength = np.shape(nodes)[0]) / np.maximum(np.bincount(elem, minlength = np.shape(nodes)[0]), 1)
+        qpos = nodes[near, :] - nout / musp_n[near, None]
+        Q = mesh_interp_matrix(mesh, qpos)                          # OPTODE x NODE
+
+        ## All source and adjoint fields from one factorization.
+        rhs = Q.T.toarray().astype(K.dtype)
+        Phi = lu.solve(rhs)                                         # NODE x OPTODE
+        Phi_s = Phi[:, 0:Ns]
+        Phi_d = Phi[:, Ns:]
+        Phi_sd = (Q[Ns:, :] @ Phi_s)                                # DET x SRC
+
+        ## Jacobian by per-node field products, mapped to voxels.
+        for k in range(0, len(m_w), chunk):
+            m = m_w[k:k + chunk]
+            dens = Phi_s[:, Src[m]] * Phi_d[:, Det[m]] / Phi_sd[Det[m], Src[m]][None, :]
+            A[m, :] = np.transpose(Pv @ dens) * dV
+
+    infoA = dict()
+    infoA['tissue'] = {'dim': dim}
+    infoA['pairs'] = info['pairs']
+    infoA['optodes'] = info['optodes']
+
+    return A, infoA
+
+
+def makeA_MC(seg, dim, info, params = None, mc = None):
+    '''
+    MAKEA_MC Generates a sensitivity "A" matrix by Monte Carlo photon transport in a segmented volume.
+
+    [A, infoA, mc] = MAKEA_MC(seg, dim, info, params) launches photon
+    packets from every source in "info.pairs" into the X x Y x Z label
+    volume "seg" (e.g., the Segmented_MNI152nl atlases; label 0 is
+    outside the head), which lives in the voxel space "dim". Photons
+    are propagated in vectorized batches: each step moves every live
+    photon to its next scattering event or voxel face, so tissue
+    boundaries are followed exactly. Scattering uses the Henyey-Greenstein
+    phase function; absorption is applied to the packet weight
+    W = exp(-sum(mua * L)). The boundary is index-matched. Photons that
+    leave the head within "det_radius" of a detector are detected there.
+
+    Row m of "A" is the detector-weighted mean partial path length
+        A(m, j) = sum_p W_p * L_pj / sum_p W_p,
+    summed over photons p detected for pair m, which is the Rytov
+    sensitivity -dlog(Phi)/dmua_j (see MAKEA_DIFFUSION). The columns
+    follow "dim.Good_Vox" (default: all labeled voxels), so a row can be
+    viewed with GOOD_VOX2VOL.
+
+    The accumulated photon statistics are returned in "mc". Calling
+    MAKEA_MC again with the same inputs and "mc" (or with an existing
+    "checkpoint" file) adds "Nphotons" more photons per source and
+    wavelength. Every batch draws from its own random stream, derived
+    from "seed" and its (source, wavelength, batch) index. Results are
+    therefore reproducible whatever the number of workers and however
+    the photons are split across calls.
+
+    Params:
+        :Nphotons:   1e5     Photons per source and wavelength to add.
+        :batch:      5000    Photons per work unit.
+        :mua:        0.01    Absorption (mm^-1). Scalar, 1 x WL, or
+                             LABEL x WL (row = label in "seg").
+        :musp:       1.0     Reduced scattering (mm^-1), same shapes.
+        :g:          0.9     Anisotropy, same shapes.
+        :det_radius: 1.5 voxels   Detector capture radius (mm).
+        :Lmax:       (W < 1e-4)   Maximum path length (mm) per photon.
+        :seed:       0       Root seed of the random streams.
+        :workers:    (cpu count)  Number of worker processes. Use 1 to
+                             run in the current process.
+        :checkpoint: (none)  .npz file. "mc" is saved to it (replacing
+                             it atomically) during the run and at the
+                             end, and reloaded if the file already
+                             exists and "mc" is not given.
+        :checkpoint_interval: 60    Minimum time (s) between saves.
+
+    See Also: MAKEA_DIFFUSION, MAKEA_FEM, GOOD_VOX2VOL.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    seg = np.asarray(seg)
+    nV = np.array([int(dim['nVx']), int(dim['nVy']), int(dim['nVz'])])
+    if tuple(nV) != np.shape(seg):
+        raise ValueError('Error: seg does not match the size of dim.')
+    Nphotons = int(params.get('Nphotons', 1e5))
+    batch = int(params.get('batch', 5000))
+    seed = int(params.get('seed', 0))
+    workers = params.get('workers', None)
+    checkpoint = params.get('checkpoint', None)
+    checkpoint_interval = float(params.get('checkpoint_interval', 60))
+
+    dim = dict(dim)
+    if 'Good_Vox' not in dim:
+        dim['Good_Vox'] = np.flatnonzero(np.ravel(seg, order = 'F') > 0) + 1
+    GV = np.asarray(dim['Good_Vox']).astype(np.int64).ravel() - 1
+    gvcol = np.full(int(np.prod(nV)), -1, dtype = np.int64)
+    gvcol[GV] = np.arange(0, len(GV))
+
+    Src = np.asarray(info['pairs']['Src']).astype(int).ravel() - 1
+    Det = np.asarray(info['pairs']['Det']).astype(int).ravel() - 1
+    WL = np.asarray(info['pairs']['WL']).astype(int).ravel() - 1
+    Nwl = WL.max() + 1
+    Nm = len(Src)
+
+    ## Optical property tables, LABEL x WL.
+    Nlab = int(seg.max()) + 1
+    def label_props(key, default):
+        prop = np.asarray(params.get(key, default), dtype = np.float64)
+        if prop.ndim == 2:
+            return np.array(prop[0:Nlab, 0:Nwl])
+        return np.tile(np.broadcast_to(prop, (Nwl,)), (Nlab, 1))
+    mua = label_props('mua', 0.01)
+    g = label_props('g', 0.9)
+    mus = label_props('musp', 1.0) / (1 - g)
+    if 'Lmax' in params:
+        Lmax = float(params['Lmax'])
+    else:
+        Lmax = np.log(1e4) / max(np.min(mua[np.unique(seg[seg > 0]), :]), 1e-4)
+
+    ## Voxel frame: u = h * (0-based voxel index), voxel centers on integers.
+    if 'mmppix' in dim and 'center' in dim:
+        dr = np.asarray(dim['mmppix'], dtype = np.float64)
+        center = np.asarray(dim['center'], dtype = np.float64)
+    else:
+        dr = -np.full(3, float(dim['sV']))
+        center = dr * nV
+    h = np.abs(dr)
+    det_radius = float(params.get('det_radius', 1.5 * np.max(h)))
+    def world2u(X):
+        return h * (nV - (np.asarray(X, dtype = np.float64) + center) / dr)
+
+    ## Snap optodes to the nearest surface voxel; launch along the inward normal.
+    mask = seg > 0
+    surf = np.argwhere(mask & ~ndi.binary_erosion(mask))
+    grad = np.gradient(ndi.gaussian_filter(mask.astype(np.float64), 2.0))
+    tree = spt.cKDTree(surf * h)
+    _, k = tree.query(world2u(info['optodes']['spos3']))
+    s_ijk = surf[k, :]
+    s_dir = np.stack([grad[a][s_ijk[:, 0], s_ijk[:, 1], s_ijk[:, 2]] / h[a] for a in range(0, 3)], axis = 1)
+    s_dir = s_dir / np.maximum(np.linalg.norm(s_dir, axis = 1, keepdims = True), 1e-12)
+    _, k = tree.query(world2u(info['optodes']['dpos3']))
+    d_u = surf[k, :] * h
+
+    ## Photon statistics, new or resumed.
+    srcs = np.unique(Src)
+    if mc is None and checkpoint is not None and os.path.exists(checkpoint):
+        with np.load(checkpoint) as f:
+            mc = {key: f[key] for key in f.files}
+    if mc is None:
+        mc = dict()
+        mc['num'] = np.zeros((Nm, len(GV)))
+        mc['den'] = np.zeros(Nm)
+        mc['detected'] = np.zeros(Nm, dtype = np.int64)
+        mc['Nphotons'] = np.zeros((np.shape(info['optodes']['spos3'])[0], Nwl), dtype = np.int64)
+        mc['batches'] = np.zeros_like(mc['Nphotons'])
+        mc['batch'] = batch
+        mc['seed'] = seed
+    else:
+        mc = dict(mc)
+        if np.shape(mc['num']) != (Nm, len(GV)):
+            raise ValueError('Error: mc does not match info.pairs and dim.Good_Vox.')
+        if int(mc['batch']) != batch or int(mc['seed']) != seed:
+            raise ValueError('Error: batch and seed must match those used for mc.')
+
+    ## Work units: (source, wavelength, batch index), each with its own stream.
+    jobs = []
+    meas = []
+    for s in srcs:
+        for w in range(0, Nwl):
+            m = np.flatnonzero((Src == s) & (WL == w))
+            if len(m) == 0:
+                continue
+            for b in range(0, -(-Nphotons // batch)):
+                kb = int(mc['batches'][s, w]) + b
+                ss = np.random.SeedSequence(seed, spawn_key = (int(s), int(w), kb))
+                jobs.append((s_ijk[s, :], s_dir[s, :], w, d_u[Det[m], :], batch, ss))
+                meas.append((m, s, w))
+
+    ## Run in waves so that the statistics can be checkpointed.
+    shared = (seg.astype(np.int16 if Nlab < 2**15 else np.int32), h, mua, mus, g, gvcol, det_radius, Lmax)
+    if workers == 1 or len(jobs) <= 1:
+        _MC_init(*shared)
+        pool = None
+        wave = 1
+    else:
+        pool = cf.ProcessPoolExecutor(max_workers = workers, initializer = _MC_init, initargs = shared)
+        wave = 4 * (workers or os.cpu_count() or 1)
+    saved = time.monotonic()
+    try:
+        for k in range(0, len(jobs), wave):
+            if pool is None:
+                results = [_MC_batch(job) for job in jobs[k:k + wave]]
+            else:
+                results = list(pool.map(_MC_batch, jobs[k:k + wave]))
+            for (m, s, w), (num, den, cnt) in zip(meas[k:k + wave], results):
+                mc['num'][m, :] += num.toarray()
+                mc['den'][m] += den
+                mc['detected'][m] += cnt
+                mc['batches'][s, w] += 1
+                mc['Nphotons'][s, w] += batch
+            last = k + wave >= len(jobs)
+            if checkpoint is not None and (last or time.monotonic() - saved >= checkpoint_interval):
+                _save_checkpoint(checkpoint, mc)
+                saved = time.monotonic()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    ## Normalize by the detected weight.
+    if np.any(mc['detected'] == 0):
+        print('Warning: no photons detected for ' + str(int(np.sum(mc['detected'] == 0))) + ' measurements; their rows are zero.')
+    A = mc['num'] / np.where(mc['den'] > 0, mc['den'], 1)[:, None]
+
+    infoA = dict()
+    infoA['tissue'] = {'dim': dim}
+    infoA['pairs'] = info['pairs']
+    infoA['optodes'] = info['optodes']
+
+    return A, infoA, mc
+
+
+def _save_checkpoint(path, mc):
+    # Writes "mc" to a temporary file next to "path", then renames it, so
+    # that an interrupted save never leaves a truncated checkpoint.
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **mc)
+    os.replace(tmp, path)
+
+
+_MC_shared = dict()
+
+def _MC_init(seg, h, mua, mus, g, gvcol, det_radius, Lmax):
+    # MAKEA_MC worker initializer: keep the volume and property tables in the worker.
+    _MC_shared.update(seg = seg, h = h, mua = mua, mus = mus, g = g, gvcol = gvcol, det_radius = det_radius, Lmax = Lmax)
+
+
+def _MC_batch(job):
+    # One MAKEA_MC work unit: propagate a batch of photons from one source
+    # and return, per detector, sum(W * L_j), sum(W) and the photon count.
+    s_ijk, s_dir, w, d_u, N, ss = job
+    seg = _MC_shared['seg']
+    h = _MC_shared['h']
+    gvcol = _MC_shared['gvcol']
+    mua = _MC_shared['mua'][:, w]
+    mus = _MC_shared['mus'][:, w]
+    g = _MC_shared['g'][:, w]
+    nV = np.array(np.shape(seg))
+    Ngv = np.count_nonzero(gvcol >= 0)
+    Nd = np.shape(d_u)[0]
+    rng = np.random.default_rng(ss)
+
+    ## Photon state; only live photons are kept in the working arrays.
+    pid = np.arange(0, N)
+    ijk = np.tile(np.asarray(s_ijk, dtype = np.int64), (N, 1))
+    pos = ijk * h
+    dirs = np.tile(np.asarray(s_dir, dtype = np.float64), (N, 1))
+    tau = rng.standard_exponential(N)
+    L = np.zeros(N)
+    aL = np.zeros(N)
+    detid = np.full(N, -1)
+    dtree = spt.cKDTree(d_u)
+    logs = []
+    keys = np.zeros(0, dtype = np.int64)
+    vals = np.zeros(0)
+
+    def compact(keys, vals, logs, keep):
+        # Drop path segments of lost photons and merge repeated voxels.
+        keys = np.concatenate([keys] + [l[0] for l in logs])
+        vals = np.concatenate([vals] + [l[1] for l in logs])
+        ok = keep[keys // Ngv]
+        keys, inv = np.unique(keys[ok], return_inverse = True)
+        return keys, np.bincount(inv, weights = vals[ok], minlength = len(keys))
+
+    it = 0
+    while len(pid) > 0:
+        lab = seg[ijk[:, 0], ijk[:, 1], ijk[:, 2]]
+
+        ## Distance to the next voxel face and to the next scattering event.
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            dB = np.where(dirs != 0, ((ijk + 0.5 * np.sign(dirs)) * h - pos) / dirs, np.inf)
+            ax = np.argmin(dB, axis = 1)
+            dB = np.maximum(dB[np.arange(0, len(pid)), ax], 0)
+            dS = np.where(mus[lab] > 0, tau / mus[lab], np.inf)
+        scat = dS <= dB
+        step = np.where(scat, dS, dB)
+
+        ## Path length and absorption in the current voxel.
+        col = gvcol[ijk[:, 0] + nV[0] * (ijk[:, 1] + nV[1] * ijk[:, 2])]
+        ok = col >= 0
+        logs.append((pid[ok] * Ngv + col[ok], step[ok]))
+        L[pid] += step
+        aL[pid] += mua[lab] * step
+        pos = pos + dirs * step[:, None]
+        tau = tau - step * mus[lab]
+
+        ## Scatter, or cross into the neighboring voxel.
+        n = np.flatnonzero(scat)
+        if len(n) > 0:
+            dirs[n, :] = _HG_scatter(dirs[n, :], g[lab[n]], rng)
+            tau[n] = rng.standard_exponential(len(n))
+        n = np.flatnonzero(~scat)
+        ijk[n, ax[n]] += np.sign(dirs[n, ax[n]]).astype(np.int64)
+
+        ## Photons leaving the head are detected or lost.
+        out = np.any((ijk < 0) | (ijk >= nV), axis = 1)
+        inb = np.minimum(np.maximum(ijk, 0), nV - 1)
+        out = out | (seg[inb[:, 0], inb[:, 1], inb[:, 2]] == 0)
+        if np.any(out):
+            dist, k = dtree.query(pos[out, :], distance_upper_bound = _MC_shared['det_radius'])
+            detid[pid[out]] = np.where(dist <= _MC_shared['det_radius'], k, -1)
+        live = ~out & (L[pid] < _MC_shared['Lmax'])
+        pid, ijk, pos, dirs, tau = pid[live], ijk[live, :], pos[live, :], dirs[live, :], tau[live]
+
+        it += 1
+        if it % 256 == 0:
+            keep = detid >= 0
+            keep[pid] = True
+            keys, vals = compact(keys, vals, logs, keep)
+            logs = []
+
+    keys, vals = compact(keys, vals, logs, detid >= 0)
+
+    ## Weighted partial path lengths per detector.
+    W = np.exp(-aL)
+    p = keys // Ngv
+    num = sps.csr_matrix((W[p] * vals, (detid[p], keys % Ngv)), shape = (Nd, Ngv))
+    hit = detid >= 0
+    den = np.bincount(detid[hit], weights = W[hit], minlength = Nd)
+    cnt = np.bincount(detid[hit], minlength = Nd)
+
+    return num, den, cnt
+
+
+def _HG_scatter(dirs, g, rng):
+    # Sample new directions from the Henyey-Greenstein phase function.
+    N = np.shape(dirs)[0]
+    xi = rng.random(N)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        frac = (1 - g**2) / (1 - g + 2 * g * xi)
+        cost = np.where(np.abs(g) > 1e-6, (1 + g**2 - frac**2) / (2 * g), 2 * xi - 1)
+    cost = np.clip(cost, -1, 1)
+    sint = np.sqrt(1 - cost**2)
+    phi = 2 * np.pi * rng.random(N)
+    cphi = np.cos(phi)
+    sphi = np.sin(phi)
+    ux, uy, uz = dirs[:, 0], dirs[:, 1], dirs[:, 2]
+    den = np.sqrt(np.maximum(1 - uz**2, 0))
+    polar = den < 1e-10
+    den = np.where(polar, 1, den)
+    new = np.empty_like(dirs)
+    new[:, 0] = np.where(polar, sint * cphi, sint * (ux * uz * cphi - uy * sphi) / den + ux * cost)
+    new[:, 1] = np.where(polar, sint * sphi, sint * (uy * uz * cphi + ux * sphi) / den + uy * cost)
+    new[:, 2] = np.where(polar, np.sign(uz) * cost, -sint * cphi * den + uz * cost)
+    return new / np.linalg.norm(new, axis = 1, keepdims = True)
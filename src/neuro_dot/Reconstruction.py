@@ -1,8 +1,12 @@
 # General imports
 import numpy as np
 import scipy as scp 
+import scipy.sparse as sps
 import scipy.ndimage as ndi
 import numpy.linalg as lna
+import concurrent.futures as cf
+
+import neuro_dot as ndot
 
 
 
@@ -125,10 +129,19 @@ def Tikhonov_invert_Amat(A, lambda1, lambda2):
     inversion calculation. lambda2 for spatially-variant regularization,
     is optional.
 
-    See Also: SMOOTH_AMAT, RECONSTRUCT_IMG, FINDGOODMEAS.
+    "A" may be a dense array or a scipy.sparse matrix (e.g., the output of
+    SPARSIFY_AMAT). In the sparse case the spatially variant regularization
+    and the Gram matrix are computed on the nonzeros only; the output "iA"
+    is always a dense VOX x MEAS array.
+
+    See Also: SMOOTH_AMAT, RECONSTRUCT_IMG, FINDGOODMEAS, SPARSIFY_AMAT, GRAM_AMAT.
     ''' 
-    if not np.isreal(A.any):  # If complex A, sep into [Re;Im] first
-        A = np.concatenate((A.re, A.imag), axis = 0)
+    isSparse = sps.issparse(A)
+    if np.iscomplexobj(A):  # If complex A, sep into [Re;Im] first
+        if isSparse:
+            A = sps.vstack((A.real, A.imag), format = 'csr')
+        else:
+            A = np.concatenate((A.real, A.imag), axis = 0)
     Nm = np.shape(A)[0]
     Nvox = np.shape(A)[1]
     if lambda2:
@@ -138,31 +151,418 @@ def Tikhonov_invert_Amat(A, lambda1, lambda2):
 
     ## Spatially variant regularization
     if svr:
-        ll_0 = np.sum((A**2), axis = 0) 
+        if isSparse:
+            ll_0 = np.asarray(A.multiply(A).sum(axis = 0)).ravel()
+        else:
+            ll_0 = np.sum((A**2), axis = 0) 
         ll = np.sqrt(ll_0+lambda2*max(ll_0)) # Adjust with Lambda2 cut-off value
-        A = A/ll
+        if isSparse:
+            A = sps.csr_matrix(A @ sps.diags(1 / ll))
+        else:
+            A = A/ll
 
     ## Take the pseudo-inverse.
     if Nvox < Nm:
-        Att = np.zeros(Nvox, dtype = np.single)
-        Att = np.single(A.astype(np.transpose(A).astype(np.float64) @ np.float64))
+        Att = np.single(ndot.Gram_Amat(A, 'vox'))
         ss = lna.norm(Att, ord = 2) # numpy.linalg.norm() with ord = 2 is the matrix 2-norm 
         penalty = np.multiply(np.sqrt(ss), lambda1)
-        iA = lna.lstsq(Att + np.multiply(penalty**2, np.eye(Nvox, dtype = np.uint8)), np.transpose(A))
+        At = A.T.toarray() if isSparse else np.transpose(A)
+        iA = lna.solve(Att + np.multiply(penalty**2, np.eye(Nvox, dtype = np.uint8)), At)
     else:
-        Att = np.zeros(Nm, dtype = np.single)
-        Att = np.single(A.astype(np.float64) @ np.transpose(A).astype(np.float64))  
+        Att = np.single(ndot.Gram_Amat(A, 'meas'))
         ss = lna.norm(Att)
         penalty = np.multiply(np.sqrt(ss), lambda1)
         # In matlab, the following two lines are written as: iA = A' / (Att + penalty .^ 2 .* eye(Nm, 'single'));
         # In python, it is impossible to divide a (m,n) matrix by (n,n), when m or n != 1
         # Instead, we multiply A' by the inverse of the divisor 
         iAtt = lna.inv((Att + np.multiply(penalty**2, np.eye(Nm, dtype = np.uint8))))
-        iA = np.matmul(np.transpose(A),iAtt)
+        if isSparse:
+            iA = np.asarray(A.T @ iAtt) # Sparse-dense product scales with nnz(A)
+        else:
+            iA = np.matmul(np.transpose(A),iAtt)
 
     ## Undo spatially variant regularization
     if svr:
         ll.shape = (1, ll.shape[0]) # add singleton dimension to ll
         iA = iA / np.transpose(ll)
 
-    return iA
\ No newline at end of file
+    return iA
+
+
+def Gram_Amat(A, space = 'meas'):
+    '''
+    GRAM_AMAT Computes the Gram matrix of a sensitivity "A" matrix.
+
+    Att = GRAM_AMAT(A) returns the MEAS x MEAS matrix A * A' in double
+    precision.
+
+    Att = GRAM_AMAT(A, 'vox') returns the VOX x VOX matrix A' * A instead.
+
+    "A" may be dense or a scipy.sparse matrix. For sparse input the product
+    is formed sparse-sparse, so the cost scales with the number of nonzeros
+    rather than Nm*Nvox; the result is returned as a dense array since the
+    Gram matrix of a sensitivity matrix is generally dense.
+
+    See Also: TIKHONOV_INVERT_AMAT, SPARSIFY_AMAT.
+    '''
+    if space not in ('meas', 'vox'):
+        raise ValueError("Error: space must be 'meas' or 'vox'.")
+
+    if sps.issparse(A):
+        A = sps.csr_matrix(A, dtype = np.float64)
+        if space == 'meas':
+            Att = A @ A.T
+        else:
+            Att = A.T @ A
+        return Att.toarray()
+
+    A = np.asarray(A, dtype = np.float64)
+    if space == 'meas':
+        return A @ np.transpose(A)
+    return np.transpose(A) @ A
+
+
+def sparsify_Amat(A, thresh = 1e-3, mode = 'meas', fmt = 'csr', chunk = 1024):
+    '''
+    SPARSIFY_AMAT Converts a sensitivity "A" matrix into a thresholded sparse matrix.
+
+    As = SPARSIFY_AMAT(A, thresh) takes the MEAS x VOX sensitivity matrix
+    "A" and zeroes every element whose magnitude is below "thresh" times
+    the maximum magnitude of its measurement (row). The result is returned
+    as a scipy.sparse CSR matrix "As" that can be passed directly to
+    TIKHONOV_INVERT_AMAT, GRAM_AMAT and MAKEFLATFIELDRECON.
+
+    As = SPARSIFY_AMAT(A, thresh, mode) allows the user to choose the
+    reference for the relative cutoff:
+        :meas: (default) relative to the maximum of each measurement.
+        :global: relative to the maximum of the whole matrix.
+
+    As = SPARSIFY_AMAT(A, thresh, mode, fmt) selects the output format,
+    'csr' (default, fastest for A*x and A*A') or 'csc'.
+
+    Dense input is processed in blocks of "chunk" measurements so that no
+    full-size boolean mask is ever built.
+
+    See Also: SENSITIVITY_LOSS_AMAT, TIKHONOV_INVERT_AMAT, GRAM_AMAT.
+    '''
+    ## Parameters and Initialization.
+    if mode not in ('meas', 'global'):
+        raise ValueError("Error: mode must be 'meas' or 'global'.")
+    if fmt not in ('csr', 'csc'):
+        raise ValueError("Error: fmt must be 'csr' or 'csc'.")
+    if np.ndim(A) != 2:
+        raise ValueError('Error: A must be a 2D MEAS x VOX matrix.')
+
+    if sps.issparse(A):
+        A = sps.csr_matrix(A, copy = True) # Never modify the caller's matrix
+        absA = abs(A)
+        if mode == 'global':
+            ref = np.full(A.shape[0], absA.max())
+        else:
+            ref = absA.max(axis = 1).toarray().ravel()
+        rows = np.repeat(np.arange(A.shape[0]), np.diff(A.indptr))
+        A.data[np.abs(A.data) < thresh * ref[rows]] = 0
+        A.eliminate_zeros()
+        return A.asformat(fmt)
+
+    Nm = np.shape(A)[0]
+    if mode == 'global':
+        gmax = np.max(np.abs(A))
+
+    ## Threshold block by block.
+    blocks = []
+    for k in range(0, Nm, chunk):
+        Ak = np.asarray(A[k:k + chunk, :])
+        if mode == 'global':
+            cut = thresh * gmax
+        else:
+            cut = thresh * np.max(np.abs(Ak), axis = 1, keepdims = True)
+        blocks.append(sps.csr_matrix(np.where(np.abs(Ak) >= cut, Ak, 0)))
+    As = sps.vstack(blocks, format = 'csr')
+
+    return As.asformat(fmt)
+
+
+def sensitivity_loss_Amat(A, thresholds = (1e-4, 1e-3, 1e-2, 1e-1), mode = 'meas', chunk = 1024):
+    '''
+    SENSITIVITY_LOSS_AMAT Reports the sensitivity lost when thresholding an "A" matrix.
+
+    report = SENSITIVITY_LOSS_AMAT(A, thresholds) evaluates, for every
+    relative cutoff in "thresholds" (same definition as in SPARSIFY_AMAT),
+    how much of the sensitivity of the MEAS x VOX matrix "A" would be
+    discarded. The output dictionary "report" contains one entry per
+    threshold in each of the following fields:
+        :thresh:        the relative cutoffs.
+        :density:       fraction of elements kept (nnz / (Nm*Nvox)).
+        :nnz:           number of nonzeros kept.
+        :mass_lost:     fraction of total sum(|A|) discarded.
+        :energy_lost:   fraction of total sum(A.^2) discarded.
+        :max_meas_lost: worst-case fraction of sum(|A|) discarded in any
+                        single measurement.
+        :MB:            approximate CSR storage size in megabytes.
+
+    See Also: SPARSIFY_AMAT.
+    '''
+    ## Parameters and Initialization.
+    if mode not in ('meas', 'global'):
+        raise ValueError("Error: mode must be 'meas' or 'global'.")
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype = np.float64))
+    Nth = len(thresholds)
+    Nm, Nvox = np.shape(A)
+    isSparse = sps.issparse(A)
+    if isSparse:
+        A = sps.csr_matrix(A)
+        gmax = abs(A).max()
+    elif mode == 'global':
+        gmax = np.max(np.abs(A))
+
+    nnz = np.zeros(Nth, dtype = np.int64)
+    mass_lost = np.zeros(Nth)
+    energy_lost = np.zeros(Nth)
+    max_meas_lost = np.zeros(Nth)
+    mass_total = 0.0
+    energy_total = 0.0
+
+    ## Accumulate block by block.
+    for k in range(0, Nm, chunk):
+        Ak = A[k:k + chunk, :]
+        Ak = np.abs(Ak.toarray() if isSparse else np.asarray(Ak))
+        if mode == 'global':
+            ref = np.full((Ak.shape[0], 1), gmax)
+        else:
+            ref = np.max(Ak, axis = 1, keepdims = True)
+        row_mass = np.sum(Ak, axis = 1)
+        row_mass[row_mass == 0] = 1
+        mass_total += np.sum(Ak)
+        energy_total += np.sum(Ak**2)
+        for j in range(0, Nth):
+            lost = Ak < thresholds[j] * ref
+            kept = np.logical_and(np.logical_not(lost), Ak != 0)
+            nnz[j] += np.count_nonzero(kept)
+            lost_vals = np.where(lost, Ak, 0)
+            mass_lost[j] += np.sum(lost_vals)
+            energy_lost[j] += np.sum(lost_vals**2)
+            max_meas_lost[j] = max(max_meas_lost[j], np.max(np.sum(lost_vals, axis = 1) / row_mass))
+
+    ## Normalize and return.
+    report = dict()
+    report['thresh'] = thresholds
+    report['nnz'] = nnz
+    report['density'] = nnz / float(Nm * Nvox)
+    report['mass_lost'] = mass_lost / mass_total if mass_total else mass_lost
+    report['energy_lost'] = energy_lost / energy_total if energy_total else energy_lost
+    report['max_meas_lost'] = max_meas_lost
+    report['MB'] = (nnz * (np.dtype(np.float64).itemsize + np.dtype(np.int32).itemsize) + (Nm + 1) * np.dtype(np.int32).itemsize) / 2**20
+
+    return report
+
+
+# Stages that act on each row of a MEAS x TIME (or VOX x TIME) array with
+# the same linear operator in time. These commute with left-multiplication
+# by iA, so reconstruction can be deferred past them.
+LINEAR_TIME_STAGES = ('detrend_tts', 'highpass', 'lowpass', 'resample_tts', 'BlockAverage', 'glm')
+
+
+def plan_recon_pipeline(stages, verbose = True):
+    '''
+    PLAN_RECON_PIPELINE Reorders a processing pipeline so reconstruction runs on the fewest time points.
+
+    [plan, notes] = PLAN_RECON_PIPELINE(stages) takes a list of stage
+    dictionaries "stages" (see RUN_RECON_PIPELINE) containing one
+    'reconstruct_img' stage, and moves that stage after every consecutive
+    stage that follows it and is linear in time (block averaging, GLM
+    fitting, detrending, filtering and resampling). Because reconstruction
+    is linear in the measurements, the output is unchanged up to
+    single-precision rounding, while the VOX x MEAS product "iA * data"
+    is evaluated on the shortest time series. The reordered stage list is
+    returned as "plan".
+
+    A stage is treated as linear in time if its 'name' is one of
+    LINEAR_TIME_STAGES, or if it sets 'linear': True (e.g., a custom
+    'func' stage). Any other stage blocks the reordering; a message naming
+    it is added to "notes" and printed when "verbose" is true.
+
+    See Also: RUN_RECON_PIPELINE, RECONSTRUCT_IMG, BLOCKAVERAGE.
+    '''
+    ## Parameters and Initialization.
+    stages = list(stages)
+    notes = []
+    idx = [k for k, stage in enumerate(stages) if stage['name'] == 'reconstruct_img']
+    if len(idx) == 0:
+        notes.append('No reconstruct_img stage found; pipeline left unchanged.')
+    elif len(idx) > 1:
+        notes.append('More than one reconstruct_img stage found; pipeline left unchanged.')
+    else:
+        ## Commute reconstruction past linear temporal stages.
+        r = idx[0]
+        j = r + 1
+        while j < len(stages) and stages[j].get('linear', stages[j]['name'] in LINEAR_TIME_STAGES):
+            j = j + 1
+        if j > r + 1:
+            notes.append('Moved reconstruct_img after: ' + ', '.join(stage['name'] for stage in stages[r + 1:j]) + '.')
+        if j < len(stages):
+            notes.append("Stage '" + stages[j]['name'] + "' (position " + str(j) + ') is not linear in time; '
+                         'reconstruct_img must run before it and cannot be moved further.')
+        stages = stages[:r] + stages[r + 1:j] + [stages[r]] + stages[j:]
+
+    if verbose:
+        for note in notes:
+            print(note)
+
+    return stages, notes
+
+
+def run_recon_pipeline(data, stages, plan = True, verbose = True):
+    '''
+    RUN_RECON_PIPELINE Applies a list of processing stages, reconstructing as late as possible.
+
+    out = RUN_RECON_PIPELINE(data, stages) takes a MEAS x TIME array "data"
+    and applies each stage in "stages" in turn. If "plan" is true (default)
+    the stages are first reordered by PLAN_RECON_PIPELINE so that
+    RECONSTRUCT_IMG runs on the smallest time dimension.
+
+    Each stage is a dictionary with a 'name' and its arguments:
+        :reconstruct_img: 'iA'
+        :detrend_tts:     (none)
+        :highpass:        'omegaHz', 'frate', optional 'params'
+        :lowpass:         'omegaHz', 'frate', optional 'params'
+        :resample_tts:    'info', optional 'omega_resample', 'tol', 'framerate'
+        :BlockAverage:    'pulse', 'dt', optional 'Tkeep' (returns BA_out)
+        :glm:             'design', a TIME x K design matrix; returns the
+                          least-squares betas (ROWS x K)
+        :any other name:  'func', a callable taking and returning the data
+                          array; set 'linear': True if it is linear in time
+
+    See Also: PLAN_RECON_PIPELINE, RECONSTRUCT_IMG.
+    '''
+    if plan:
+        stages, _ = plan_recon_pipeline(stages, verbose)
+
+    for stage in stages:
+        data = _apply_recon_stage(data, stage)
+
+    return data
+
+
+def _apply_recon_stage(data, stage):
+    # Dispatch a single RUN_RECON_PIPELINE stage.
+    name = stage['name']
+    if name == 'reconstruct_img':
+        return ndot.reconstruct_img(data, stage['iA'])
+    elif name == 'detrend_tts':
+        return ndot.detrend_tts(data)
+    elif name == 'highpass':
+        return ndot.highpass(data, stage['omegaHz'], stage['frate'], stage.get('params'))
+    elif name == 'lowpass':
+        return ndot.lowpass(data, stage['omegaHz'], stage['frate'], stage.get('params'))
+    elif name == 'resample_tts':
+        return ndot.resample_tts(data, stage['info'], stage.get('omega_resample', 1), stage.get('tol', 0.001), stage.get('framerate', 0))[0]
+    elif name == 'BlockAverage':
+        pulse = np.array(stage['pulse'], copy = True) # BlockAverage shifts pulse in place
+        return ndot.BlockAverage(data, pulse, stage['dt'], stage.get('Tkeep', 0))[0]
+    elif name == 'glm':
+        return data @ np.transpose(lna.pinv(stage['design']))
+    elif 'func' in stage:
+        return stage['func'](data)
+    raise ValueError("Error: unknown pipeline stage '" + str(name) + "'.")
+
+
+def reconstruct_img_batch(runs, A = None, dim = None, lambda1 = 0.01, lambda2 = 0.1, gsigma = None, max_workers = None, mem_budget = None):
+    '''
+    RECONSTRUCT_IMG_BATCH Reconstructs several runs that share sensitivity matrices.
+
+    imgs = RECONSTRUCT_IMG_BATCH(runs, A) takes a list "runs" of dictionaries,
+    each with a MEAS x TIME light-level array 'data' and an optional
+    logical 'keep' mask over the rows of "A" (default: all measurements),
+    and returns a list "imgs" with one VOX x TIME reconstruction per run,
+    in the same order, exactly as RECONSTRUCT_IMG would produce them.
+
+    Runs are grouped by (A, keep, lambda1, lambda2, gsigma). Each group
+    inverts its A matrix once with TIKHONOV_INVERT_AMAT (and smooths it
+    with SMOOTH_AMAT when "gsigma" is given, which requires "dim"), then
+    concatenates the kept measurements of all its runs along time so that
+    the reconstruction is a single large matrix product, and finally
+    splits the result back per run.
+
+    A run may override the shared arguments with its own 'A', 'lambda1',
+    'lambda2' or 'gsigma' entries. Runs are considered to share an A matrix
+    when they reference the same array object.
+
+    Groups are processed in parallel by up to "max_workers" threads (BLAS
+    and LAPACK release the GIL). If "mem_budget" (in bytes) is given,
+    groups are scheduled so that the estimated working memory of the
+    groups running at the same time stays within it; a group larger than
+    the budget runs on its own.
+
+    See Also: TIKHONOV_INVERT_AMAT, SMOOTH_AMAT, RECONSTRUCT_IMG.
+    '''
+    ## Parameters and Initialization.
+    Nruns = len(runs)
+    groups = dict()
+    for k in range(0, Nruns):
+        run = runs[k]
+        Ak = run.get('A', A)
+        if Ak is None:
+            raise ValueError('Error: no A matrix given for run ' + str(k) + '.')
+        Nm = np.shape(Ak)[0]
+        keep = run.get('keep')
+        if keep is None:
+            keep = np.ones(Nm, dtype = bool)
+        keep = np.asarray(keep).astype(bool).ravel()
+        if len(keep) != Nm:
+            raise ValueError('Error: keep mask of run ' + str(k) + ' does not match the rows of A.')
+        gs = run.get('gsigma', gsigma)
+        if gs and dim is None:
+            raise ValueError('Error: "dim" is required when smoothing with gsigma.')
+        key = (id(Ak), keep.tobytes(), run.get('lambda1', lambda1), run.get('lambda2', lambda2), gs)
+        if key not in groups:
+            groups[key] = {'A': Ak, 'keep': keep, 'lambda1': key[2], 'lambda2': key[3], 'gsigma': gs, 'runs': []}
+        groups[key]['runs'].append(k)
+
+    ## Estimate working memory per group (A subset, Gram/inverse, iA and image).
+    glist = list(groups.values())
+    for group in glist:
+        Nkeep = int(np.sum(group['keep']))
+        Nvox = np.shape(group['A'])[1]
+        Nt = sum(np.shape(runs[k]['data'])[-1] for k in group['runs'])
+        group['bytes'] = 8 * (2 * Nkeep * Nvox + 2 * Nkeep**2 + Nkeep * Nt) + 4 * Nvox * Nt
+
+    ## Schedule groups into waves that fit the memory budget.
+    if mem_budget is None:
+        waves = [glist]
+    else:
+        waves = []
+        wave = []
+        used = 0
+        for group in sorted(glist, key = lambda g: g['bytes'], reverse = True):
+            if wave and used + group['bytes'] > mem_budget:
+                waves.append(wave)
+                wave = []
+                used = 0
+            wave.append(group)
+            used = used + group['bytes']
+        if wave:
+            waves.append(wave)
+
+    ## Invert once per group and reconstruct all of its runs in one product.
+    imgs = [None] * Nruns
+    def recon_group(group):
+        Akeep = group['A'][group['keep'], :]
+        iA = ndot.Tikhonov_invert_Amat(Akeep, group['lambda1'], group['lambda2'])
+        if group['gsigma']:
+            iA = ndot.smooth_Amat(iA, dim, group['gsigma'])
+        data = np.concatenate([np.reshape(runs[k]['data'], (np.shape(runs[k]['data'])[0], -1))[group['keep'], :] for k in group['runs']], axis = 1)
+        img = ndot.reconstruct_img(data, iA)
+        bounds = np.cumsum([0] + [np.shape(runs[k]['data'])[-1] for k in group['runs']])
+        for j, k in enumerate(group['runs']):
+            imgs[k] = img[:, bounds[j]:bounds[j + 1]]
+
+    for wave in waves:
+        if max_workers == 1 or len(wave) == 1:
+            for group in wave:
+                recon_group(group)
+        else:
+            with cf.ThreadPoolExecutor(max_workers = max_workers) as pool:
+                list(pool.map(recon_group, wave))
+
+    return imgs
@@ -0,0 +1,229 @@
+# General imports
+import csv
+import numpy as np
+import scipy.spatial as spt
+
+import neuro_dot as ndot
+
+
+
+def load_digitized_points(filename):
+    '''
+    LOAD_DIGITIZED_POINTS Reads a digitizer (e.g., Polhemus) point file.
+
+    pts = LOAD_DIGITIZED_POINTS(filename) reads a CSV file with a header
+    row and one "Location, X, Y, Z" row per digitized point (fiducials
+    such as Nasion, Inion, Ar, Al, Cz, followed by optodes), as in
+    ExampleData/Example2/Example2_Polhemus.csv. The output structure
+    "pts" contains:
+        :labels: list of the N point names.
+        :pos:    N x 3 coordinates, in the units of the file.
+
+    See Also: REGISTER_OPTODES.
+    '''
+    labels = []
+    pos = []
+    with open(filename, newline = '') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            if len(row) < 4 or row[0].strip() == '':
+                continue
+            labels.append(row[0].strip())
+            pos.append([float(x) for x in row[1:4]])
+
+    pts = dict()
+    pts['labels'] = labels
+    pts['pos'] = np.reshape(np.array(pos, dtype = np.float64), (-1, 3))
+
+    return pts
+
+
+def rigid_fit(P, Q, scale = False):
+    '''
+    RIGID_FIT Least-squares rigid (or similarity) transform between paired points.
+
+    [R, s, t] = RIGID_FIT(P, Q) returns the rotation "R" (3 x 3) and
+    translation "t" (1 x 3) that minimize the squared distances between
+    the N x 3 points P @ R + t and their partners "Q" (row-vector
+    convention, as in ROTATE_CAP). With "scale" set, a uniform scale "s"
+    is also fitted (Q ~ s * P @ R + t); otherwise s = 1.
+
+    See Also: ICP_REGISTER.
+    '''
+    P = np.asarray(P, dtype = np.float64)
+    Q = np.asarray(Q, dtype = np.float64)
+    mP = np.mean(P, axis = 0)
+    mQ = np.mean(Q, axis = 0)
+    Pc = P - mP
+    Qc = Q - mQ
+
+    ## Orthogonal Procrustes, without reflections.
+    U, S, Vt = np.linalg.svd(Pc.T @ Qc)
+    D = np.diag([1, 1, np.sign(np.linalg.det(U @ Vt))])
+    R = U @ D @ Vt
+    s = 1.0
+    if scale:
+        s = np.trace(np.diag(S) @ D) / np.sum(Pc**2)
+    t = mQ - s * mP @ R
+
+    return R, s, t
+
+
+def icp_register(pts, surf, params = None):
+    '''
+    ICP_REGISTER Fits a point set to a surface by iterative closest point.
+
+    [pts_out, T] = ICP_REGISTER(pts, surf, params) moves the N x 3 points
+    "pts" (e.g., digitized or template optode positions) onto the
+    M x 3 surface points "surf" (e.g., scalp mesh nodes). Closest
+    points are found with a KD-tree on "surf".
+
+    1. Initialization: if "landmarks" are given, a fit of the landmark
+       pairs; otherwise the identity.
+    2. Coarse search: a grid of rotations about the centroid of "pts"
+       (every "search_step" degrees up to +/- "search" about each axis)
+       is evaluated as one batch of K x 3 x 3 rotations. Each candidate
+       gets a few closest-point translation updates, and the one with
+       the lowest mean squared distance is kept.
+    3. Refinement: ICP, alternating closest points and RIGID_FIT, until
+       the RMS distance changes by less than "tol".
+
+    The output structure "T" holds the transform pts_out = s * pts @ R + t
+    as "R", "s", "t", plus the final "rms" distance and "iter" count.
+    A cap patch can slide along a smooth, nearly symmetric head without
+    raising the RMS, so landmarks (e.g., digitized fiducials) should be
+    given whenever they are available.
+
+    Params:
+        :landmarks:   (none)  Pair (P, Q) of K x 3 arrays: landmarks in
+                              the frame of "pts" (e.g., digitized
+                              fiducials) and their positions on "surf".
+        :scale:       False   Also fit a uniform scale (e.g., to convert
+                              digitizer cm to mm).
+        :search:      20      Coarse rotation search half-range (deg).
+                              0 disables the search.
+        :search_step: 10      Coarse rotation search step (deg).
+        :trim:        0       Fraction of the worst matches ignored in
+                              each ICP fit.
+        :maxiter:     50      Maximum ICP iterations (at least 1).
+        :tol:         1e-6    Convergence tolerance on the RMS (mm).
+
+    See Also: RIGID_FIT, REGISTER_OPTODES, ROTATION_MATRICES.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    scale = bool(params.get('scale', False))
+    search = float(params.get('search', 20))
+    search_step = float(params.get('search_step', 10))
+    trim = float(params.get('trim', 0))
+    maxiter = int(params.get('maxiter', 50))
+    tol = float(params.get('tol', 1e-6))
+    if maxiter < 1:
+        raise ValueError('Error: maxiter must be at least 1.')
+
+    pts = np.asarray(pts, dtype = np.float64)
+    surf = np.asarray(surf, dtype = np.float64)
+    tree = spt.cKDTree(surf)
+    N = np.shape(pts)[0]
+
+    ## Initialization from landmarks.
+    R0 = np.eye(3)
+    s0 = 1.0
+    t0 = np.zeros(3)
+    if 'landmarks' in params and params['landmarks'] is not None:
+        R0, s0, t0 = rigid_fit(params['landmarks'][0], params['landmarks'][1], scale)
+    X = s0 * pts @ R0 + t0
+
+    ## Batched coarse search over rotations about the centroid.
+    if search > 0:
+        steps = np.arange(-search, search + search_step / 2, search_step) * np.pi / 180
+        grid = np.stack(np.meshgrid(steps, steps, steps, indexing = 'ij'), axis = -1).reshape(-1, 3)
+        rot = ndot.rotation_matrices(grid)                          # K x 3 x 3
+        c = np.mean(X, axis = 0)
+        Xk = (X - c) @ rot + c                                      # K x N x 3
+        tk = np.zeros((np.shape(rot)[0], 1, 3))
+        for k in range(0, 3):
+            _, j = tree.query(np.reshape(Xk + tk, (-1, 3)))
+            tk = tk + np.mean(np.reshape(surf[j, :], np.shape(Xk)) - (Xk + tk), axis = 1, keepdims = True)
+        d, _ = tree.query(np.reshape(Xk + tk, (-1, 3)))
+        best = np.argmin(np.mean(np.reshape(d, (-1, N))**2, axis = 1))
+        X = Xk[best] + tk[best]
+
+    ## ICP refinement; each fit maps the original points to their current matches.
+    rms = np.inf
+    for it in range(1, maxiter + 1):
+        d, j = tree.query(X)
+        keep = np.ones(N, dtype = bool)
+        if trim > 0:
+            keep = d <= np.quantile(d, 1 - trim)
+        R, s, t = rigid_fit(pts[keep, :], surf[j[keep], :], scale)
+        X = s * pts @ R + t
+        rms_new = np.sqrt(np.mean(tree.query(X)[0][keep]**2))
+        if abs(rms - rms_new) < tol:
+            rms = rms_new
+            break
+        rms = rms_new
+
+    T = dict()
+    T['R'] = R
+    T['s'] = s
+    T['t'] = t
+    T['rms'] = rms
+    T['iter'] = it
+
+    return X, T
+
+
+def register_optodes(info, mesh, params = None):
+    '''
+    REGISTER_OPTODES Registers cap optode positions to a head surface mesh.
+
+    [info_out, T] = REGISTER_OPTODES(info, mesh, params) fits the source
+    and detector positions "info.optodes.spos3/dpos3" (template or
+    digitized) jointly to the nodes of the head (scalp) surface "mesh"
+    with ICP_REGISTER. It returns a copy of "info" with the registered
+    "optodes.spos3/dpos3" and with "pairs.r3d" (and "pairs.r2d", from
+    spos2/dpos2) recomputed for the new positions. "T" is the fitted
+    transform (see ICP_REGISTER).
+
+    Params:
+        :snap:  True    Move each registered optode onto the nearest
+                        mesh node.
+        (plus the parameters of ICP_REGISTER)
+
+    See Also: ICP_REGISTER, LOAD_DIGITIZED_POINTS, ROTATE_CAP.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    surf = np.asarray(mesh['nodes'], dtype = np.float64)[:, 0:3]
+    spos = np.asarray(info['optodes']['spos3'], dtype = np.float64)
+    dpos = np.asarray(info['optodes']['dpos3'], dtype = np.float64)
+    Ns = np.shape(spos)[0]
+
+    ## Register all optodes together.
+    X, T = icp_register(np.concatenate((spos, dpos), axis = 0), surf, params)
+    if params.get('snap', True):
+        _, j = spt.cKDTree(surf).query(X)
+        X = surf[j, :]
+
+    ## Output structure.
+    info_out = dict(info)
+    info_out['optodes'] = dict(info['optodes'])
+    info_out['optodes']['spos3'] = X[0:Ns, :]
+    info_out['optodes']['dpos3'] = X[Ns:, :]
+    if 'pairs' in info:
+        info_out['pairs'] = dict(info['pairs'])
+        Src = np.asarray(info['pairs']['Src']).astype(int).ravel() - 1
+        Det = np.asarray(info['pairs']['Det']).astype(int).ravel() - 1
+        r3d = np.linalg.norm(X[Src, :] - X[Ns + Det, :], axis = 1)
+        info_out['pairs']['r3d'] = np.reshape(r3d, np.shape(info['pairs']['r3d'])) if 'r3d' in info['pairs'] else r3d
+        if 'spos2' in info['optodes'] and 'dpos2' in info['optodes']:
+            spos2 = np.asarray(info['optodes']['spos2'], dtype = np.float64)
+            dpos2 = np.asarray(info['optodes']['dpos2'], dtype = np.float64)
+            r2d = np.linalg.norm(spos2[Src, :] - dpos2[Det, :], axis = 1)
+            info_out['pairs']['r2d'] = np.reshape(r2d, np.shape(info['pairs']['r2d'])) if 'r2d' in info['pairs'] else r2d
+
+    return info_out, T
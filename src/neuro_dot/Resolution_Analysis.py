@@ -0,0 +1,119 @@
+# General imports
+import numpy as np
+import scipy.sparse as sps
+import concurrent.futures as cf
+
+import neuro_dot as ndot
+
+
+
+def CalcResolution(A, iA, dim, params = None):
+    '''
+    CALCRESOLUTION Calculates point-spread-function image-quality metrics for every voxel.
+
+    res = CALCRESOLUTION(A, iA, dim) evaluates the resolution matrix
+    R = iA * A one block of columns at a time, so the full VOX x VOX matrix
+    is never formed. Column v of R is the point-spread function (PSF) of a
+    point perturbation at voxel v, from which the following metrics are
+    computed and returned as VOX x 1 columns of the structure "res":
+        :LE:   localization error (mm), the distance between voxel v and
+               the centroid of the PSF above half maximum.
+        :FVOL: focal volume (mm^3), the volume of the PSF above half
+               maximum.
+        :FWHM: effective full width at half maximum (mm), the diameter of
+               a sphere with volume FVOL.
+    "A" is the MEAS x VOX sensitivity matrix (dense or scipy.sparse) and
+    "iA" the VOX x MEAS inverse of the same measurements (e.g., from
+    TIKHONOV_INVERT_AMAT, optionally smoothed with SMOOTH_AMAT). "dim"
+    describes the voxel space (nVx, nVy, nVz, Good_Vox, and mmppix or sV).
+
+    res = CALCRESOLUTION(A, iA, dim, params) allows the user to specify
+    parameters.
+
+    Params:
+        :vox:     (all)   Indices (0-based, into Good_Vox) of the voxels to
+                          evaluate. Unevaluated voxels are NaN.
+        :step:    1       Evaluate every "step"-th voxel when "vox" is not
+                          given.
+        :thresh:  0.5     Fraction of the PSF maximum defining the focal
+                          region.
+        :block:   256     Number of voxels per block of R.
+        :workers: (auto)  Number of threads evaluating blocks in parallel.
+
+    See Also: RESOLUTION2VOL, MAKEFLATFIELDRECON, TIKHONOV_INVERT_AMAT.
+    '''
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    thresh = params.get('thresh', 0.5)
+    block = int(params.get('block', 256))
+    workers = params.get('workers', None)
+
+    Nvox = np.shape(A)[1]
+    if np.shape(iA)[0] != Nvox:
+        raise ValueError('Error: iA must be VOX x MEAS with the same voxels as A.')
+    if 'vox' in params and params['vox'] is not None:
+        vox = np.asarray(params['vox']).astype(int).ravel()
+    else:
+        vox = np.arange(0, Nvox, int(params.get('step', 1)))
+
+    if sps.issparse(A):
+        A = sps.csc_matrix(A) # Fast column slicing
+    iA = np.asarray(iA, dtype = np.float64)
+    coords = ndot.GoodVox_coords(dim)
+    if np.shape(coords)[0] != Nvox:
+        raise ValueError('Error: dim["Good_Vox"] does not match the number of voxels in A.')
+    if 'mmppix' in dim:
+        dV = np.prod(np.abs(np.asarray(dim['mmppix'], dtype = np.float64)))
+    else:
+        dV = float(dim['sV'])**3
+
+    LE = np.full(Nvox, np.nan)
+    FVOL = np.full(Nvox, np.nan)
+
+    ## Evaluate blocks of the resolution matrix.
+    def eval_block(vb):
+        Ab = A[:, vb]
+        Ab = Ab.toarray() if sps.issparse(Ab) else np.asarray(Ab, dtype = np.float64)
+        Rb = iA @ Ab                                            # VOX x block of PSFs
+        peak = np.max(Rb, axis = 0)
+        W = np.where(Rb >= thresh * peak, Rb, 0)
+        Wsum = np.sum(W, axis = 0)
+        Wsum[Wsum == 0] = np.nan
+        centroid = (np.transpose(coords) @ W) / Wsum            # 3 x block
+        LE[vb] = np.sqrt(np.sum((centroid - np.transpose(coords[vb, :]))**2, axis = 0))
+        FVOL[vb] = np.count_nonzero(W, axis = 0) * dV
+
+    blocks = [vox[k:k + block] for k in range(0, len(vox), block)]
+    if workers == 1 or len(blocks) <= 1:
+        for vb in blocks:
+            eval_block(vb)
+    else:
+        with cf.ThreadPoolExecutor(max_workers = workers) as pool:
+            list(pool.map(eval_block, blocks))
+
+    ## Populate output.
+    res = dict()
+    res['vox'] = vox
+    res['LE'] = LE
+    res['FVOL'] = FVOL
+    res['FWHM'] = 2 * np.cbrt(3 * FVOL / (4 * np.pi))
+
+    return res
+
+
+def Resolution2vol(res, dim):
+    '''
+    RESOLUTION2VOL Converts the output of CALCRESOLUTION into volumes.
+
+    vols = RESOLUTION2VOL(res, dim) passes each VOX x 1 metric of "res"
+    (LE, FVOL, FWHM) through GOODVOX2VOL and returns the resulting
+    X x Y x Z volumes as fields of "vols".
+
+    See Also: CALCRESOLUTION, GOODVOX2VOL, PLOTSLICES.
+    '''
+    vols = dict()
+    for key in ('LE', 'FVOL', 'FWHM'):
+        vols[key] = np.squeeze(ndot.GoodVox2vol(np.reshape(res[key], (-1, 1)), dim), axis = 3)
+
+    return vols
@@ -2,11 +2,14 @@
 import numpy as np
 import numpy.matlib as mlb
 import scipy as scp
+import scipy.interpolate
+import scipy.sparse as sps
+from collections import OrderedDict
 
 import neuro_dot as ndot
 
 
-def affine3d_img(imgA, infoA, infoB, affine = np.eye(4), interp_type = 'nearest'):
+def affine3d_img(imgA, infoA, infoB, affine = np.eye(4), interp_type = 'nearest', plan = None):
     """
     AFFINE3D_IMG Transforms a 3D data set to a new space.
     
@@ -14,79 +17,238 @@ def affine3d_img(imgA, infoA, infoB, affine = np.eye(4), interp_type = 'nearest'
     VOX x TIME image "imgA" and transforms it from its initial voxel space
     defined by the structure "infoA" into a target voxel space defined by
     the structure "infoB" and using the transform matrix "affine". The
-    output is a VOX x TIME matrix "imgB" in the target voxel space.
+    output is a VOX x TIME matrix "imgB" in the target voxel space. The
+    rows of "imgA" are either all voxels of "infoA" or, if "infoA" has a
+    "Good_Vox" field, its good voxels; the rows of "imgB" are all voxels
+    of "infoB". Volumes (X x Y x Z) and time series of volumes
+    (X x Y x Z x TIME) are also accepted and returned in the same form.
     
     imgB = AFFINE3D_IMG(imgA, infoA, infoB, affine, interp_type) allows the
     user to specify an interpolation method for the INTERP3 function that
     AFFINE3D_IMG uses. Other methods that can be used (input as strings)
-    are 'nearest', 'spline', and 'cubic'. The default value is 'linear'.
+    are 'linear', 'spline', and 'cubic'. The default value is 'nearest'.
+
+    For 'nearest' and 'linear' the resampling is a sparse VOX x VOX
+    operator (see AFFINE3D_PLAN), applied to all time points in one
+    product. Operators are cached per geometry (see AFFINE3D_PLAN_CACHE),
+    so repeated calls with the same spaces and affine do not recompute
+    them. A precomputed
+    "plan" may also be passed directly. A VOXELVOLUME input is resampled
+    without densifying and returned as a VOXELVOLUME over the target
+    voxels that receive data.
     
-    See Also: SPECTROSCOPY_IMG, CHANGE_SPACE_COORDS, INTERP3.
+    See Also: AFFINE3D_PLAN, SPECTROSCOPY_IMG, CHANGE_SPACE_COORDS, INTERP3.
     """
     ## Parameters and Initialization.
+    nVA = (int(infoA['nVx']), int(infoA['nVy']), int(infoA['nVz']))
+    nVB = (int(infoB['nVx']), int(infoB['nVy']), int(infoB['nVz']))
+    if isinstance(imgA, VoxelVolume):
+        if plan is None and interp_type not in ('nearest', 'linear'):
+            imgA = imgA.toarray()
+        else:
+            ## Lazy volumes stay on their good voxels in both spaces.
+            if plan is None:
+                plan = affine3d_plan(infoA, infoB, affine, interp_type)
+            GV = np.asarray(imgA.dim['Good_Vox']).astype(np.int64).ravel() - 1
+            W = plan['W'].tocsc()[:, GV].tocsr()
+            rows = np.flatnonzero(W.getnnz(axis = 1))
+            dimB = dict(infoB)
+            dimB['Good_Vox'] = rows + 1
+            return VoxelVolume(W[rows, :] @ imgA.img, dimB)
+    imgA = np.asarray(imgA)
     size_imgA = np.shape(imgA)
-    
-    if len(size_imgA) <= 3: 
-        Nt = 1
+    if imgA.ndim <= 2:
+        if imgA.ndim == 1:
+            imgA = imgA[:, None]
+        if np.shape(imgA)[0] != np.prod(nVA):
+            if 'Good_Vox' not in infoA:
+                raise ValueError('Error: imgA rows do not match the voxels of infoA.')
+            full = np.zeros((int(np.prod(nVA)), np.shape(imgA)[1]), dtype = imgA.dtype)
+            full[np.asarray(infoA['Good_Vox']).astype(int).ravel() - 1, :] = imgA
+            imgA = full
+        Nt = np.shape(imgA)[1]
+        vox = True
+    else:
+        Nt = 1 if imgA.ndim == 3 else size_imgA[3]
+        imgA = np.reshape(imgA, (int(np.prod(nVA)), Nt), order = 'F')
+        vox = False
+
+    ## Resample all time points.
+    if plan is None and interp_type in ('nearest', 'linear'):
+        plan = affine3d_plan(infoA, infoB, affine, interp_type)
+    if plan is not None:
+        imgB = plan['W'] @ imgA
     else:
-        Nt = size_imgA[3]
-    extrapval = 0
-
-    ## Determine initial and target space coordinate ranges.
-    # Initial space.
-    centerA = infoA['center']
-    nVxA = infoA['nVx']
-    nVyA = infoA['nVy']
-    nVzA = infoA['nVz']
-    drA = infoA['mmppix']
-
-    X = np.arange((-centerA[0] + nVxA * drA[0]), (-centerA[0]), -drA[0]) 
-    Y = np.arange((-centerA[1] + nVyA * drA[1]), (-centerA[1]), -drA[1]) 
-    Z = np.arange((-centerA[2] + nVzA * drA[2]), (-centerA[2]), -drA[2]) 
-
-    # Target space.
-    centerB = infoB['center']
-    nVxB = infoB['nVx']
-    nVyB = infoB['nVy']
-    nVzB = infoB['nVz']
-    drB = infoB['mmppix']
-
-    x = np.arange((-centerB[0] + nVxB * drB[0]), (-centerB[0]), -drB[0]) 
-    y = np.arange((-centerB[1] + nVyB * drB[1]), (-centerB[1]), -drB[1]) 
-    z = np.arange((-centerB[2] + nVzB * drB[2]), (-centerB[2]), -drB[2])
-
-    # Make target space x, y, z column vectors 
-    x.shape = (x.shape[0], 1)
-    y.shape = (y.shape[0], 1)
-    z.shape = (z.shape[0], 1)
-
-
-    ## Get all points in destination to sample
-    [ygv, xgv, zgv] = np.meshgrid(y, x, z)
-    xyz = np.squeeze(np.asarray([np.reshape(xgv, (np.size(xgv), 1), order = 'F').T, np.reshape(ygv, (np.size(ygv), 1), order = 'F').T, np.reshape(zgv, (np.size(zgv), 1), order = 'F').T])) #squeeze and asarray are used so that the row of 1's can be appended to xyz
-    xyz = np.append(xyz, np.ones((1, np.size(xyz, 1))), axis = 0)
-
-    ## Transform into source coordinates and remove extra column
-    uvw = affine @ xyz
-    uvw = np.transpose(uvw[0:3, :])
-
-    ## Sample
-    xi = np.reshape(uvw[:,0], (len(x), len(y), len(z)), order = 'F')
-    yi = np.reshape(uvw[:,1], (len(x), len(y), len(z)), order = 'F')
-    zi = np.reshape(uvw[:,2], (len(x), len(y), len(z)), order = 'F')
-
-
-    ## Interpolate
-    # scipy.interpolate.interpn requires initial space coordinates to all be strictly ascending, due to this we flip initial space corrdinates in the X dimension, as they are descending
-    # interpn also requires the order of initial space inputs to match the dimension order of the input image, so the order is specified as X, Y , Z in python instead of Y, X, Z as it is in matlab
-    # We also flip the x dimension of the input image to replicate what we're doing with the initial space X coordinates
-    X = np.flip(X)
-    imgA = np.flip(imgA, axis = 0)
-    for k in range(0, Nt):
-        imgB = scp.interpolate.interpn((X, Y, Z), np.squeeze(imgA[:, :, :]), np.array([xi, yi, zi]).T, method = interp_type, bounds_error = False, fill_value = extrapval)
-    imgB1 = np.transpose(imgB)
-
-    return imgB1
+        imgB = _affine3d_interpn(imgA, infoA, infoB, affine, interp_type)
+
+    if vox:
+        return imgB
+    if len(size_imgA) <= 3:
+        return np.reshape(imgB, nVB, order = 'F')
+    return np.reshape(imgB, nVB + (Nt,), order = 'F')
+
+
+# Process-wide cache of resampling plans, least recently used first.
+_affine3d_plans = OrderedDict()
+_affine3d_plans_state = {'max_entries': 8}
+
+def affine3d_plan(infoA, infoB, affine = np.eye(4), interp_type = 'nearest', cache = True):
+    """
+    AFFINE3D_PLAN Precomputes the resampling of AFFINE3D_IMG as a sparse matrix.
+
+    plan = AFFINE3D_PLAN(infoA, infoB, affine, interp_type) returns a
+    structure "plan" whose field "W" is a sparse (VOX_B x VOX_A) matrix
+    such that, for any VOX_A x TIME array "imgA" (voxels in column-major
+    order, as in GOOD_VOX2VOL), W @ imgA equals AFFINE3D_IMG(imgA, infoA,
+    infoB, affine, interp_type). Target voxels that map outside the
+    initial space get zero rows. "interp_type" is 'nearest' (default) or
+    'linear'. The last few plans are cached by geometry and returned
+    directly when requested again; with "cache" set to False the plan is
+    always recomputed and not stored (see AFFINE3D_PLAN_CACHE). Cached
+    plans are shared between callers, so they must not be modified.
+
+    See Also: AFFINE3D_IMG, AFFINE3D_PLAN_CACHE.
+    """
+    ## Parameters and Initialization.
+    if interp_type not in ('nearest', 'linear'):
+        raise ValueError("Error: interp_type must be 'nearest' or 'linear' for a resampling plan.")
+    affine = np.asarray(affine, dtype = np.float64)
+    geom = []
+    for info in (infoA, infoB):
+        geom.append(np.asarray([info['nVx'], info['nVy'], info['nVz']], dtype = np.float64).tobytes())
+        geom.append(np.asarray(info['mmppix'], dtype = np.float64).tobytes())
+        geom.append(np.asarray(info['center'], dtype = np.float64).tobytes())
+    key = (tuple(geom), affine.tobytes(), interp_type)
+    if cache and key in _affine3d_plans:
+        _affine3d_plans.move_to_end(key)
+        return _affine3d_plans[key]
+
+    ## Target voxel coordinates, column-major, mapped into the initial space.
+    nVB = np.array([int(infoB['nVx']), int(infoB['nVy']), int(infoB['nVz'])])
+    drB = np.asarray(infoB['mmppix'], dtype = np.float64)
+    centerB = np.asarray(infoB['center'], dtype = np.float64)
+    ijk = np.transpose(np.array(np.unravel_index(np.arange(0, int(np.prod(nVB))), tuple(nVB), order = 'F'), dtype = np.float64))
+    xyz = drB * (nVB - ijk) - centerB
+    uvw = xyz @ affine[0:3, 0:3].T + affine[0:3, 3]
+    W = grid_interp_matrix(uvw, infoA, interp_type)
+    nVA = np.array([int(infoA['nVx']), int(infoA['nVy']), int(infoA['nVz'])])
+
+    plan = dict()
+    plan['W'] = W
+    plan['interp_type'] = interp_type
+    plan['nVA'] = tuple(nVA)
+    plan['nVB'] = tuple(nVB)
+
+    if cache and _affine3d_plans_state['max_entries'] > 0:
+        while len(_affine3d_plans) >= _affine3d_plans_state['max_entries']:
+            _affine3d_plans.popitem(last = False)
+        _affine3d_plans[key] = plan
+
+    return plan
+
+
+def affine3d_plan_cache(max_entries = None, clear = False):
+    '''
+    AFFINE3D_PLAN_CACHE Sizes, clears, or reports the cache of AFFINE3D_PLAN.
+
+    info = AFFINE3D_PLAN_CACHE() returns the number of cached plans
+    ("entries") and the cache size ("max_entries", default 8).
+
+    AFFINE3D_PLAN_CACHE(max_entries) sets the size, evicting the least
+    recently used plans as needed. 0 disables caching.
+    AFFINE3D_PLAN_CACHE(clear = True) empties the cache.
+
+    See Also: AFFINE3D_PLAN, AFFINE3D_IMG.
+    '''
+    if clear:
+        _affine3d_plans.clear()
+    if max_entries is not None:
+        _affine3d_plans_state['max_entries'] = int(max_entries)
+        while len(_affine3d_plans) > _affine3d_plans_state['max_entries']:
+            _affine3d_plans.popitem(last = False)
+    return {'entries': len(_affine3d_plans), 'max_entries': _affine3d_plans_state['max_entries']}
+
+
+def grid_interp_matrix(pts, dim, interp_type = 'linear'):
+    """
+    GRID_INTERP_MATRIX Builds a sparse interpolation operator from a voxel space to a set of points.
+
+    W = GRID_INTERP_MATRIX(pts, dim, interp_type) returns a sparse
+    PTS x VOX matrix "W" such that W @ img interpolates the VOX x TIME
+    array "img" (all voxels of the space "dim", column-major as in
+    GOOD_VOX2VOL) at the N x 3 coordinates "pts" (mm, using "dim.mmppix"
+    and "dim.center"). "interp_type" is 'linear' (default) or 'nearest',
+    matching INTERPN; points outside the voxel grid get zero rows.
+
+    See Also: AFFINE3D_PLAN, VOL2SURF_MESH.
+    """
+    ## Parameters and Initialization.
+    if interp_type not in ('nearest', 'linear'):
+        raise ValueError("Error: interp_type must be 'nearest' or 'linear'.")
+    pts = np.asarray(pts, dtype = np.float64)
+    nVA = np.array([int(dim['nVx']), int(dim['nVy']), int(dim['nVz'])])
+    drA = np.asarray(dim['mmppix'], dtype = np.float64)
+    centerA = np.asarray(dim['center'], dtype = np.float64)
+    Npts = np.shape(pts)[0]
+
+    ## Fractional position along each axis, in ascending coordinate order.
+    # Index i has coordinate drA * (nVA - i) - centerA; axes with drA > 0 are descending in i.
+    lo = np.where(drA > 0, drA - centerA, drA * nVA - centerA)
+    t = (pts - lo) / np.abs(drA)
+    tol = 1e-6
+    inside = np.all((t >= -tol) & (t <= nVA - 1 + tol), axis = 1)
+    t = np.clip(t[inside, :], 0, nVA - 1)
+    rows = np.flatnonzero(inside)
+
+    def vox_index(k):
+        # Ascending-order indices -> column-major voxel index.
+        k = np.where(drA > 0, nVA - 1 - k, k)
+        return k[:, 0] + nVA[0] * (k[:, 1] + nVA[1] * k[:, 2])
+
+    if interp_type == 'nearest':
+        k0 = np.minimum(np.floor(t), nVA - 1)
+        k = np.where(t - k0 <= 0.5, k0, k0 + 1).astype(np.int64)
+        W = sps.csr_matrix((np.ones(len(rows)), (rows, vox_index(k))), shape = (Npts, int(np.prod(nVA))))
+    else:
+        k0 = np.minimum(np.floor(t), np.maximum(nVA - 2, 0)).astype(np.int64)
+        f = t - k0
+        R = []
+        C = []
+        V = []
+        for corner in range(0, 8):
+            c = np.array([(corner >> a) & 1 for a in range(0, 3)])
+            R.append(rows)
+            C.append(vox_index(np.minimum(k0 + c, nVA - 1)))
+            V.append(np.prod(np.where(c == 1, f, 1 - f), axis = 1))
+        W = sps.csr_matrix((np.concatenate(V), (np.concatenate(R), np.concatenate(C))), shape = (Npts, int(np.prod(nVA))))
+        W.eliminate_zeros()
+
+    return W
+
+
+def _affine3d_interpn(imgA, infoA, infoB, affine, interp_type):
+    # AFFINE3D_IMG for methods without a sparse plan: interpolate each time point of a VOX x TIME array.
+    nVA = (int(infoA['nVx']), int(infoA['nVy']), int(infoA['nVz']))
+    nVB = np.array([int(infoB['nVx']), int(infoB['nVy']), int(infoB['nVz'])])
+    drA = np.asarray(infoA['mmppix'], dtype = np.float64)
+    drB = np.asarray(infoB['mmppix'], dtype = np.float64)
+    centerA = np.asarray(infoA['center'], dtype = np.float64)
+    centerB = np.asarray(infoB['center'], dtype = np.float64)
+
+    ## Initial-space axes in ascending order, target points in the initial space.
+    axes = [drA[a] * (nVA[a] - np.arange(0, nVA[a])) - centerA[a] for a in range(0, 3)]
+    flip = [axes[a][0] > axes[a][-1] for a in range(0, 3)]
+    axes = [np.flip(axes[a]) if flip[a] else axes[a] for a in range(0, 3)]
+    ijk = np.transpose(np.array(np.unravel_index(np.arange(0, int(np.prod(nVB))), tuple(nVB), order = 'F'), dtype = np.float64))
+    uvw = (drB * (nVB - ijk) - centerB) @ np.asarray(affine, dtype = np.float64)[0:3, 0:3].T + np.asarray(affine, dtype = np.float64)[0:3, 3]
+
+    imgB = np.zeros((int(np.prod(nVB)), np.shape(imgA)[1]))
+    for k in range(0, np.shape(imgA)[1]):
+        vol = np.reshape(imgA[:, k], nVA, order = 'F')
+        vol = np.flip(vol, axis = tuple(a for a in range(0, 3) if flip[a]))
+        imgB[:, k] = scp.interpolate.interpn(tuple(axes), vol, uvw, method = interp_type, bounds_error = False, fill_value = 0)
+
+    return imgB
 
 
 def change_space_coords(coord_in, space_info, output_type = 'coord'):
@@ -113,6 +275,7 @@ def change_space_coords(coord_in, space_info, output_type = 'coord'):
     nV = np.shape(coord_in)[0]
 
     # Preallocate.
+    coord_in = np.asarray(coord_in, dtype = np.float64)
     coord_out = np.zeros(np.shape(coord_in))
 
     # Create coordinates for each voxel index.
@@ -120,52 +283,48 @@ def change_space_coords(coord_in, space_info, output_type = 'coord'):
     Y = np.transpose(int(drA[1]) * np.array(range(nVyA, 0, -1)) - centerA[1])
     Z = np.transpose(int(drA[2]) * np.array(range(nVzA, 0, -1)) - centerA[2])
 
-    # Convert coordinates to new space.
-    if output_type == 'coord':
-        #ATLAS/4DFP/ETC COORDINATE SPACE
-        for j in range(0, nV):
-            x = coord_in[j, 0]
-            a = np.floor(x)
-            if ((np.floor(x) >= 0) and (np.floor(x) <= nVxA)):
-                coord_out[j, 0] = X[int(np.floor(x))-1] - drA[0] * (x - np.floor(x))
-            elif np.floor(x) < 0:
-                coord_out[j, 0] = X[0] - drA[0] * (x - 1)
-            elif np.floor(x) > nVxA - 1:
-                coord_out[j, 0] = X[nVxA - 1] - drA[0] * (x - (nVxA - 1))
-
-            y = coord_in[j, 1]
-            if ((np.floor(y) >= 0) and (np.floor(y) <= nVyA)):
-                coord_out[j, 1] = Y[int(np.floor(y))-1] - drA[1] * (y - np.floor(y))
-            elif np.floor(y) < 0:
-                coord_out[j, 1] = Y[0] - drA[1] * (y - 1)
-            elif np.floor(y) > nVyA - 1:
-                coord_out[j, 1] = Y[nVyA - 1] - drA[1] * (y - (nVyA - 1))
-
-            z = coord_in[j, 2]
-            if ((np.floor(z) >= 0) and (np.floor(z) <= nVzA)):
-                coord_out[j, 2] = Z[int(np.floor(z))-1] - drA[2] * (z - np.floor(z))
-            elif np.floor(z) < 0:
-                coord_out[j, 2] = Z[0] - drA[2] * (z - 1)
-            elif np.floor(z) > nVzA - 1:
-                coord_out[j, 2] = Z[nVzA - 1] - drA[2] * (z - (nVzA - 1))
-    elif output_type == 'idx': # MATLAB INDEX SPACE
-        for j in range(0, nV):
-            coord_out[j, 0] = np.argmin(abs(coord_in[j, 0] - X))
-            coord_out[j, 1] = np.argmin(abs(coord_in[j, 1] - Y))
-            coord_out[j, 2] = np.argmin(abs(coord_in[j, 2] - Z))
-
-    elif output_type == 'idxC': # MATLAB INDEX SPACE WITH NO ROUNDING
-        for j in range(0, nV):
-            foo = np.argmin(abs(coord_in[j, 0] - X))
-            coord_out[j, 0] = foo + (X[foo] - coord_in[j, 0]) / drA[0]
-            foo = np.argmin(abs(coord_in[j, 1] - Y))
-            coord_out[j, 1] = foo + (Y[foo] - coord_in[j, 1]) / drA[1]
-            foo = np.argmin(abs(coord_in[j, 2] - Z))
-            coord_out[j, 2] = foo + (Z[foo] - coord_in[j, 2]) / drA[2]
+    # Convert coordinates to new space, one axis at a time for all points.
+    for k, (V, n) in enumerate(((X, nVxA), (Y, nVyA), (Z, nVzA))):
+        x = coord_in[:, k]
+        if output_type == 'coord':
+            #ATLAS/4DFP/ETC COORDINATE SPACE
+            # Linear within the grid (index 0 wraps to the last voxel, as before), extrapolated beyond it.
+            f = np.floor(x)
+            inside = (f >= 0) & (f <= n)
+            fi = np.where(inside, f, 1).astype(np.int64) - 1
+            coord_out[inside, k] = V[fi[inside]] - drA[k] * (x[inside] - f[inside])
+            below = f < 0
+            coord_out[below, k] = V[0] - drA[k] * (x[below] - 1)
+            above = f > n
+            coord_out[above, k] = V[n - 1] - drA[k] * (x[above] - (n - 1))
+        elif output_type == 'idx': # MATLAB INDEX SPACE
+            coord_out[:, k] = _nearest_index(V, x)
+        elif output_type == 'idxC': # MATLAB INDEX SPACE WITH NO ROUNDING
+            foo = _nearest_index(V, x)
+            coord_out[:, k] = foo + (V[foo] - x) / drA[k]
 
     return coord_out
 
-def GoodVox2vol(img, dim):
+def _nearest_index(V, x):
+    # Index of the entry of the monotonic axis "V" nearest to each "x", with the
+    # ties, clamping and NaN handling of argmin(abs(x - V)).
+    desc = len(V) > 1 and V[0] > V[-1]
+    asc = V[::-1] if desc else V
+    n = len(V)
+    hi = np.clip(np.searchsorted(asc, x), 0, n - 1)
+    lo = np.clip(hi - 1, 0, n - 1)
+    d_lo = np.abs(x - asc[lo])
+    d_hi = np.abs(x - asc[hi])
+    if desc:
+        # Ties go to the larger ascending index (the first entry of V).
+        a = np.where(d_hi <= d_lo, hi, lo)
+        idx = n - 1 - a
+    else:
+        a = np.where(d_lo <= d_hi, lo, hi)
+        idx = a
+    return np.where(np.isnan(x), 0, idx).astype(np.int64)
+
+def GoodVox2vol(img, dim, lazy = False):
     """
     GOOD_VOX2VOL Transforms a VOX x TIME array into a volume, X x Y x Z x TIME, given a space described by "dim".
 
@@ -173,10 +332,16 @@ def GoodVox2vol(img, dim):
     an X x Y x Z x TIME array "imgvol", according to the dimensions of the
     space described by "dim".
 
-    See Also: SPECTROSCOPY_IMG.
+    imgvol = GOOD_VOX2VOL(img, dim, lazy = True) returns a VOXELVOLUME
+    instead, which keeps "img" on the good voxels and densifies only the
+    slices, frames or regions that are indexed.
+
+    See Also: VOXELVOLUME, SPECTROSCOPY_IMG.
     """
 
     ## Parameters and Initialization.
+    if lazy:
+        return VoxelVolume(img, dim)
     Nvox = np.shape(img)[0]
     Nt = np.shape(img)[1]
     if np.logical_and(Nvox == 1, Nt > 1):
@@ -193,6 +358,149 @@ def GoodVox2vol(img, dim):
 
     return imgvol
 
+
+class VoxelVolume:
+    """
+    VOXELVOLUME An X x Y x Z x TIME volume stored as a VOX x TIME array on its good voxels.
+
+    vol = VOXELVOLUME(img, dim) wraps the VOX x TIME array "img", whose
+    rows are the voxels "dim.Good_Vox" of the space "dim", without
+    building the dense volume (see GOOD_VOX2VOL). "vol" has the shape
+    of the X x Y x Z x TIME volume and can be indexed like it, e.g.
+    vol[:, :, 30, 0] or vol[10:20, ..., 5]. Only the indexed region is
+    densified. Voxels outside Good_Vox read as 0. Each axis is indexed
+    separately (integers, slices, or index lists), so lists on two
+    axes select the full sub-grid. np.asarray(vol) gives the dense
+    volume.
+
+    Fields and methods:
+        :img:      VOX x TIME data.
+        :dim:      Voxel space, with Good_Vox.
+        :shape:    (nVx, nVy, nVz, TIME).
+        :slice(axis, index):  X x Y x TIME slice. "axis" is 0/'sagittal',
+                              1/'coronal' or 2/'axial' ('transverse').
+        :frame(t): VOXELVOLUME holding time point "t" only.
+        :roi(mask):  ROI x TIME values at the voxels of an X x Y x Z
+                     boolean "mask" (column-major order).
+        :toarray():  Dense X x Y x Z x TIME volume.
+
+    See Also: GOOD_VOX2VOL, PLOTSLICES, AFFINE3D_IMG, SAVEVOLUMETRICDATA.
+    """
+
+    def __init__(self, img, dim):
+        img = np.asarray(img)
+        if img.ndim == 1:
+            img = img[:, None]
+        if np.shape(img)[0] == 1 and np.shape(img)[1] > 1 and np.size(dim['Good_Vox']) != 1:
+            img = img.T
+        self.img = img
+        self.dim = dim
+        self.nV = (int(dim['nVx']), int(dim['nVy']), int(dim['nVz']))
+        GV = np.asarray(dim['Good_Vox']).astype(np.int64).ravel() - 1
+        if len(GV) != np.shape(img)[0]:
+            raise ValueError('Error: img rows do not match dim.Good_Vox.')
+        self._order = np.argsort(GV, kind = 'stable')
+        self._sorted = GV[self._order]
+
+    @property
+    def shape(self):
+        return self.nV + (np.shape(self.img)[1],)
+
+    @property
+    def ndim(self):
+        return 4
+
+    @property
+    def dtype(self):
+        return self.img.dtype
+
+    def _rows(self, lin):
+        # Rows of img holding the (0-based, column-major) voxels "lin"; -1 if not a good voxel.
+        if len(self._sorted) == 0:
+            return np.full(np.shape(lin), -1, dtype = np.int64)
+        k = np.minimum(np.searchsorted(self._sorted, lin), len(self._sorted) - 1)
+        return np.where(self._sorted[k] == lin, self._order[k], -1)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            e = [i for i, k in enumerate(key) if k is Ellipsis][0]
+            key = key[:e] + (slice(None),) * (5 - len(key)) + key[e + 1:]
+        key = key + (slice(None),) * (4 - len(key))
+        if len(key) > 4:
+            raise IndexError('Too many indices for a VoxelVolume.')
+
+        ## Per-axis index lists; integer indices drop their axis.
+        idx = []
+        drop = []
+        for a, k in enumerate(key):
+            ik = np.arange(0, self.shape[a])[k]
+            drop.append(np.ndim(ik) == 0)
+            idx.append(np.atleast_1d(ik))
+        ix, iy, iz, it = idx
+        lin = ix[:, None, None] + self.nV[0] * (iy[None, :, None] + self.nV[1] * iz[None, None, :])
+        rows = self._rows(lin.ravel(order = 'F'))
+
+        ## Densify the requested region only.
+        out = np.zeros((len(rows), len(it)), dtype = self.img.dtype)
+        ok = rows >= 0
+        out[ok, :] = self.img[np.ix_(rows[ok], it)]
+        out = np.reshape(out, (len(ix), len(iy), len(iz), len(it)), order = 'F')
+        return np.squeeze(out, axis = tuple(a for a in range(0, 4) if drop[a]))
+
+    def slice(self, axis, index):
+        axes = {'sagittal': 0, 'coronal': 1, 'axial': 2, 'transverse': 2}
+        axis = axes.get(axis, axis)
+        key = [slice(None)] * 3
+        key[axis] = index
+        return self[tuple(key)]
+
+    def frame(self, t):
+        return VoxelVolume(self.img[:, [t]], self.dim)
+
+    def roi(self, mask):
+        lin = np.flatnonzero(np.ravel(np.asarray(mask), order = 'F'))
+        rows = self._rows(lin)
+        out = np.zeros((len(lin), np.shape(self.img)[1]), dtype = self.img.dtype)
+        out[rows >= 0, :] = self.img[rows[rows >= 0], :]
+        return out
+
+    def toarray(self):
+        return GoodVox2vol(self.img, self.dim)
+
+    def __array__(self, dtype = None, copy = None):
+        vol = self.toarray()
+        return vol if dtype is None else vol.astype(dtype)
+
+    def __repr__(self):
+        return 'VoxelVolume(shape=' + str(self.shape) + ', Good_Vox=' + str(len(self._sorted)) + ')'
+
+def GoodVox_coords(dim):
+    """
+    GOODVOX_COORDS Returns the spatial coordinates of the good voxels of a space described by "dim".
+
+    coords = GOODVOX_COORDS(dim) returns a VOX x 3 array "coords" with the
+    position (in mm) of every voxel listed in "dim.Good_Vox", in the same
+    order as the rows of a VOX x TIME image. If "dim" contains "mmppix"
+    and "center", the coordinates follow the same convention as
+    CHANGE_SPACE_COORDS; otherwise voxel indices are scaled by "dim.sV".
+
+    See Also: GOODVOX2VOL, CHANGE_SPACE_COORDS.
+    """
+    nV = (int(dim['nVx']), int(dim['nVy']), int(dim['nVz']))
+    GV = np.asarray(dim['Good_Vox']).astype(int).ravel() - 1
+    ijk = np.transpose(np.array(np.unravel_index(GV, nV, order = 'F'), dtype = np.float64))
+
+    if 'mmppix' in dim and 'center' in dim:
+        dr = np.asarray(dim['mmppix'], dtype = np.float64)
+        center = np.asarray(dim['center'], dtype = np.float64)
+        coords = dr * (np.array(nV) - ijk) - center
+    else:
+        coords = ijk * float(dim['sV'])
+
+    return coords
+
 def rotate_cap(tpos_in, dTheta):
     """
     ROTATE_CAP Rotates the cap in space.
@@ -201,28 +509,24 @@ def rotate_cap(tpos_in, dTheta):
     "tpos_in" by the rotation vector "dTheta" (in degrees) and outputs it
     as "tpos_out".
 
-    Dependencies: ROTATION_MATRIX.
+    If "dTheta" is a K x 3 array of rotation vectors, all K rotations are
+    applied in one batched product and "tpos_out" is K x N x 3.
 
-    See Also: PLOTLRMESHES, SCALE_CAP.
+    Dependencies: ROTATION_MATRICES.
+
+    See Also: PLOTLRMESHES, SCALE_CAP, REGISTER_OPTODES.
     """
 
     ## Parameters and Initialization.
+    tpos_in = np.asarray(tpos_in, dtype = np.float64)
     centroid = np.mean(tpos_in, axis = 0)
-    centroid_mat = mlb.repmat(centroid, tpos_in.shape[0], 1)
-    Dx_axis = dTheta[0] # Pos rotates true right down
-    Dy_axis = dTheta[1] # Pos rotates CCW from top
-    Dz_axis = dTheta[2] # Pos rotates back of cap up
     d2r = np.pi / 180   # Convert from degrees to radians
 
-
-    ## Create rotation matrices.
-    rotX = ndot.rotation_matrix('x', Dx_axis * d2r)
-    rotY = ndot.rotation_matrix('y', Dy_axis * d2r)
-    rotZ = ndot.rotation_matrix('z', Dz_axis * d2r)
+    ## Create rotation matrices (x: pos rotates true right down, y: pos rotates CCW from top, z: pos rotates back of cap up).
+    rot = ndot.rotation_matrices(np.asarray(dTheta, dtype = np.float64) * d2r)
 
     ## Rotate around Centroid.
-    rot = rotX @ rotY @ rotZ
-    tpos_out = (tpos_in - centroid_mat) @ rot + centroid_mat
+    tpos_out = (tpos_in - centroid) @ rot + centroid
 
     return tpos_out
 
@@ -246,4 +550,34 @@ def rotation_matrix(direction, theta):
     if direction == 'z':
         rot = np.array(([np.cos(theta), -np.sin(theta), 0], [np.sin(theta), np.cos(theta), 0], [0, 0, 1],), order = 'F')
     
-    return rot
\ No newline at end of file
+    return rot
+
+def rotation_matrices(theta):
+    """
+    ROTATION_MATRICES Creates a batch of composite rotation matrices.
+
+    rot = ROTATION_MATRICES(theta) takes a K x 3 array "theta" of rotation
+    angles (in radians) about x, y and z and returns the K x 3 x 3 stack
+    "rot" of ROTATION_MATRIX('x') @ ROTATION_MATRIX('y') @
+    ROTATION_MATRIX('z'), as used by ROTATE_CAP. A single 3-vector gives
+    a single 3 x 3 matrix.
+
+    See Also: ROTATION_MATRIX, ROTATE_CAP.
+    """
+
+    ## Parameters and Initialization.
+    theta = np.asarray(theta, dtype = np.float64)
+    single = theta.ndim == 1
+    theta = np.reshape(theta, (-1, 3))
+    c = np.cos(theta)
+    s = np.sin(theta)
+    one = np.ones(np.shape(theta)[0])
+    zero = np.zeros(np.shape(theta)[0])
+
+    ## Per-axis stacks, then the batched product.
+    rotX = np.stack((np.stack((one, zero, zero), -1), np.stack((zero, c[:, 0], -s[:, 0]), -1), np.stack((zero, s[:, 0], c[:, 0]), -1)), 1)
+    rotY = np.stack((np.stack((c[:, 1], zero, s[:, 1]), -1), np.stack((zero, one, zero), -1), np.stack((-s[:, 1], zero, c[:, 1]), -1)), 1)
+    rotZ = np.stack((np.stack((c[:, 2], -s[:, 2], zero), -1), np.stack((s[:, 2], c[:, 2], zero), -1), np.stack((zero, zero, one), -1)), 1)
+    rot = rotX @ rotY @ rotZ
+
+    return rot[0] if single else rot
\ No newline at end of file
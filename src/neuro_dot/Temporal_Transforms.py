@@ -135,7 +135,7 @@ def fft_tts(data, framerate):
 
     return ftdomain, ftmag, ftpower, ftphase
 
-def gethem(data, info, sel_type  = 'r2d', value = [10,16]):
+def gethem(data, info, sel_type  = 'r2d', value = [10,16], NNidx = None):
     """
     GETHEM Calculates the mean across a set of measurements.
     
@@ -155,6 +155,10 @@ def gethem(data, info, sel_type  = 'r2d', value = [10,16]):
     vector (for 'r2d' and 'r3d'), or a scalar or vector containing all
     nearest neighbor numbers to be averaged. By default, this function
     averages the first nearest neighbor.
+
+    hem = GETHEM(data, info, 'NN', value, NNidx) uses the per-NN index
+    lists "NNidx" returned by CALC_NN(..., return_idx = True) instead of
+    scanning "info.pairs.NN".
     
     See Also: REGCORR, DETREND_TTS.
     """
@@ -162,20 +166,26 @@ def gethem(data, info, sel_type  = 'r2d', value = [10,16]):
     ## Parameters and Initialization
     Nm = np.shape(data)[0]
     Nt = np.shape(data)[1]
-    cs = np.unique(info['pairs']['WL'])
+    WL = np.ravel(info['pairs']['WL']) # MEAS x 1 columns as vectors
+    cs = np.unique(WL)
     Nc = len(cs)
     hem = np.zeros(shape = [Nc,Nt])
 
     if sel_type == 'r2d':
-        keep_R_NN = np.logical_and((info['pairs']['r2d'] >= value[0]), info['pairs']['r2d'] <= value[1]).astype(np.uint8)
+        r2d = np.ravel(info['pairs']['r2d'])
+        keep_R_NN = np.logical_and((r2d >= value[0]), r2d <= value[1]).astype(np.uint8)
     elif sel_type == 'r3d':
-        keep_R_NN = np.logical_and((info['pairs']['r3d'] >= value[0]), info['pairs']['r3d'] <= value[1]).astype(np.uint8)
+        r3d = np.ravel(info['pairs']['r3d'])
+        keep_R_NN = np.logical_and((r3d >= value[0]), r3d <= value[1]).astype(np.uint8)
     elif sel_type == 'NN':
-        keep_R_NN = np.zeros(shape = info['pairs']['NN'])
-        k = value
-        while k == value:
-            keep_R_NN = np.logical_or(keep_R_NN, (info['pairs']['NN'] == k)).astype(np.uint8)
-            k = k+1
+        NN = np.ravel(info['pairs']['NN'])
+        if NNidx is not None: # reuse index lists from CALC_NN(..., return_idx = True)
+            keep_R_NN = np.zeros(np.shape(NN), dtype = np.uint8)
+            for k in np.atleast_1d(value):
+                if 0 < k <= len(NNidx):
+                    keep_R_NN[np.ravel(NNidx[int(k) - 1])] = 1
+        else:
+            keep_R_NN = np.isin(NN, value).astype(np.uint8)
 
     if np.logical_and(('MEAS' in info), (not 'GI' in info['MEAS'])):
         info['MEAS']['GI'] = np.ones(shape = (Nm, 1), dtype = np.bool8)
@@ -184,7 +194,7 @@ def gethem(data, info, sel_type  = 'r2d', value = [10,16]):
 
     k = 0
     while k <=1:
-        keep = np.logical_and(np.logical_and(keep_R_NN, (info['pairs']['WL'] == cs[k])), info['MEAS']['GI']).astype(np.uint8)
+        keep = np.logical_and(np.logical_and(keep_R_NN, (WL == cs[k])), np.ravel(info['MEAS']['GI'])).astype(np.uint8)
         hem[k, :] = np.mean(data[np.squeeze(np.argwhere(keep == 1)), :], 0) 
         k = k + 1
     return hem
@@ -530,7 +540,7 @@ def resample_tts(data_in, info_in, omega_resample = 1, tol = 0.001, framerate =
     """
 
     ## Parameters and Initialization.
-    info_out = copy.deepcopy(info_in)
+    info_out = ndot.Info(info_in)
     dims = np.shape(data_in)
     Nt = dims[-1]
     NDtf = np.ndim(data_in) > 2
@@ -150,7 +150,51 @@ def adjust_brain_pos(meshL, meshR, params = None):
 
     return Lnodes, Rnodes
 
-def applycmap(overlay, underlay, params):
+def _isempty(x):
+    # True for the "unset" parameter values used in NeuroDOT: None, [] or an empty array.
+    if x is None:
+        return True
+    if isinstance(x, (list, tuple, dict)):
+        return len(x) == 0
+    return np.size(x) == 0
+
+
+@ft.lru_cache(maxsize = 32)
+def _named_cmap(name, DR):
+    # DR x 4 (RGBA) table of a Matplotlib colormap, computed once per (name, DR).
+    table = plt.get_cmap(name, DR)(np.arange(0, DR))
+    table.flags.writeable = False
+    return table
+
+
+def _cmap_table(cmap, DR):
+    # Colormap look-up table: a Matplotlib colormap name, or an
+    # N x 3 (or N x 4) array of colors (RGB rows get an alpha of 1).
+    if isinstance(cmap, str):
+        return _named_cmap(cmap, DR)
+    table = np.asarray(cmap, dtype = np.float64)
+    if np.shape(table)[1] == 3:
+        table = np.hstack((table, np.ones((np.shape(table)[0], 1))))
+    return table
+
+
+def _lut_cast(rgb, dtype):
+    # RGB colors in [0, 1] as values of the output type (0-255 for uint8).
+    if np.dtype(dtype) == np.uint8:
+        return np.rint(np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+    return np.asarray(rgb, dtype = dtype)
+
+
+def _broadcast_volume(vol, img_size):
+    # View of "vol" with the shape "img_size": "vol" may match its leading
+    # dimensions (e.g., one volume for a X x Y x Z x TIME series) or, as
+    # in NumPy broadcasting, its trailing ones (TIME x X x Y x Z).
+    if np.shape(vol) != tuple(img_size) and tuple(img_size[0:np.ndim(vol)]) == np.shape(vol):
+        vol = np.reshape(vol, np.shape(vol) + (1,) * (len(img_size) - np.ndim(vol)))
+    return np.broadcast_to(vol, img_size)
+
+
+def applycmap(overlay, underlay, params = None, out = None):
     """  
     APPLYCMAP Performs color mapping and fuses images with anatomical models.
     
@@ -164,6 +208,16 @@ def applycmap(overlay, underlay, params):
     
     mapped = APPLYCMAP(overlay, underlay, params) allows the user to
     specify parameters for plot creation.
+
+    mapped = APPLYCMAP(overlay, underlay, params, out) writes the colors
+    into the preallocated N-D x 3 array "out" (float, or uint8 for 0-255
+    colors) and returns it.
+
+    Every value is mapped with one integer index into a look-up table of
+    the colormap(s) and background, so a whole time series (e.g.,
+    X x Y x Z x TIME) is mapped in one call. The "underlay" (and
+    "Saturation") may have the shape of one frame: they are broadcast
+    over the trailing (or, as in NumPy, leading) extra axes.
     
     Params:
         :TC: Direct map integer data values to defined color map ("True Color"). Default Value: 0
@@ -193,186 +247,154 @@ def applycmap(overlay, underlay, params):
         See Also: PLOTSLICES, PLOTINTERPSURFMESH, PLOTLRMESHES, PLOTCAPMEANLL.
     """
 
-    #  Parameters and initialization
-    img_size = overlay.shape
-    overlay = np.transpose(overlay.flatten())  
-    mapped = np.zeros((len(overlay), 3))
-    overlay[np.argwhere(np.isfinite(overlay)==False)] = 0
-    if underlay != []:
-        underlay[np.argwhere(np.isfinite(underlay)==False)]=0
+    ## Parameters and Initialization.
+    if params is None:
+        params = {}
+    overlay = np.asarray(overlay, dtype = np.float64)
+    img_size = np.shape(overlay)
+    overlay = np.where(np.isfinite(overlay), overlay, 0)
+    if out is None:
+        mapped = np.zeros(img_size + (3,))
+    else:
+        mapped = out
+        if np.shape(mapped) != img_size + (3,):
+            raise ValueError('Error: "out" must have shape ' + str(img_size + (3,)) + '.')
 
-    if not sum(abs(overlay[overlay!=0])):
-        print(['The Overlay has only elements equal to zero'])
-        mapped = mapped + 0.5
-        map_out=[0.5,0.5,0.5]
+    if 'BG' not in params or _isempty(params['BG']):
+        params['BG'] = [0.5, 0.5, 0.5]
+    BG = np.asarray(params['BG'], dtype = np.float64)[0:3]
 
-        return
-    
-    if underlay is None  or underlay == []:
+    if _isempty(underlay):
         params['underlay'] = 0
     else:
         params['underlay'] = 1
-        underlay = np.transpose(underlay.flatten())
-
-        max_underlay = max(underlay)
-        underlay = [number / max_underlay for number in underlay]  
-
-    if params is None:
-        params = {}
+        underlay = np.asarray(underlay, dtype = np.float64)
+        underlay = np.where(np.isfinite(underlay), underlay, 0)
+        underlay = underlay / np.max(underlay)
+        underlay = _broadcast_volume(underlay, img_size) # N-D view, not a copy
 
+    if not np.any(overlay != 0):
+        print(['The Overlay has only elements equal to zero'])
+        mapped[...] = _lut_cast(BG, mapped.dtype)
+        map_out = colors.ListedColormap([BG])
+        return mapped, map_out, params
 
-    if 'PD' not in params or params['PD'] == []:
+    if 'PD' not in params or _isempty(params['PD']):
         params['PD'] = 0
 
-    if 'TC' not in params or params['TC'] == []:
+    if 'TC' not in params or _isempty(params['TC']):
         params['TC'] = 0
 
-    if 'DR' not in params or params['DR'] == []:
+    if 'DR' not in params or _isempty(params['DR']):
         params['DR'] = 1000
+    DR = int(params['DR'])
 
-    if 'Scale' not in params or params['Scale'] == []:
-        params['Scale'] = 0.9 * max(overlay)
+    if 'Scale' not in params or _isempty(params['Scale']):
+        params['Scale'] = 0.9 * np.max(overlay)
 
-    if 'Th' not in params or params['Th'] == []:
+    if 'Th' not in params or _isempty(params['Th']):
+        params['Th'] = {}
+    if 'P' not in params['Th'] or _isempty(params['Th']['P']):
         params['Th']['P'] = 0.25 * params['Scale']
+    if 'N' not in params['Th'] or _isempty(params['Th']['N']):
         params['Th']['N'] = -params['Th']['P']
 
-    if 'N' not in params['Th'] or params['Th']['N'] == []:
-        params['Th']['N'] = -params['Th']['P']
-
-    if ('Cmap' not in params or params['Cmap'] == []) or ('P' in params['Cmap'] and params['Cmap']['P'] == []):
+    if 'Cmap' not in params or _isempty(params['Cmap']):
+        params['Cmap'] = {}
+    elif not isinstance(params['Cmap'], dict):
+        params['Cmap'] = {'P': params['Cmap']}
+    if 'P' not in params['Cmap'] or _isempty(params['Cmap']['P']):
         params['Cmap']['P'] = 'jet'
-    else:
-        if not isinstance(params['Cmap'], dict):
-            temp = params['Cmap']
-            params['Cmap'] = {}
-            params['Cmap']['P'] = temp
-    
-    Cmap = {}                                # Initialize colormap as an empty python dictionary
-    if isinstance(params['Cmap']['P'], str): # Generate positive and negative Cmaps, if present (chars are represented in Python as length 1 strings)
-        Cmap['P'] = plt.get_cmap(str(params['Cmap']['P']),params['DR'])
-        Cmap['P'] = Cmap['P'](range(params['DR']))
-    elif params['Cmap']['P'].isnumeric():
-        Cmap['P'] = params['Cmap']['P']
-    if 'flipP' in params['Cmap']  and params['Cmap']['flipP'] != []  and params['Cmap']['flipP']: # Optional colormap flip.
-        Cmap['P'] = np.flip(Cmap['P'], 0)
 
-    if 'N' in params['Cmap'] and params['Cmap']['N'] != []:
-        if isinstance(params['Cmap']['N'], str):
-            Cmap['N'] = eval(params['Cmap']['N'], '[', str(params['DR']), ']')
-        elif params['Cmap']['N'].isnumeric():
-            Cmap['N'] = params['Cmap']['N']
-        
-        if 'flipN' in params['Cmap'] and params['Cmap']['flipN'] != [] and params['Cmap']['flipN']:
+    ## Look-up tables: DR x 4 (RGBA) colormaps, and their RGB in the output type.
+    Cmap = {}
+    Cmap['P'] = _cmap_table(params['Cmap']['P'], DR)
+    if 'flipP' in params['Cmap'] and not _isempty(params['Cmap']['flipP']) and params['Cmap']['flipP']: # Optional colormap flip.
+        Cmap['P'] = np.flip(Cmap['P'], 0)
+    if 'N' in params['Cmap'] and not _isempty(params['Cmap']['N']):
+        Cmap['N'] = _cmap_table(params['Cmap']['N'], DR)
+        if 'flipN' in params['Cmap'] and not _isempty(params['Cmap']['flipN']) and params['Cmap']['flipN']:
             Cmap['N'] = np.flip(Cmap['N'], 0)
-        
         params['PD'] = 1
-
-    if 'BG' not in params or params['BG'] == []:
-        params['BG'] = [0.5, 0.5, 0.5]
-
-    ## Get Background.
-    bg = np.argwhere(overlay == 0)
-    ## Truecolor
+    ## One look-up table: the positive colormap (rows 0 to NP-1), the
+    ## background (NP), the negative colormap and black for unmapped values.
+    NP = np.shape(Cmap['P'])[0]
+    lut = [Cmap['P'][:, 0:3], np.reshape(BG, (1, 3))]
+    if 'N' in Cmap:
+        lut.append(Cmap['N'][:, 0:3])
+    lut.append(np.zeros((1, 3)))
+    lut = _lut_cast(np.vstack(lut), mapped.dtype)
+    n0 = NP + 1
+    black = np.shape(lut)[0] - 1
+
+    ## Truecolor: integer data values index the colormap directly.
+    bg = overlay == 0
     if params['TC']:
-        # Color in RGB channels.
-        Nc = np.shape(Cmap['P'], 0)
-        for i in range(0,Nc):
-            mapped[np.where(overlay == i)[0], 0] = Cmap['P'][i, 0]
-            mapped[np.where(overlay == i)[0], 1] = Cmap['P'][i, 1]
-            mapped[np.where(overlay == i)[0], 2] = Cmap['P'][i, 2]
-
-        #Color in background.
-        if not params['underlay']:
-            mapped[bg, :] = nm.repmat(params['BG'], len(bg), 1)
-
-        else:
-            mapped[bg, :] = [underlay[bg] * params.BG[1], underlay[bg] * params['BG'][2], underlay[bg] * params['BG'][3]]  
+        idx = overlay.astype(np.int64)
+        code = np.where((idx == overlay) & (idx >= 0) & (idx < NP), idx, black)
 
     else:
         ## Label Data Outside Thresholds to Background.
-        bg = ft.reduce(np.union1d,(bg, np.intersect1d(np.argwhere(overlay <= params['Th']['P']), np.argwhere(overlay >= params['Th']['N']))))
-        ##  Scaling and Dynamic Range.
-        # All below threshold set to gray, all above set to colormap.
-        if params['PD']: 
-            overlay = (np.multiply(np.divide(overlay, params['Scale']), (params['DR']))) # Normalize and scale to colormap
-            fgP = np.argwhere(overlay > 0) # Populate Pos to color; returns array of indices - potential cause of off by one errors later on
-            fgN = np.argwhere(overlay < 0) # Populate Neg to color
-        else:
-            overlay = (np.multiply(np.divide(overlay, params['Scale']) , params['DR'] / 2)) # Normalize and scale to colormap
-            overlay = overlay + (params['DR'] / 2) # Shift data
-            fgP = np.argwhere(overlay != (params['DR'] / 2))   # Populate Pos to color
-            overlay[np.argwhere(overlay <= 0)] = 1 # Correct for neg clip
-        
-        overlay[np.argwhere(overlay >= params['DR'])] = params['DR']# Correct for pos clip
-        
-        
-        
-        # Color in RGB channels.
-        mapped[fgP, 0] = Cmap['P'][np.ceil(overlay[fgP]).astype(int)-1, 0]
-        mapped[fgP, 1] = Cmap['P'][np.ceil(overlay[fgP]).astype(int)-1, 1]
-        mapped[fgP, 2] = Cmap['P'][np.ceil(overlay[fgP]).astype(int)-1, 2]
+        bg |= (overlay <= params['Th']['P']) & (overlay >= params['Th']['N'])
 
-        # Pos def treatment.
+        ## Scaling and Dynamic Range: colormap indices, with clipping.
         if params['PD']:
-            if 'N' in params['Cmap']:
-                overlay[-overlay >= params['DR']] = -params['DR'] # Correct for clip.
-                mapped[fgN, 0] = Cmap['N'][np.ceil(-overlay[fgN]), 0]
-                mapped[fgN, 1] = Cmap['N'][np.ceil(-overlay[fgN]), 1]
-                mapped[fgN, 2] = Cmap['N'][np.ceil(-overlay[fgN]), 2]
-
+            overlay = overlay * (DR / params['Scale']) # Normalize and scale to colormap
+            code = np.where(overlay > 0, np.ceil(np.minimum(overlay, DR)) - 1, black)
+            if 'N' in Cmap: # Pos def treatment.
+                code = np.where(overlay < 0, n0 + np.ceil(np.minimum(-overlay, DR)) - 1, code)
             else:
-                bg = np.union1d(bg, fgN) # If only pos, neg values to background.
-
-        ## Apply background coloring.
-    if not params['underlay']: 
-        mapped[bg, :] = nm.repmat(params['BG'], len(bg), 1)
+                bg |= overlay < 0 # If only pos, neg values to background.
+        else:
+            overlay = overlay * (DR / 2 / params['Scale']) + (DR / 2) # Normalize, scale and shift
+            fgP = overlay != (DR / 2)
+            overlay = np.where(overlay <= 0, 1, overlay) # Correct for neg clip
+            code = np.where(fgP, np.ceil(np.minimum(overlay, DR)) - 1, black) # Correct for pos clip
+
+    ## Color in RGB channels, with one gather from the table.
+    code = np.where(bg, NP, code).astype(np.intp)
+    if mapped.flags.c_contiguous:
+        np.take(lut, code, axis = 0, out = mapped, mode = 'clip')
     else:
-        underlay = np.array(underlay)
-        mapped[bg, :] = np.array([np.multiply(underlay[bg], params['BG'][0]), np.multiply(underlay[bg], params['BG'][1]), np.multiply(underlay[bg], params['BG'][2])]).transpose() 
+        mapped[...] = np.take(lut, code, axis = 0, mode = 'clip')
+    if params['underlay']: # Background from the underlay.
+        mapped[bg] = _lut_cast(underlay[bg][:, None] * BG, mapped.dtype)
 
     ## Apply Saturation if available
     if 'Saturation' in params:
-        nbg = np.setdiff1d(np.arange(1, np.shape(mapped)[0]), bg)
+        nbg = ~bg
+        sat = _broadcast_volume(np.asarray(params['Saturation'], dtype = np.float64), img_size)[nbg][:, None]
+        fg = mapped[nbg] / (255.0 if mapped.dtype == np.uint8 else 1.0)
         if not params['underlay']:
-            mapped[nbg,:] = (np.multiply(params['Saturation'][nbg], mapped[nbg,:])) + (np.multiply(params['BG']* (1- params['Saturation'][nbg])))
-
+            mapped[nbg] = _lut_cast(sat * fg + (1 - sat) * BG, mapped.dtype)
         else:
-            mapped[nbg,:] = (np.multiply(params['Saturation'][nbg], mapped[nbg,:])) + (np.multiply(params['BG'], (np.multiply(1- params['Saturation'][nbg],underlay[nbg, :]))))
-        
-        # Reshape to original size + RGB.
-    if (len(img_size) == 1):
-        mapped = np.reshape(mapped, [img_size[0], 3])
-    else:
-        mapped = np.reshape(mapped, list(img_size) + [3])
+            mapped[nbg] = _lut_cast(sat * fg + (1 - sat) * underlay[nbg][:, None] * BG, mapped.dtype)
 
     ## Create a final color map.
     if not params['underlay']:
-        thresh_zone_color = params['BG'] # Same color as background if no underlay.
+        thresh_zone_color = BG # Same color as background if no underlay.
     else:
         thresh_zone_color = [0, 0, 0] # Black if there is an underlay.
 
-    map_out = Cmap['P']
+    map_out = np.array(Cmap['P'])
     if params['TC']:
         map_out = params['Cmap']['P']
     else:
         if params['PD']:
-            thP = np.floor(params['Th']['P'] / params['Scale'] * params['DR']).astype(int) 
-
-            map_out[1:thP, 0:3] = nm.repmat(thresh_zone_color, thP, 1)
+            thP = int(np.floor(params['Th']['P'] / params['Scale'] * DR))
+            map_out[0:max(thP, 0), 0:3] = thresh_zone_color
             if 'N' in Cmap:
-                thN = np.floor(params['Th']['N'] / params['Scale'] * params['DR'])
-                tempN = Cmap['N']
-                tempN[1:thN, :] = nm.repmat(thresh_zone_color, thN, 1)
-                map_out = np.hstack(np.flip(tempN, 0), map_out)
+                thN = int(np.floor(-params['Th']['N'] / params['Scale'] * DR))
+                tempN = np.array(Cmap['N'])
+                tempN[0:max(thN, 0), 0:3] = thresh_zone_color
+                map_out = np.vstack((np.flip(tempN, 0), map_out))
             
         else:
-            thP = np.floor(params['Th']['P'] / params['Scale'] * params['DR'] / 2 + (params['DR'] / 2)).astype(np.int64)
-            thN = np.ceil(params['Th']['N'] / params['Scale'] * params['DR'] / 2 + (params['DR'] / 2)).astype(np.int64)
+            thP = np.floor(params['Th']['P'] / params['Scale'] * DR / 2 + (DR / 2)).astype(np.int64)
+            thN = np.ceil(params['Th']['N'] / params['Scale'] * DR / 2 + (DR / 2)).astype(np.int64)
             if thN<1:
                 thN=1
-            thresh_A = nm.repmat(thresh_zone_color, 1, 1)
-            thresh_A = np.append(thresh_A, 1)    
+            thresh_A = np.append(thresh_zone_color, 1)
             map_out[thN:thP, :] = thresh_A
 
     
@@ -474,13 +496,17 @@ def nlrGrayPlots_220324(nlrdata, info, mode = 'auto'):
     
     ## Prepare data and imagesc together
     keep = {}
-    keep['d1'] = np.logical_and(np.logical_and(info['MEAS']['GI'],(info['pairs']['r2d']<20)),(info['pairs']['WL'] == 2)).astype(np.uint8)
-    keep['d2'] = np.logical_and(np.logical_and(np.logical_and(info['MEAS']['GI'],(info['pairs']['r2d']>=20)), #and
-    (info['pairs']['r2d']<30)), #and
-    (info['pairs']['WL'] == 2)).astype(np.uint8)
-    keep['d3'] = np.logical_and(np.logical_and(np.logical_and(info['MEAS']['GI'],(info['pairs']['r2d']>=30)), #and
-    (info['pairs']['r2d']<40)), #and
-    (info['pairs']['WL'] == 2)).astype(np.uint8)
+    # MEAS x 1 columns as vectors, so that the masks stay MEAS long
+    GI = np.ravel(info['MEAS']['GI'])
+    r2d = np.ravel(info['pairs']['r2d'])
+    WL = np.ravel(info['pairs']['WL'])
+    keep['d1'] = np.logical_and(np.logical_and(GI,(r2d<20)),(WL == 2)).astype(np.uint8)
+    keep['d2'] = np.logical_and(np.logical_and(np.logical_and(GI,(r2d>=20)), #and
+    (r2d<30)), #and
+    (WL == 2)).astype(np.uint8)
+    keep['d3'] = np.logical_and(np.logical_and(np.logical_and(GI,(r2d>=30)), #and
+    (r2d<40)), #and
+    (WL == 2)).astype(np.uint8)
     
     SepSize = np.round((np.sum(keep['d1']) + np.sum(keep['d2']) + np.sum(keep['d3']))/50)
     nans = np.empty((SepSize.astype(np.int64), Nt))
@@ -3252,7 +3278,8 @@ def PlotSlices(underlay, infoVol = None, params = None, overlay = None):
     PLOTSLICES Creates an interactive 3D plot, including transverse, sagittal, and coronal slices.
 
     PLOTSLICES(underlay) takes a 3D voxel space image "underlay" and
-    generates views along the three canonical axes.
+    generates views along the three canonical axes. "underlay" and
+    "overlay" may also be single-frame VOXELVOLUMEs.
 
     In interactive mode, left-click on any point to move to those slices.
     To reset to the middle of the volume, right-click anywhere. To cancel
@@ -3314,6 +3341,15 @@ def PlotSlices(underlay, infoVol = None, params = None, overlay = None):
     # Parameters and initialization.
     LineColor = 'w'
     BkgdColor = 'k'
+    # Lazy volumes (VOXELVOLUME) are densified for their single time point only.
+    if isinstance(underlay, ndot.VoxelVolume):
+        if underlay.shape[3] > 1:
+            raise Exception("'underlay' has more than one time point. Select one with VoxelVolume.frame.")
+        underlay = underlay[:, :, :, 0]
+    if isinstance(overlay, ndot.VoxelVolume):
+        if overlay.shape[3] > 1:
+            raise Exception("'overlay' has more than one time point. Select one with VoxelVolume.frame.")
+        overlay = overlay[:, :, :, 0]
     [nVx, nVy, nVz] = np.shape(underlay)
     button = 0
     axlist = ['X', 'Y', 'Z']
@@ -4107,12 +4143,7 @@ def PlotSlicesTimeTrace(underlay, infoVol = None, params = None, overlay = None,
     if overlay is None:
         [FUSED, CMAP, params2] = ndot.applycmap(underlay, [], params) #save out params from ACM as params2 to not overwrite params in workspace
     else:
-        if nVtU == 1:
-            # repeat anatomy for all time points, create 4D array
-            new_array = np.zeros([nVxO, nVyO, nVzO, nVtO])
-            for i in range(0,nVtO):
-                new_array[:,:,:,i] = underlay
-            underlay = new_array
+        # a 3D anatomy is broadcast over all time points by applycmap
         [FUSED, CMAP, params2] = ndot.applycmap(overlay, underlay, params) #save out params from ACM as params2 to not overwrite params in workspace
 
 
@@ -4541,78 +4572,110 @@ def PlotTimeTraceData(data, time, params = None, fig_axes = None, coordinates =
     return ax
 
 
-def vol2surf_mesh(Smesh, volume, dim, params = None):
+def vol2surf_mesh(Smesh, volume, dim, params = None, plan = None):
     """
     VOL2SURF_MESH Interpolates volumetric data onto a surface mesh.
 
     Smesh = VOL2SURF_MESH(mesh_in, volume, dim) takes the mesh "Smesh"
     and interpolates the values of the volumetric data "volume" at the
     mesh's surface, using the spatial information in "dim". These values
-    are output as "Smesh".
+    are output as "Smesh". "volume" may be X x Y x Z, X x Y x Z x TIME,
+    or a VOX x TIME array over all voxels or over "dim.Good_Vox" (no
+    GOOD_VOX2VOL step is needed). "Smesh.data" is NODE x TIME, or a
+    vector of node values for a single time point.
 
     Smesh = VOL2SURF_MESH(Smesh, volume, dim, params) allows the user
     to specify parameters for plot creation.
 
+    Smesh = VOL2SURF_MESH(Smesh, volume, dim, params, plan) uses the
+    operator precomputed by VOL2SURF_PLAN, so that many volumes or
+    time series can be projected onto the same mesh with one sparse
+    product each.
+
     Params:
         :OL:      0   If "overlap" data is presented (OL==1), this sets the
                     interpolation method to "nearest". Default is "linear".
 
-    See Also: PLOTINTERPSURFMESH, GOOD_VOX2VOL, AFFINE3D_IMG.
+    See Also: VOL2SURF_PLAN, PLOTINTERPSURFMESH, GOOD_VOX2VOL, AFFINE3D_IMG.
     """
 
     ## Parameters and Initialization.
     if params == None:
         params = {}
-
-    size_vol = volume.shape
-    if len(size_vol) <= 3:
-        Ncols = 1
+    if plan is None:
+        plan = vol2surf_plan(Smesh, dim, params)
+    Nvox = int(dim['nVx']) * int(dim['nVy']) * int(dim['nVz'])
+
+    volume = np.asarray(volume)
+    if volume.ndim >= 3:
+        Ncols = 1 if volume.ndim == 3 else volume.shape[3]
+        img = np.reshape(volume, (Nvox, Ncols), order = 'F')
     else:
-        Ncols = size_vol[3]
-    Ncoords = Smesh['nodes'].shape[0]
-    Smesh['data'] = np.zeros((Ncoords, Ncols))
-    extrapval = 0
-
-    nVx = dim['nVx']
-    nVy = dim['nVy']
-    nVz = dim['nVz']
-    dr = dim['mmppix']
-    center = dim['center']
-
-    if not 'OL' in params or params['OL'] == False:
-        params['OL'] = 0
-    if 'OL' in params and params['OL'] == 1:
-        method = 'nearest'
+        img = np.reshape(volume, (volume.shape[0], -1))
+        Ncols = img.shape[1]
+
+    ## Project all time points at once.
+    if img.shape[0] == Nvox:
+        data = plan['W'] @ img
+    elif 'W_gv' in plan and img.shape[0] == plan['W_gv'].shape[1]:
+        data = plan['W_gv'] @ img
     else:
-        method = 'linear'
+        raise ValueError('Error: volume rows match neither the voxels of dim nor dim.Good_Vox.')
 
-    buffer = 2
+    if Ncols == 1:
+        data = data[:, 0]
+    Smesh['data'] = data
 
-    ## Define coordinate space of volumetric data
-    X = np.multiply(dr[0], np.arange(nVx, 0, -1)) - center[0] # changed stop index to be 0 instead of 1 to get the correct number of elements in vector bc of python 0 indexing
-    Y = np.multiply(dr[1], np.arange(nVy, 0, -1)) - center[1]
-    Z = np.multiply(dr[2], np.arange(nVz, 0, -1)) - center[2]
+    return Smesh
 
-    ## Get coordinates for surface mesh
-    x = Smesh['nodes'][:,0]
-    y = Smesh['nodes'][:,1]
-    z = Smesh['nodes'][:,2]
 
+def vol2surf_plan(Smesh, dim, params = None):
+    """
+    VOL2SURF_PLAN Precomputes the volume-to-surface interpolation of VOL2SURF_MESH.
+
+    plan = VOL2SURF_PLAN(Smesh, dim, params) returns a structure "plan"
+    whose field "W" is a sparse NODE x VOX matrix that interpolates a
+    VOX x TIME array over all voxels of the space "dim" (column-major,
+    as in GOOD_VOX2VOL) at the nodes of "Smesh". If "dim" has a
+    "Good_Vox" field, "plan.W_gv" holds the columns of the good voxels,
+    so VOX x TIME reconstructions map onto the mesh directly. Nodes
+    up to 2 mm outside the volume (MNI and TT atlas space cuts off the
+    occipital pole and parts of the dorsal tip and lateral extremes)
+    are moved onto its boundary; nodes further out get zero rows. The
+    mesh itself is not modified.
 
-    ## Correct for nodes just outside of volume (MNI and TT atlas space cuts off occipital pole and part of dorsal tip and lateral extremes).
-    x[np.logical_and((x < min(X)), (x > min(X) - buffer))] =  min(X)
-    x[np.logical_and((x > max(X)), (x > max(X) - buffer))] =  max(X)
+    Params:
+        :OL:      0   If "overlap" data is presented (OL==1), this sets the
+                    interpolation method to "nearest". Default is "linear".
 
-    y[np.logical_and((y < min(Y)), (y > min(Y) - buffer))] =  min(Y)
-    y[np.logical_and((y > max(Y)), (y > max(Y) - buffer))] =  max(Y)
+    See Also: VOL2SURF_MESH, GRID_INTERP_MATRIX.
+    """
 
-    z[np.logical_and((z < min(Z)), (z > min(Z) - buffer))] =  min(Z)
-    z[np.logical_and((z > max(Z)), (z > max(Z) - buffer))] =  max(Z)
+    ## Parameters and Initialization.
+    if params == None:
+        params = {}
+    if 'OL' in params and params['OL'] == 1:
+        method = 'nearest'
+    else:
+        method = 'linear'
+    buffer = 2
 
-    ## Interpolate
-    X = np.flip(X)
-    volume = np.flip(volume, axis = 0)
-    for k in range(0, Ncols):
-        Smesh['data'] = scipy.interpolate.interpn((X, Y, Z), np.squeeze(volume[:,:,:]), np.array([x, y, z]).T, method = method, bounds_error = False, fill_value = extrapval)
-    
-    return Smesh
\ No newline at end of file
+    nV = np.array([int(dim['nVx']), int(dim['nVy']), int(dim['nVz'])])
+    dr = np.asarray(dim['mmppix'], dtype = np.float64)
+    center = np.asarray(dim['center'], dtype = np.float64)
+
+    ## Correct for nodes just outside of volume.
+    lo = np.minimum(dr * nV, dr) - center
+    hi = np.maximum(dr * nV, dr) - center
+    xyz = np.array(Smesh['nodes'][:, 0:3], dtype = np.float64)
+    below = (xyz < lo) & (xyz > lo - buffer)
+    above = (xyz > hi) & (xyz < hi + buffer)
+    xyz = np.where(below, lo, np.where(above, hi, xyz))
+
+    ## Sparse interpolation weights.
+    plan = dict()
+    plan['W'] = ndot.grid_interp_matrix(xyz, dim, method)
+    if 'Good_Vox' in dim:
+        plan['W_gv'] = plan['W'].tocsc()[:, np.asarray(dim['Good_Vox']).astype(int).ravel() - 1].tocsr()
+
+    return plan
\ No newline at end of file
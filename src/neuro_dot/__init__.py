@@ -7,4 +7,7 @@ from neuro_dot.Light_Modeling import *
 from neuro_dot.DynamicFilter import *
 from neuro_dot.Reconstruction import *
 from neuro_dot.Analysis import *
-
+from neuro_dot.Resolution_Analysis import *
+from neuro_dot.Registration import *
+from neuro_dot.Data_Structures import *
+from neuro_dot.Ingest import *